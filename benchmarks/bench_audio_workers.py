@@ -0,0 +1,100 @@
+"""
+Benchmark: CPU của tiến trình bot khi đọc gói Opus trực tiếp từ FFmpeg so với nhận gói từ worker âm thanh (AUDIO_WORKERS).
+
+Tạo file Opus mẫu bằng nguồn lavfi của FFmpeg và phục vụ qua HTTP cục bộ (không cần mạng), rồi phát đồng thời
+nhiều luồng qua bot.build_ffmpeg_source như voice_client (mỗi luồng một thread đọc đến hết).
+CPU được đo bằng time.process_time() nên chỉ tính tiến trình bot, không tính FFmpeg hay worker.
+
+Chạy từ thư mục gốc của dự án:
+    python benchmarks/bench_audio_workers.py --seconds 60 --streams 8 --workers 2
+"""
+import argparse
+import functools
+import http.server
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+
+def make_fixture(path, seconds):
+    subprocess.run(
+        [bot.FFMPEG_PATH, '-nostdin', '-loglevel', 'error', '-y',
+         '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+         '-ac', '2', '-ar', '48000', '-c:a', 'libopus', '-b:a', '128k', path],
+        check=True
+    )
+
+
+def drain(source, counts):
+    frames = 0
+    while source.read():
+        frames += 1
+    source.cleanup()
+    counts.append(frames)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(directory):
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure(url, streams):
+    song = bot.Track(url, 'fixture')
+    counts = []
+    cpu_before = time.process_time()
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(target=drain, args=(bot.build_ffmpeg_source(song), counts)) for _ in range(streams)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.process_time() - cpu_before, time.perf_counter() - started, sum(counts) * 0.02
+
+
+def report(name, cpu, wall, audio_seconds):
+    print(f"{name:<7} cpu={cpu:7.3f}s wall={wall:7.3f}s audio={audio_seconds:7.1f}s "
+          f"cpu/giây âm thanh={cpu / audio_seconds * 1000:6.3f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=int, default=60, help='Độ dài file mẫu (giây)')
+    parser.add_argument('--streams', type=int, default=4, help='Số luồng phát đồng thời')
+    parser.add_argument('--workers', type=int, default=2, help='Số worker âm thanh')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'fixture.webm')
+        make_fixture(path, args.seconds)
+        server = serve(tmp)
+        bot.PROXY_URL = None  # Máy chủ HTTP cục bộ, không đi qua proxy
+        url = f'http://127.0.0.1:{server.server_address[1]}/fixture.webm'
+        report('local', *measure(url, args.streams))
+
+        bot.audio_worker_pool = bot.AudioWorkerPool(args.workers)
+        bot.audio_worker_pool.start()
+        try:
+            report('workers', *measure(url, args.streams))
+        finally:
+            bot.audio_worker_pool.close()
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
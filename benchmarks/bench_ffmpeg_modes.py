@@ -0,0 +1,80 @@
+"""
+Benchmark: CPU của FFmpeg cho mỗi luồng phát ở chế độ stream copy so với mã hóa lại để chỉnh âm lượng (gain).
+
+Tạo file Opus mẫu bằng nguồn lavfi của FFmpeg (không cần mạng), rồi phát qua discord.FFmpegOpusAudio
+với đúng tùy chọn mà bot dùng (bot.ffmpeg_output_options). CPU được đo bằng getrusage(RUSAGE_CHILDREN)
+nên chỉ tính tiến trình FFmpeg, không tính phần Python đọc gói.
+
+Chạy từ thư mục gốc của dự án:
+    python benchmarks/bench_ffmpeg_modes.py --seconds 120 --streams 4
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+
+import bot
+
+
+def make_fixture(path, seconds):
+    # Tín hiệu sine + nhiễu hồng, mã hóa Opus giống luồng webm của YouTube
+    subprocess.run(
+        [bot.FFMPEG_PATH, '-nostdin', '-loglevel', 'error', '-y',
+         '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+         '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.1:duration={seconds}',
+         '-filter_complex', 'amix=inputs=2', '-ac', '2', '-ar', '48000',
+         '-c:a', 'libopus', '-b:a', '128k', path],
+        check=True
+    )
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def play_through(path, gain_db):
+    source = discord.FFmpegOpusAudio(path, executable=bot.FFMPEG_PATH, options=bot.ffmpeg_output_options(gain_db))
+    frames = 0
+    while source.read():
+        frames += 1
+    source.cleanup()
+    return frames
+
+
+def measure(path, gain_db, streams):
+    cpu_before = children_cpu()
+    started = time.perf_counter()
+    frames = sum(play_through(path, gain_db) for _ in range(streams))
+    wall = time.perf_counter() - started
+    cpu = children_cpu() - cpu_before
+    audio_seconds = frames * 0.02  # Mỗi gói Opus 20ms
+    return cpu, wall, audio_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=int, default=60, help='Độ dài file mẫu (giây)')
+    parser.add_argument('--streams', type=int, default=3, help='Số lần phát mỗi chế độ')
+    parser.add_argument('--gain', type=float, default=-6.0, help='Mức gain (dB) cho chế độ mã hóa lại')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'fixture.webm')
+        make_fixture(path, args.seconds)
+        for name, gain_db in (('copy', None), ('gain', args.gain)):
+            cpu, wall, audio_seconds = measure(path, gain_db, args.streams)
+            per_audio_second = cpu / audio_seconds * 1000
+            print(f"{name:<5} cpu={cpu:7.3f}s wall={wall:7.3f}s audio={audio_seconds:7.1f}s "
+                  f"cpu/giây âm thanh={per_audio_second:6.2f}ms (~{per_audio_second / 10:.2f}% một nhân khi phát thời gian thực)")
+
+
+if __name__ == '__main__':
+    main()
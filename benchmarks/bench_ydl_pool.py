@@ -0,0 +1,102 @@
+"""
+Benchmark: độ trễ mỗi lần phân giải khi tạo YoutubeDL mới (cold) so với dùng kho YoutubeDLPool (warm).
+
+Dùng một extractor cục bộ (FixtureIE) nên không cần mạng; số đo phản ánh chi phí khởi tạo
+YoutubeDL (extractor, cookie, HTTP opener) chứ không phải thời gian tải từ YouTube.
+
+Chạy từ thư mục gốc của dự án:
+    python benchmarks/bench_ydl_pool.py --iterations 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yt_dlp
+from yt_dlp.extractor.common import InfoExtractor
+
+import bot
+
+
+class FixtureIE(InfoExtractor):
+    """
+    Extractor giả lập trả về một định dạng âm thanh cố định cho URL fixture:<id>.
+    """
+    IE_NAME = 'Fixture'
+    _VALID_URL = r'fixture:(?P<id>[A-Za-z0-9_-]{11})'
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        expire = int(time.time()) + 6 * 3600
+        return {
+            'id': video_id,
+            'title': f'Fixture {video_id}',
+            'duration': 180,
+            'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+            'formats': [{
+                'format_id': '251',
+                'url': f'https://rr1.googlevideo.invalid/videoplayback?id={video_id}&expire={expire}',
+                'ext': 'webm',
+                'acodec': 'opus',
+                'vcodec': 'none',
+                'abr': 160,
+            }],
+        }
+
+
+def fixture_ydl(options):
+    ydl = yt_dlp.YoutubeDL(options)
+    ydl.add_info_extractor(FixtureIE())
+    return ydl
+
+
+def resolve_cold(url):
+    # Giống đường cũ: mỗi lần phân giải tạo một YoutubeDL mới
+    with fixture_ydl({**bot.YDL_BASE_OPTIONS, **bot.YDL_RETRY_PROFILES[0]}) as ydl:
+        return ydl.extract_info(url, download=False, ie_key='Fixture')
+
+
+def make_resolve_warm(pool):
+    def resolve_warm(url):
+        with pool.acquire(0) as ydl:
+            return ydl.extract_info(url, download=False, ie_key='Fixture')
+    return resolve_warm
+
+
+def measure(resolve, iterations):
+    samples = []
+    for i in range(iterations):
+        url = f'fixture:{i:011d}'
+        started = time.perf_counter()
+        info = resolve(url)
+        samples.append(time.perf_counter() - started)
+        assert info and info.get('url'), f'Không phân giải được {url}'
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{name:<6} mean={statistics.mean(samples) * 1000:8.2f}ms "
+          f"p50={statistics.median(samples) * 1000:8.2f}ms p95={p95 * 1000:8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=100)
+    args = parser.parse_args()
+
+    pool = bot.YoutubeDLPool(bot.YDL_BASE_OPTIONS, bot.YDL_RETRY_PROFILES, size=1, factory=fixture_ydl)
+    pool.warm()
+
+    report('cold', measure(resolve_cold, args.iterations))
+    report('warm', measure(make_resolve_warm(pool), args.iterations))
+    print(f"pool: created={pool.created} reused={pool.reused}")
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,13 +6,41 @@ import aiohttp
 import isodate
 import asyncio
 import shutil
+import subprocess
 import random
+import math
+import sys
+import time
+import queue
+import threading
+import contextlib
+import contextvars
+import itertools
+import json
+import hashlib
+import sqlite3
+import tempfile
+import unicodedata
+import datetime
+import concurrent.futures
+import traceback
+import atexit
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from urllib.parse import urlparse, parse_qs
 from discord.ext import commands
 from discord.ui import Button, View, Select
+from aiohttp import web
 from dotenv import load_dotenv
 import logging
+import logging.handlers
 from cachetools import TTLCache
 
+try:
+    import fcntl  # Khóa file để giới hạn FFmpeg trên toàn máy (không có trên Windows)
+except ImportError:
+    fcntl = None
+
 # -----------------------------#
 #    Đọc Thông Tin Proxy        #
 # -----------------------------#
@@ -61,15 +89,59 @@ else:
 #        Cài Đặt Logging        #
 # -----------------------------#
 
-# Thiết lập logging để theo dõi và gỡ lỗi
-logging.basicConfig(
-    level=logging.INFO,  # Thiết lập mức logging (INFO, DEBUG, ERROR, v.v.)
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Định dạng log
-    handlers=[
+# Shard đang xử lý sự kiện/lệnh hiện tại; tác vụ asyncio tạo ra từ đó kế thừa giá trị này
+current_shard = contextvars.ContextVar('current_shard', default=None)
+
+class ShardLogFilter(logging.Filter):
+    """
+    Thêm shard hiện tại (record.shard) vào mọi bản ghi log, kể cả log của discord.py.
+    """
+    def filter(self, record):
+        shard_id = current_shard.get()
+        record.shard = '-' if shard_id is None else shard_id
+        return True
+
+LOG_FORMAT = '%(asctime)s - [shard %(shard)s] - %(name)s - %(levelname)s - %(message)s'  # Định dạng log
+log_listener = None
+
+def build_log_handlers():
+    handlers = [
         logging.FileHandler("bot.log"),  # Ghi log vào file
         logging.StreamHandler()          # Ghi log ra console
     ]
-)
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    return handlers
+
+def configure_logging():
+    """
+    Thiết lập logging cho tiến trình bot: ghi file/console trong thread riêng (QueueListener)
+    để lệnh log không chặn event loop khi đĩa chậm.
+    """
+    global log_listener
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, *build_log_handlers(), respect_handler_level=True)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))  # Chỉ ghép message; định dạng đầy đủ do handler đích áp dụng
+    queue_handler.addFilter(ShardLogFilter())  # Đọc shard trong thread ghi log, trước khi đưa vào hàng đợi
+    logging.basicConfig(
+        level=logging.INFO,  # Thiết lập mức logging (INFO, DEBUG, ERROR, v.v.)
+        handlers=[queue_handler],
+        force=True  # Các cảnh báo proxy/cookies khi import đã tự cấu hình root logger; thay bằng cấu hình này
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)  # Ghi nốt các log còn trong hàng đợi khi thoát
+
+def configure_process_logging():
+    """
+    Thiết lập logging cho tiến trình con (worker trích xuất, worker âm thanh): ghi trực tiếp vào file/console.
+    Tiến trình con không có thread QueueListener, nên QueueHandler kế thừa khi fork sẽ không bao giờ được đọc.
+    """
+    handlers = build_log_handlers()
+    for handler in handlers:
+        handler.addFilter(ShardLogFilter())
+    logging.basicConfig(level=logging.INFO, handlers=handlers, force=True)
+
 logger = logging.getLogger(__name__)
 
 # -----------------------------#
@@ -81,14 +153,39 @@ load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')          # Token Discord Bot
 YOUTUBE_API_KEY = os.getenv('YOUTUBE_API_KEY')  # API Key YouTube
 
+def parse_shard_ids(value):
+    """
+    Đọc danh sách shard từ chuỗi dạng "0-3,8" (khoảng đóng và số lẻ, phân cách bằng dấu phẩy).
+    """
+    shard_ids = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return sorted(set(shard_ids))
+
+# Sharding: SHARD_COUNT trống/"auto" để Discord đề xuất số shard; SHARD_IDS chọn các shard chạy trong tiến trình này
+# (ví dụ hai tiến trình trên cùng máy: SHARD_COUNT=8 SHARD_IDS=0-3 và SHARD_COUNT=8 SHARD_IDS=4-7)
+SHARD_COUNT = None if os.getenv('SHARD_COUNT', 'auto') in ('', 'auto') else int(os.getenv('SHARD_COUNT'))
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', '')) or None
+if SHARD_IDS and SHARD_COUNT is None:
+    raise ValueError("SHARD_IDS cần đi kèm SHARD_COUNT.")
+if SHARD_IDS and max(SHARD_IDS) >= SHARD_COUNT:
+    raise ValueError(f"SHARD_IDS phải nằm trong khoảng 0-{SHARD_COUNT - 1}.")
+
 # Đường dẫn đến ffmpeg trên hệ thống Ubuntu (sử dụng 'ffmpeg' từ PATH)
 FFMPEG_PATH = 'ffmpeg'  # Hoặc sử dụng '/usr/bin/ffmpeg' nếu cần thiết
 
-# Kiểm tra xem ffmpeg có tồn tại không
-if not shutil.which(FFMPEG_PATH):
-    raise FileNotFoundError(
-        f"FFmpeg executable không tìm thấy. Vui lòng đảm bảo rằng ffmpeg đã được cài đặt và thêm vào PATH."
-    )
+def check_ffmpeg():
+    """
+    Kiểm tra xem ffmpeg có tồn tại không (gọi khi khởi chạy bot, không phải khi import).
+    """
+    if not shutil.which(FFMPEG_PATH):
+        raise FileNotFoundError(
+            f"FFmpeg executable không tìm thấy. Vui lòng đảm bảo rằng ffmpeg đã được cài đặt và thêm vào PATH."
+        )
 
 # -----------------------------#
 #        Định Nghĩa Intents     #
@@ -121,16 +218,36 @@ def parse_duration(duration_iso8601):
         logger.error(f"Lỗi khi phân tích duration: {e}")
         return "Unknown"
 
-def generate_queue_list(music_queue):
+QUEUE_LIST_MAX_ITEMS = 10  # Số bài mỗi trang hàng đợi trong bảng điều khiển
+EMBED_FIELD_LIMIT = 1024   # Giới hạn ký tự của một embed field trên Discord
+
+def queue_page_count(music_queue):
+    """
+    Số trang của hàng đợi (ít nhất 1).
+    """
+    return max(1, -(-len(music_queue) // QUEUE_LIST_MAX_ITEMS))
+
+def generate_queue_list(music_queue, page=0):
     """
-    Tạo danh sách các bài hát trong hàng đợi dưới dạng chuỗi.
+    Tạo nội dung một trang hàng đợi: chỉ dựng các dòng của trang đang xem (dùng lại dòng đã dựng của từng bài)
+    và luôn nằm trong giới hạn 1024 ký tự của embed field.
     """
     if music_queue.empty():
         return "Hàng đợi trống."
-    queue_list = ""
-    for idx, song in enumerate(music_queue._queue, start=1):
-        queue_list += f"{idx}. {song['title']} - {song['duration']}\n"
-    return queue_list
+    pages = queue_page_count(music_queue)
+    start = page * QUEUE_LIST_MAX_ITEMS
+    footer = f"Trang {page + 1}/{pages} • {len(music_queue)} bài" if pages > 1 else ""
+    budget = EMBED_FIELD_LIMIT - len(footer) - 1
+    lines = []
+    for idx, song in enumerate(music_queue.peek(QUEUE_LIST_MAX_ITEMS, start), start=start + 1):
+        line = f"{idx}. {song.queue_label()}"
+        if len(line) + 1 > budget:
+            break
+        budget -= len(line) + 1
+        lines.append(line)
+    if footer:
+        lines.append(footer)
+    return "\n".join(lines)
 
 def truncate_label(text, max_length):
     """
@@ -151,289 +268,4020 @@ def is_url(query):
     """
     return re.match(URL_REGEX, query) is not None
 
-# -----------------------------#
-#        Định Nghĩa MusicPlayer#
-# -----------------------------#
+def is_playlist_url(query):
+    """
+    Kiểm tra xem URL YouTube có chứa danh sách phát (tham số list=, bao gồm cả mix RD...) không.
+    """
+    if not is_url(query):
+        return False
+    url = query if re.match(r'^https?://', query) else f"https://{query}"
+    return bool(parse_qs(urlparse(url).query).get('list'))
 
-class MusicPlayer:
+# Regex lấy ID video (11 ký tự) từ các dạng URL YouTube phổ biến
+VIDEO_ID_REGEX = re.compile(
+    r'(?:[?&]v=|/shorts/|/embed/|/live/|/v/|youtu\.be/)([A-Za-z0-9_-]{11})'
+)
+
+# Regex lấy tham số expire trong URL googlevideo (dạng ?expire=... hoặc /expire/...)
+EXPIRE_REGEX = re.compile(r'[?&/]expire[=/](\d+)')
+
+def extract_video_id(url):
     """
-    Lớp quản lý phát nhạc cho mỗi guild.
-    """    
-    def __init__(self, guild_id, text_channel):
-        self.guild_id = guild_id
-        self.voice_client = None
-        self.voice_channel = None  # Kênh thoại mà bot đang kết nối
-        self.current_song = None
-        self.is_paused = False
-        self.is_looping = False
-        self.music_queue = asyncio.Queue()
-        self.current_control_message = None
-        self.disconnect_task = None
-        self.audio_cache = TTLCache(maxsize=100, ttl=3600)  # Bộ nhớ đệm với TTL 1 giờ
-        self.text_channel = text_channel  # Kênh TextChannel để gửi thông báo
-        self.played_songs = []  # Danh sách các bài hát đã được phát
-        self.is_playing_from_cache = False  # Trạng thái đang phát từ bộ nhớ đệm
+    Lấy ID video chuẩn từ URL YouTube. Trả về None nếu không nhận diện được.
+    """
+    if not url:
+        return None
+    match = VIDEO_ID_REGEX.search(url)
+    if match:
+        return match.group(1)
+    if re.fullmatch(r'[A-Za-z0-9_-]{11}', url):
+        return url
+    return None
+
+def parse_stream_expiry(stream_url):
+    """
+    Đọc thời điểm hết hạn (epoch giây) từ tham số expire của URL luồng googlevideo.
+    """
+    if not stream_url:
+        return None
+    try:
+        values = parse_qs(urlparse(stream_url).query).get('expire')
+        if values:
+            return float(values[0])
+        match = EXPIRE_REGEX.search(stream_url)
+        if match:
+            return float(match.group(1))
+    except ValueError:
+        pass
+    return None
+
+def format_duration_seconds(duration_seconds):
+    """
+    Định dạng số giây sang HH:MM:SS hoặc MM:SS.
+    """
+    if not duration_seconds:
+        return "Unknown"
+    minutes, seconds = divmod(int(duration_seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours > 0:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
 
 # -----------------------------#
-#        Định Nghĩa YouTubeAPI  #
+#   Bộ Nhớ Đệm Luồng Dùng Chung #
 # -----------------------------#
 
-class YouTubeAPI:
+STREAM_CACHE_MAX_ENTRIES = int(os.getenv('STREAM_CACHE_MAX_ENTRIES', '5000'))
+STREAM_CACHE_MAX_BYTES = int(os.getenv('STREAM_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+STREAM_CACHE_DEFAULT_TTL = 3600     # TTL khi URL luồng không có tham số expire
+STREAM_URL_EXPIRY_MARGIN = 60       # Hết hạn sớm hơn expire một chút để kịp mở luồng
+STREAM_REFRESH_MARGIN = 600         # Lấy lại URL luồng của bài sắp phát nếu còn dưới 10 phút
+PREFETCH_LOOKAHEAD = int(os.getenv('PREFETCH_LOOKAHEAD', '2'))        # Số bài sắp phát được lấy trước
+PREFETCH_LEAD_SECONDS = int(os.getenv('PREFETCH_LEAD_SECONDS', '30'))  # Lấy trước bao lâu trước khi hết bài
+
+class StreamCache:
     """
-    Lớp quản lý các yêu cầu tới YouTube API.
+    Bộ nhớ đệm dùng chung cho toàn bot, lưu kết quả phân giải luồng theo ID video.
+    Loại bỏ theo LRU, TTL riêng cho từng mục và giới hạn tổng dung lượng bộ nhớ.
     """
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.session = None
+    def __init__(self, max_entries, max_bytes, default_ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, size, data)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
-    async def init_session(self):
+    @staticmethod
+    def _estimate_size(key, data):
+        size = sys.getsizeof(key) + sys.getsizeof(data)
+        for k, v in data.items():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+        return size
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def get(self, key):
         """
-        Khởi tạo session aiohttp.
+        Lấy mục còn hạn trong cache (bản sao), hoặc None nếu không có.
         """
-        self.session = aiohttp.ClientSession()
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, data = entry
+        if expires_at <= time.time():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return dict(data)
 
-    async def close(self):
+    def set(self, key, data):
         """
-        Đóng session aiohttp.
+        Lưu kết quả phân giải. TTL lấy theo tham số expire của URL luồng.
         """
-        if self.session:
-            await self.session.close()
+        expires_at = data.get('expires_at')
+        if expires_at:
+            expires_at -= STREAM_URL_EXPIRY_MARGIN
+        else:
+            expires_at = time.time() + self.default_ttl
+        if expires_at <= time.time():
+            return
+        if key in self._entries:
+            self._remove(key)
+        size = self._estimate_size(key, data)
+        self._entries[key] = (expires_at, size, dict(data))
+        self.current_bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
 
-    async def search_youtube(self, query, max_results=10):
+    def invalidate(self, key):
         """
-        Tìm kiếm video trên YouTube dựa trên truy vấn.
+        Xóa một mục khỏi cache (ví dụ khi URL luồng bị từ chối).
         """
-        search_url = "https://www.googleapis.com/youtube/v3/search"
-        params = {
-            'part': 'snippet',
-            'q': query,
-            'type': 'video',
-            'maxResults': max_results,
-            'key': self.api_key
+        if key in self._entries:
+            self._remove(key)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > time.time()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Trả về các chỉ số của cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
         }
-        try:
-            async with self.session.get(search_url, params=params) as resp:
-                if resp.status != 200:
-                    logger.error(f"Error in YouTube search: {resp.status}")
-                    return None
-                data = await resp.json()
-                video_ids = [item['id']['videoId'] for item in data.get('items', [])]
 
-            if not video_ids:
-                return []
+stream_cache = StreamCache(STREAM_CACHE_MAX_ENTRIES, STREAM_CACHE_MAX_BYTES, STREAM_CACHE_DEFAULT_TTL)
 
-            details_url = "https://www.googleapis.com/youtube/v3/videos"
-            details_params = {
-                'part': 'contentDetails',
-                'id': ','.join(video_ids),
-                'key': self.api_key
-            }
-            async with self.session.get(details_url, params=details_params) as details_resp:
-                if details_resp.status != 200:
-                    logger.error(f"Error in YouTube video details: {details_resp.status}")
-                    return None
-                details_data = await details_resp.json()
-                id_to_duration = {}
-                for item in details_data.get('items', []):
-                    video_id = item['id']
-                    duration_iso8601 = item['contentDetails']['duration']
-                    duration = parse_duration(duration_iso8601)
-                    id_to_duration[video_id] = duration
-
-            results = []
-            for item in data.get('items', []):
-                video_id = item['id']['videoId']
-                title = item['snippet']['title']
-                thumbnail = item['snippet']['thumbnails']['default']['url']
-                url = f"https://www.youtube.com/watch?v={video_id}"
-                duration = id_to_duration.get(video_id, "Unknown")
-                results.append({
-                    'title': title,
-                    'url': url,
-                    'thumbnail': thumbnail,
-                    'duration': duration
-                })
-            return results
-        except Exception as e:
-            logger.error(f"Lỗi khi tìm kiếm YouTube: {e}")
-            return None
+class SingleFlight:
+    """
+    Bảng các yêu cầu đang xử lý: các lời gọi đồng thời cùng khóa chờ chung một tác vụ.
+    """
+    def __init__(self):
+        self._inflight = {}  # key -> asyncio.Task
+        self.leaders = 0
+        self.followers = 0
+
+    async def run(self, key, coro_factory):
+        """
+        Chạy coro_factory() cho khóa key, hoặc chờ tác vụ đang chạy với cùng khóa.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(coro_factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.followers += 1
+            logger.info(f"Đang chờ kết quả trích xuất đang chạy cho {key}.")
+        # shield để một người gọi bị hủy không hủy tác vụ dùng chung của những người khác
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._inflight)
+
+inflight_resolutions = SingleFlight()
 
 # -----------------------------#
-#        Định Nghĩa Bot         #
+#      Trích Xuất Bằng yt-dlp   #
 # -----------------------------#
 
-class MyBot(commands.Bot):
+YDL_BASE_OPTIONS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'noplaylist': True,
+    'default_search': 'auto',
+    'nocheckcertificate': True,
+    'no_warnings': True,
+    'ignoreerrors': True,
+    'restrictfilenames': True,
+    'skip_download': True,
+    'cachedir': False,
+    'extractor_args': {
+        'youtube': {
+            'skip': ['hls', 'dash'],
+            'player_skip': ['configs', 'webpage'],
+        }
+    },
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Language': 'en-us,en;q=0.5',
+        'Accept-Encoding': 'gzip,deflate',
+        'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
+        'Connection': 'close'
+    }
+}
+
+if PROXY_URL:
+    YDL_BASE_OPTIONS['proxy'] = PROXY_URL
+
+# Thêm hỗ trợ cookies nếu có
+if COOKIES_PATH:
+    YDL_BASE_OPTIONS['cookiefile'] = COOKIES_PATH
+
+# Thử nhiều lần với các cấu hình khác nhau
+YDL_RETRY_PROFILES = [
+    {},  # Cấu hình mặc định
+    {'extractor_args': {'youtube': {'skip': ['dash']}}},  # Bỏ qua DASH
+    {'format': 'worst'},  # Chất lượng thấp nhất
+]
+
+class YoutubeDLPool:
     """
-    Lớp Bot kế thừa từ commands.Bot để quản lý các chức năng bot.
+    Kho các đối tượng YoutubeDL đã khởi tạo sẵn, mỗi cấu hình thử lại một kho riêng.
+    Mỗi đối tượng chỉ được một thread dùng tại một thời điểm, dùng xong trả lại kho.
     """
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.youtube_api = YouTubeAPI(YOUTUBE_API_KEY)
-        self.music_players = {}  # Dictionary để quản lý MusicPlayer cho từng guild
+    def __init__(self, base_options, profiles, size, factory=None):
+        self.base_options = base_options
+        self.profiles = profiles
+        self.size = max(1, size)
+        self.factory = factory or yt_dlp.YoutubeDL
+        self._idle = [queue.LifoQueue() for _ in profiles]
+        self._created = [0] * len(profiles)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
 
-    async def setup_hook(self):
+    def _create(self, profile_index):
+        return self.factory({**self.base_options, **self.profiles[profile_index]})
+
+    def warm(self):
         """
-        Hook để khởi tạo các tài nguyên cần thiết khi bot đã sẵn sàng.
+        Khởi tạo trước một đối tượng cho mỗi cấu hình.
         """
-        await self.youtube_api.init_session()
+        for profile_index in range(len(self.profiles)):
+            with self._lock:
+                if self._created[profile_index]:
+                    continue
+                self._created[profile_index] += 1
+                self.created += 1
+            self._idle[profile_index].put(self._create(profile_index))
 
-    async def close(self):
+    @contextlib.contextmanager
+    def acquire(self, profile_index):
         """
-        Đóng các tài nguyên khi bot tắt.
+        Mượn một đối tượng YoutubeDL cho cấu hình profile_index.
         """
-        await self.youtube_api.close()
-        await super().close()
+        idle = self._idle[profile_index]
+        try:
+            ydl = idle.get_nowait()
+            self.reused += 1
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created[profile_index] < self.size
+                if can_create:
+                    self._created[profile_index] += 1
+                    self.created += 1
+            if can_create:
+                ydl = self._create(profile_index)
+            else:
+                # Đã đủ số đối tượng: chờ một thread khác trả lại
+                ydl = idle.get()
+                self.reused += 1
+        try:
+            yield ydl
+        finally:
+            idle.put(ydl)
 
-# Instantiate the bot after defining classes
-bot = MyBot(command_prefix='!', intents=intents)
+    def close(self):
+        """
+        Đóng tất cả đối tượng đang rảnh.
+        """
+        for idle in self._idle:
+            while True:
+                try:
+                    ydl = idle.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    ydl.close()
+                except Exception as e:
+                    logger.warning(f"Lỗi khi đóng YoutubeDL: {e}")
 
-# Helper function to get or create MusicPlayer for a guild
-def get_music_player(guild_id, text_channel):
+_ydl_pool = None
+_ydl_pool_pid = None
+
+def get_ydl_pool():
     """
-    Lấy hoặc tạo MusicPlayer cho một guild cụ thể.
+    Lấy kho YoutubeDL của tiến trình hiện tại (tạo lại sau khi fork sang tiến trình worker).
     """
-    if guild_id not in bot.music_players:
-        bot.music_players[guild_id] = MusicPlayer(guild_id, text_channel)
-    return bot.music_players[guild_id]
-
-# -----------------------------#
-#    Định Nghĩa Các Lớp UI      #
-# -----------------------------#
+    global _ydl_pool, _ydl_pool_pid
+    if _ydl_pool is None or _ydl_pool_pid != os.getpid():
+        _ydl_pool = YoutubeDLPool(YDL_BASE_OPTIONS, YDL_RETRY_PROFILES, EXTRACTION_WORKERS)
+        _ydl_pool_pid = os.getpid()
+    return _ydl_pool
 
-class MusicControlView(View):
+def warm_ydl_pool():
     """
-    Lớp View để quản lý các nút điều khiển nhạc (Pause, Resume, Skip, Loop).
+    Khởi tạo trước kho YoutubeDL (chạy trong thread/tiến trình worker).
     """
-    def __init__(self, music_player):
-        super().__init__(timeout=None)
-        self.music_player = music_player
+    try:
+        get_ydl_pool().warm()
+    except Exception as e:
+        logger.warning(f"Không thể khởi tạo trước YoutubeDL: {e}")
 
-    @discord.ui.button(label="Tạm Dừng", style=discord.ButtonStyle.primary, emoji="⏸️")
-    async def pause(self, interaction: discord.Interaction, button: Button):
+def extract_stream_info(url, guild_id=None):
+    """
+    Hàm đồng bộ chạy trong worker: trích xuất thông tin luồng âm thanh với các cấu hình thử lại.
+    Chỉ trả về các trường cần thiết (dict đơn giản) để có thể gửi qua ranh giới tiến trình.
+    """
+    pool = get_ydl_pool()
+    for attempt in range(1, len(YDL_RETRY_PROFILES) + 1):
         try:
-            if self.music_player.voice_client and self.music_player.voice_client.is_playing():
-                self.music_player.voice_client.pause()
-                self.music_player.is_paused = True
-                await interaction.response.send_message("⏸️ Nhạc đã tạm dừng!", ephemeral=True)
-                await send_control_panel(self.music_player)
-            else:
-                await interaction.response.send_message("❗ Không có nhạc nào đang phát.", ephemeral=True)
-        except Exception as e:
-            logger.error(f"Lỗi trong nút Tạm Dừng: {e}")
-            await interaction.response.send_message("❗ Đã xảy ra lỗi khi tạm dừng nhạc.", ephemeral=True)
+            logger.info(f"Thử lấy URL âm thanh lần {attempt} cho guild {guild_id}")
 
-    @discord.ui.button(label="Tiếp Tục", style=discord.ButtonStyle.success, emoji="▶️")
-    async def resume(self, interaction: discord.Interaction, button: Button):
-        try:
-            if self.music_player.voice_client and self.music_player.is_paused:
-                self.music_player.voice_client.resume()
-                self.music_player.is_paused = False
-                await interaction.response.send_message("▶️ Nhạc đã tiếp tục!", ephemeral=True)
-                await send_control_panel(self.music_player)
-            else:
-                await interaction.response.send_message("❗ Không có nhạc nào đang tạm dừng.", ephemeral=True)
-        except Exception as e:
-            logger.error(f"Lỗi trong nút Tiếp Tục: {e}")
-            await interaction.response.send_message("❗ Đã xảy ra lỗi khi tiếp tục nhạc.", ephemeral=True)
+            with pool.acquire(attempt - 1) as ydl:
+                info = ydl.extract_info(url, download=False)
+            if info is None:
+                logger.warning(f"yt_dlp trả về None cho thông tin video tại {url} (lần thử {attempt}).")
+                continue
 
-    @discord.ui.button(label="Bỏ Qua", style=discord.ButtonStyle.danger, emoji="⏭️")
-    async def skip(self, interaction: discord.Interaction, button: Button):
-        try:
-            if self.music_player.voice_client and self.music_player.voice_client.is_playing():
-                self.music_player.voice_client.stop()
-                await interaction.response.send_message("⏭️ Đã bỏ qua bài hát!", ephemeral=True)
-            else:
-                await interaction.response.send_message("❗ Không có nhạc nào đang phát.", ephemeral=True)
-        except Exception as e:
-            logger.error(f"Lỗi trong nút Bỏ Qua: {e}")
-            await interaction.response.send_message("❗ Đã xảy ra lỗi khi bỏ qua nhạc.", ephemeral=True)
+            # Lấy luồng âm thanh trực tiếp
+            audio_url = info.get('url')
+            if not audio_url:
+                logger.warning(f"Không tìm thấy URL âm thanh trong lần thử {attempt}")
+                continue
 
-    @discord.ui.button(label="Lặp Bài Hát", style=discord.ButtonStyle.secondary, emoji="🔁")
-    async def loop(self, interaction: discord.Interaction, button: Button):
-        try:
-            self.music_player.is_looping = not self.music_player.is_looping
-            state = "bật" if self.music_player.is_looping else "tắt"
-            await interaction.response.send_message(f"🔁 Lặp bài hát đã {state}!", ephemeral=True)
-            await send_control_panel(self.music_player)
+            logger.info(f"Thành công lấy URL âm thanh cho guild {guild_id} ở lần thử {attempt}")
+            return {
+                'url': audio_url,
+                'title': info.get('title', 'URL Provided'),
+                'thumbnail': info.get('thumbnail'),
+                'duration': info.get('duration'),
+                'id': info.get('id'),
+                'webpage_url': info.get('webpage_url'),
+                'format_id': info.get('format_id'),
+                'acodec': info.get('acodec'),
+                'abr': info.get('abr'),
+                'ext': info.get('ext'),
+                'attempt': attempt,
+            }
         except Exception as e:
-            logger.error(f"Lỗi trong nút Lặp Bài Hát: {e}")
-            await interaction.response.send_message("❗ Đã xảy ra lỗi khi thay đổi chế độ lặp.", ephemeral=True)
+            logger.warning(f"Lần thử {attempt} thất bại: {e}")
+            if attempt == len(YDL_RETRY_PROFILES):
+                logger.error(f"Tất cả các lần thử đều thất bại cho URL {url}")
+            continue
 
-class SongSelect(Select):
+    # Nếu tất cả các lần thử đều thất bại
+    logger.error(f"Không thể lấy audio stream URL tại {url} sau {len(YDL_RETRY_PROFILES)} lần thử")
+    return None
+
+def search_with_ytdlp(query, max_results=10):
     """
-    Lớp Select để người dùng chọn bài hát từ kết quả tìm kiếm.
+    Hàm đồng bộ chạy trong worker: tìm kiếm bằng ytsearch của yt-dlp (không tốn quota YouTube API).
     """
-    def __init__(self, music_player, songs, user_voice_channel):
-        options = [
-            discord.SelectOption(
-                label=truncate_label(f"{idx + 1}. {song['title']} - {song['duration']}", 100),
-                value=str(idx)
-            ) for idx, song in enumerate(songs)
-        ]
-        super().__init__(
-            placeholder="Chọn bài hát bạn muốn phát...",
-            min_values=1,
-            max_values=1,
-            options=options
-        )
-        self.music_player = music_player
-        self.songs = songs
-        self.user_voice_channel = user_voice_channel
+    opts = {**YDL_BASE_OPTIONS, 'extract_flat': 'in_playlist', 'noplaylist': False}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(f"ytsearch{max_results}:{query}", download=False)
+    if info is None:
+        return None
+    results = []
+    for entry in info.get('entries') or []:
+        if not entry or not entry.get('id'):
+            continue
+        thumbnails = entry.get('thumbnails') or []
+        results.append({
+            'title': entry.get('title') or entry['id'],
+            'url': f"https://www.youtube.com/watch?v={entry['id']}",
+            'thumbnail': thumbnails[0].get('url') if thumbnails else None,
+            'duration': format_duration_seconds(entry.get('duration'))
+        })
+    return results
 
-    async def callback(self, interaction: discord.Interaction):
-        try:
-            selected_index = int(self.values[0])
-            selected_song = self.songs[selected_index]
-            await interaction.response.defer()
-            await interaction.message.delete()
-            await process_song_selection_from_selection(self.music_player, selected_song, self.user_voice_channel)
-        except Exception as e:
-            logger.error(f"Lỗi trong SongSelect callback: {e}")
-            await interaction.response.send_message("❗ Đã xảy ra lỗi khi chọn bài hát.", ephemeral=True)
+PLAYLIST_MAX_TRACKS = int(os.getenv('PLAYLIST_MAX_TRACKS', '500'))  # Số bài tối đa lấy từ một danh sách phát
+PLAYLIST_WATCH_MAX_TRACKS = int(os.getenv('PLAYLIST_WATCH_MAX_TRACKS', '25'))  # Giới hạn khi gửi link video kèm list=
+PLAYLIST_HEAD_TRACKS = 5      # Số bài lấy trước (trang đầu) để phát ngay khi gửi link danh sách phát
+PLAYLIST_LEAD_ATTEMPTS = 3    # Số bài đầu danh sách thử phát trước khi bỏ cuộc
 
-class SongSelectionView(View):
+def extract_playlist_entries(url, max_tracks=PLAYLIST_MAX_TRACKS):
     """
-    Lớp View chứa Select để chọn bài hát.
+    Hàm đồng bộ chạy trong worker: lấy danh sách bài (chỉ ID, tiêu đề, thời lượng) của playlist/mix
+    bằng extract_flat, không phân giải URL luồng của từng bài.
     """
-    def __init__(self, music_player, songs, user_voice_channel):
-        super().__init__(timeout=60)
-        self.music_player = music_player
-        self.songs = songs
-        self.user_voice_channel = user_voice_channel
-        self.add_item(SongSelect(music_player, songs, user_voice_channel))
-
-    async def on_timeout(self):
-        try:
-            await self.message.edit(content="⏰ Thời gian chọn bài hát đã hết.", view=None)
-        except Exception as e:
-            logger.error(f"Lỗi khi timeout SongSelectionView: {e}")
-
-    async def send(self, message):
-        self.message = await message.edit(view=self)
+    opts = {**YDL_BASE_OPTIONS, 'extract_flat': 'in_playlist', 'noplaylist': False, 'playlistend': max_tracks}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if info is None:
+        return None
+    entries = []
+    for entry in itertools.islice(info.get('entries') or [], max_tracks):
+        if not entry or not entry.get('id'):
+            continue
+        entries.append({
+            'id': entry['id'],
+            'title': entry.get('title') or entry['id'],
+            'duration': entry.get('duration'),
+        })
+    return {'title': info.get('title') or "Danh sách phát", 'entries': entries}
 
 # -----------------------------#
-#      Định Nghĩa Các Hàm       #
+#   Bộ Lập Lịch Trích Xuất      #
 # -----------------------------#
 
-async def send_control_panel(music_player):
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', '4'))
+EXTRACTION_MODE = os.getenv('EXTRACTION_MODE', 'thread').lower()   # 'thread' hoặc 'process'
+EXTRACTION_MAX_QUEUE = int(os.getenv('EXTRACTION_MAX_QUEUE', '100'))
+
+EXTRACTION_BUSY_MESSAGE = "⏳ Bot đang xử lý quá nhiều yêu cầu, vui lòng thử lại sau ít phút."
+
+class ExtractionQueueFull(Exception):
     """
-    Gửi hoặc cập nhật bảng điều khiển nhạc (embed và view).
-    """    
-    channel = music_player.text_channel
-    # Xóa bảng điều khiển cũ (nếu có)
-    if music_player.current_control_message:
-        try:
-            await music_player.current_control_message.delete()
-        except discord.NotFound:
-            pass
-        music_player.current_control_message = None
-    if music_player.current_song:
-        if music_player.is_playing_from_cache:
-            status_message = f"🎵 Phát từ bộ nhớ: **{music_player.current_song['title']}** ({music_player.current_song['duration']})"
-        else:
-            status_message = f"🎵 Đang phát: **{music_player.current_song['title']}** ({music_player.current_song['duration']})"
-    else:
-        status_message = "🎵 Không có bài hát nào đang được phát."
+    Hàng đợi trích xuất đã đầy, yêu cầu mới bị từ chối.
+    """
+
+def init_extraction_process(initializer=None):
+    """
+    Khởi tạo tiến trình worker trích xuất: ghi log trực tiếp rồi chạy initializer của bộ lập lịch.
+    """
+    configure_process_logging()
+    if initializer:
+        initializer()
+
+class ExtractionScheduler:
+    """
+    Bộ lập lịch trích xuất yt-dlp với số worker cố định, hàng đợi giới hạn
+    và luân phiên (round-robin) giữa các guild để không guild nào chiếm hết worker.
+    """
+    def __init__(self, workers, mode, max_queue, initializer=None):
+        self.workers = max(1, workers)
+        self.initializer = initializer
+        self.mode = mode if mode in ('thread', 'process') else 'thread'
+        self.max_queue = max_queue
+        self._queues = OrderedDict()  # guild_id -> deque các job đang chờ
+        self._pending = 0
+        self._wakeup = None
+        self._executor = None
+        self._worker_tasks = []
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.max_service = 0.0
+
+    def start(self):
+        """
+        Khởi tạo executor và các worker (gọi trong event loop).
+        """
+        if self._worker_tasks:
+            return
+        if self.mode == 'process':
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, initializer=init_extraction_process, initargs=(self.initializer,)
+            )
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='extract'
+            )
+            if self.initializer:
+                self._executor.submit(self.initializer)
+        self._wakeup = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Bộ lập lịch trích xuất: {self.workers} worker ({self.mode}), hàng đợi tối đa {self.max_queue}.")
+
+    async def close(self):
+        """
+        Dừng các worker và giải phóng executor.
+        """
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks = []
+        for jobs in self._queues.values():
+            for job in jobs:
+                if not job[2].done():
+                    job[2].cancel()
+        self._queues.clear()
+        self._pending = 0
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def submit(self, guild_id, func, *args):
+        """
+        Đưa một hàm đồng bộ vào hàng đợi của guild và chờ kết quả.
+        """
+        if not self._worker_tasks:
+            self.start()
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            raise ExtractionQueueFull(f"Hàng đợi trích xuất đã đầy ({self._pending} yêu cầu).")
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(guild_id, deque()).append((func, args, future, time.monotonic()))
+        self._pending += 1
+        self._wakeup.set()
+        return await future
+
+    def _next_job(self):
+        # Lấy job đầu tiên của guild kế tiếp, sau đó đưa guild xuống cuối vòng
+        guild_id, jobs = self._queues.popitem(last=False)
+        job = jobs.popleft()
+        if jobs:
+            self._queues[guild_id] = jobs
+        self._pending -= 1
+        return job
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._queues:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            func, args, future, enqueued_at = self._next_job()
+            if future.cancelled():
+                continue
+            started_at = time.monotonic()
+            wait_time = started_at - enqueued_at
+            self.total_wait += wait_time
+            self.max_wait = max(self.max_wait, wait_time)
+            self.busy += 1
+            try:
+                result = await loop.run_in_executor(self._executor, func, *args)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.busy -= 1
+                service_time = time.monotonic() - started_at
+                self.total_service += service_time
+                self.max_service = max(self.max_service, service_time)
+
+    def queue_depth(self):
+        """
+        Số yêu cầu đang chờ theo từng guild.
+        """
+        return {guild_id: len(jobs) for guild_id, jobs in self._queues.items()}
+
+    def stats(self):
+        """
+        Trả về các chỉ số của bộ lập lịch.
+        """
+        finished = self.completed + self.failed
+        return {
+            'mode': self.mode,
+            'workers': self.workers,
+            'busy': self.busy,
+            'queue_depth': self._pending,
+            'queued_guilds': len(self._queues),
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'avg_wait': self.total_wait / finished if finished else 0.0,
+            'max_wait': self.max_wait,
+            'avg_service': self.total_service / finished if finished else 0.0,
+            'max_service': self.max_service,
+        }
+
+extraction_scheduler = ExtractionScheduler(
+    EXTRACTION_WORKERS, EXTRACTION_MODE, EXTRACTION_MAX_QUEUE, initializer=warm_ydl_pool
+)
+
+# -----------------------------#
+#   Lưu Trữ Kết Quả Phân Giải   #
+# -----------------------------#
+
+# File SQLite lưu kết quả phân giải qua các lần khởi động lại (đặt rỗng để tắt)
+RESOLUTION_DB_PATH = os.getenv('RESOLUTION_DB_PATH', os.path.join(current_dir, 'data', 'resolutions.db'))
+RESOLUTION_WARM_LIMIT = 500     # Số bài gần đây nhất được nạp sẵn vào stream_cache khi khởi động
+RESOLUTION_RETENTION = 30 * 86400  # Xóa các bài không được dùng trong 30 ngày
+RESOLUTION_TOUCH_BATCH = 50     # Gom các lần đọc rồi cập nhật last_used một lần
+
+class ResolutionStore:
+    """
+    Lưu metadata phân giải (tiêu đề, ảnh, thời lượng, định dạng, URL luồng và hạn dùng)
+    vào SQLite ở chế độ WAL. Dữ liệu được đọc dần theo nhu cầu thay vì nạp toàn bộ khi khởi động.
+    Thời hạn giữ và thứ tự nạp sẵn dựa trên last_used (lần đọc/ghi gần nhất, cập nhật theo lô).
+    """
+    COLUMNS = ('video_id', 'title', 'thumbnail', 'duration', 'duration_seconds', 'webpage_url',
+               'format_id', 'acodec', 'abr', 'ext', 'stream_url', 'expires_at', 'updated_at', 'last_used')
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._touched = {}  # video_id -> thời điểm đọc, chưa ghi xuống đĩa
+
+    def open(self):
+        """
+        Mở (hoặc tạo) cơ sở dữ liệu và dọn các mục quá cũ (chạy trong thread).
+        """
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._lock:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS resolutions (
+                    video_id TEXT PRIMARY KEY,
+                    title TEXT,
+                    thumbnail TEXT,
+                    duration TEXT,
+                    duration_seconds REAL,
+                    webpage_url TEXT,
+                    format_id TEXT,
+                    acodec TEXT,
+                    abr REAL,
+                    ext TEXT,
+                    stream_url TEXT,
+                    expires_at REAL,
+                    updated_at REAL,
+                    last_used REAL
+                )
+            """)
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(resolutions)')}
+            if 'last_used' not in columns:
+                # Cơ sở dữ liệu từ phiên bản cũ: thêm cột và lấy tạm thời điểm ghi
+                self._conn.execute('ALTER TABLE resolutions ADD COLUMN last_used REAL')
+                self._conn.execute('UPDATE resolutions SET last_used = updated_at')
+            self._conn.execute('DROP INDEX IF EXISTS idx_resolutions_updated')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_resolutions_last_used ON resolutions(last_used)')
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS loudness (
+                    video_id TEXT PRIMARY KEY,
+                    integrated REAL,
+                    true_peak REAL,
+                    lra REAL,
+                    analyzed_at REAL
+                )
+            """)
+            deleted = self._conn.execute(
+                'DELETE FROM resolutions WHERE last_used < ?', (time.time() - RESOLUTION_RETENTION,)
+            ).rowcount
+            self._conn.commit()
+        logger.info(f"Đã mở kho dữ liệu phân giải {self.path} (xóa {deleted} mục cũ).")
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._flush_touched()
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+
+    def _flush_touched(self):
+        # Gọi khi đang giữ self._lock; người gọi tự commit
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE resolutions SET last_used = ? WHERE video_id = ?',
+                [(used_at, video_id) for video_id, used_at in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _row_to_audio_data(self, row):
+        record = dict(zip(self.COLUMNS, row))
+        return {
+            "url": record['stream_url'],
+            "title": record['title'],
+            "thumbnail": record['thumbnail'],
+            "duration": record['duration'],
+            "duration_seconds": record['duration_seconds'],
+            "video_id": record['video_id'],
+            "webpage_url": record['webpage_url'],
+            "expires_at": record['expires_at'],
+        }
+
+    def get(self, video_id):
+        """
+        Lấy kết quả phân giải đã lưu của một video, hoặc None. Lần đọc được ghi nhận vào last_used theo lô.
+        """
+        with self._lock:
+            if not self._conn:
+                return None
+            row = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM resolutions WHERE video_id = ?", (video_id,)
+            ).fetchone()
+            if row is not None:
+                self._touched[video_id] = time.time()
+                if len(self._touched) >= RESOLUTION_TOUCH_BATCH:
+                    self._flush_touched()
+                    self._conn.commit()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._row_to_audio_data(row)
+
+    def put(self, video_id, audio_data, info=None):
+        """
+        Ghi (hoặc cập nhật) kết quả phân giải của một video.
+        """
+        info = info or {}
+        now = time.time()
+        values = (
+            video_id, audio_data['title'], audio_data['thumbnail'], audio_data['duration'],
+            audio_data.get('duration_seconds'), audio_data.get('webpage_url'),
+            info.get('format_id'), info.get('acodec'), info.get('abr'), info.get('ext'),
+            audio_data['url'], audio_data.get('expires_at'), now, now,
+        )
+        with self._lock:
+            if not self._conn:
+                return
+            self._touched.pop(video_id, None)
+            self._flush_touched()
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO resolutions ({', '.join(self.COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                values
+            )
+            self._conn.commit()
+        self.writes += 1
+
+    def get_loudness(self, video_id):
+        """
+        Lấy kết quả phân tích độ lớn (integrated LUFS, true peak dBTP) đã lưu của một video, hoặc None.
+        """
+        with self._lock:
+            if not self._conn:
+                return None
+            row = self._conn.execute(
+                'SELECT integrated, true_peak FROM loudness WHERE video_id = ?', (video_id,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def put_loudness(self, video_id, integrated, true_peak, lra):
+        with self._lock:
+            if not self._conn:
+                return
+            self._conn.execute(
+                'INSERT OR REPLACE INTO loudness (video_id, integrated, true_peak, lra, analyzed_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (video_id, integrated, true_peak, lra, time.time())
+            )
+            self._conn.commit()
+
+    def load_recent(self, limit):
+        """
+        Lấy các kết quả gần đây nhất có URL luồng còn hạn (để nạp sẵn vào stream_cache).
+        """
+        with self._lock:
+            if not self._conn:
+                return []
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM resolutions WHERE expires_at > ? "
+                f"ORDER BY last_used DESC LIMIT ?",
+                (time.time() + STREAM_URL_EXPIRY_MARGIN, limit)
+            ).fetchall()
+        return [self._row_to_audio_data(row) for row in rows]
+
+    def stats(self):
+        """
+        Trả về các chỉ số của kho dữ liệu phân giải.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'writes': self.writes}
+
+resolution_store = ResolutionStore(RESOLUTION_DB_PATH) if RESOLUTION_DB_PATH else None
+
+async def warm_stream_cache():
+    """
+    Mở kho dữ liệu phân giải rồi nạp dần các bài gần đây còn hạn vào stream_cache trong nền.
+    """
+    try:
+        await asyncio.to_thread(resolution_store.open)
+        recent = await asyncio.to_thread(resolution_store.load_recent, RESOLUTION_WARM_LIMIT)
+        # Nạp từ cũ đến mới để các bài mới nhất nằm cuối LRU
+        for audio_data in reversed(recent):
+            if audio_data['video_id'] not in stream_cache:
+                stream_cache.set(audio_data['video_id'], audio_data)
+        logger.info(f"Đã nạp sẵn {len(recent)} kết quả phân giải vào bộ nhớ đệm.")
+    except Exception as e:
+        logger.error(f"Lỗi khi nạp kho dữ liệu phân giải: {e}")
+
+# -----------------------------#
+#  Bộ Nhớ Đệm Âm Thanh Trên Đĩa #
+# -----------------------------#
+
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR')  # Bỏ trống để tắt bộ nhớ đệm trên đĩa
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv('AUDIO_CACHE_MIN_PLAYS', '2'))  # Chỉ lưu bài đã phát ít nhất N lần
+AUDIO_CACHE_MAX_DURATION = 1200     # Không lưu bài dài hơn 20 phút
+AUDIO_CACHE_MAX_DOWNLOADS = 2       # Số bài được tải về đĩa cùng lúc
+AUDIO_CACHE_FLUSH_DELAY = 30        # Ghi lại chỉ mục sau N giây khi thứ tự LRU thay đổi
+
+class DiskAudioCache:
+    """
+    Kho âm thanh Opus trên đĩa, đặt tên file theo mã băm nội dung (sha256).
+    Giới hạn tổng dung lượng, loại bỏ theo LRU và lưu chỉ mục ra file để dùng lại sau khi khởi động lại.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_path = os.path.join(directory, 'index.json')
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()  # video_id -> {'digest', 'size', 'last_access'}, cũ nhất ở đầu
+        self._play_counts = TTLCache(maxsize=10000, ttl=86400)
+        self._downloading = set()
+        self._download_slots = None
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._dirty = False
+        self._flush_handle = None
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.opus")
+
+    def load(self):
+        """
+        Đọc chỉ mục từ đĩa, bỏ các mục không còn file (chạy trong thread).
+        """
+        os.makedirs(self.objects_dir, exist_ok=True)
+        # Xóa các file tải dở từ lần chạy trước
+        for name in os.listdir(self.directory):
+            if name.endswith('.part'):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, name))
+        entries = {}
+        if os.path.isfile(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Không đọc được chỉ mục bộ nhớ đệm âm thanh: {e}")
+        sizes = {}
+        for video_id, entry in sorted(entries.items(), key=lambda item: item[1].get('last_access', 0)):
+            path = self._object_path(entry['digest'])
+            if not os.path.isfile(path):
+                continue
+            self._index[video_id] = entry
+            sizes[entry['digest']] = entry['size']
+        self.total_bytes = sum(sizes.values())
+        logger.info(f"Bộ nhớ đệm âm thanh trên đĩa: {len(self._index)} bài, {self.total_bytes / 1024 ** 2:.1f} MiB.")
+
+    def snapshot(self):
+        """
+        Tuần tự hóa chỉ mục thành JSON (gọi trên event loop, nơi duy nhất sửa chỉ mục).
+        """
+        self._dirty = False
+        return json.dumps(self._index)
+
+    def write_index(self, data):
+        """
+        Ghi bản chụp chỉ mục ra đĩa (ghi file tạm rồi đổi tên để tránh hỏng file; chạy trong thread).
+        """
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.index_path)
+
+    def _mark_dirty(self):
+        # Hẹn ghi lại chỉ mục để giữ thứ tự LRU sau khi khởi động lại, gộp nhiều lần truy cập vào một lần ghi
+        self._dirty = True
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._flush_handle = loop.call_later(AUDIO_CACHE_FLUSH_DELAY, lambda: asyncio.create_task(self.flush()))
+
+    async def flush(self):
+        """
+        Ghi chỉ mục ra đĩa nếu có thay đổi chưa được lưu.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        try:
+            await asyncio.to_thread(self.write_index, self.snapshot())
+        except OSError as e:
+            self._dirty = True
+            logger.warning(f"Không ghi được chỉ mục bộ nhớ đệm âm thanh: {e}")
+
+    def lookup(self, video_id):
+        """
+        Trả về đường dẫn file âm thanh nếu bài đã có trên đĩa.
+        """
+        entry = self._index.get(video_id) if video_id else None
+        if entry is None:
+            self.misses += 1
+            return None
+        path = self._object_path(entry['digest'])
+        if not os.path.isfile(path):
+            self._forget(video_id)
+            self._mark_dirty()
+            self.misses += 1
+            return None
+        entry['last_access'] = time.time()
+        self._index.move_to_end(video_id)
+        self._mark_dirty()
+        self.hits += 1
+        return path
+
+    def peek(self, video_id):
+        """
+        Như lookup() nhưng không tính hit/miss và không đổi thứ tự LRU (dùng cho tác vụ nền).
+        """
+        entry = self._index.get(video_id) if video_id else None
+        if entry is None:
+            return None
+        path = self._object_path(entry['digest'])
+        return path if os.path.isfile(path) else None
+
+    def contains(self, video_id):
+        """
+        Bài đã có trên đĩa hay chưa, không ảnh hưởng thống kê và thứ tự LRU.
+        """
+        return self.peek(video_id) is not None
+
+    def __contains__(self, video_id):
+        return video_id in self._index
+
+    def _digest_in_use(self, digest):
+        return any(entry['digest'] == digest for entry in self._index.values())
+
+    def _forget(self, video_id):
+        entry = self._index.pop(video_id)
+        if not self._digest_in_use(entry['digest']):
+            self.total_bytes -= entry['size']
+            return entry['digest']
+        return None
+
+    def _evict(self):
+        removed = []
+        while self._index and self.total_bytes > self.max_bytes:
+            video_id = next(iter(self._index))
+            digest = self._forget(video_id)
+            self.evictions += 1
+            if digest:
+                removed.append(self._object_path(digest))
+        return removed
+
+    def note_play(self, song):
+        """
+        Đếm số lần phát; tải bài về đĩa trong nền khi bài đủ phổ biến.
+        """
+        video_id = song.video_id
+        if not video_id or video_id in self._index or video_id in self._downloading:
+            return
+        duration = song.duration_seconds
+        if not duration or duration > AUDIO_CACHE_MAX_DURATION or not song.url:
+            return
+        plays = self._play_counts.get(video_id, 0) + 1
+        self._play_counts[video_id] = plays
+        if plays >= AUDIO_CACHE_MIN_PLAYS:
+            self._downloading.add(video_id)
+            asyncio.create_task(self.store(video_id, song.url))
+
+    async def store(self, video_id, stream_url):
+        """
+        Tải âm thanh từ URL luồng về đĩa bằng FFmpeg (ưu tiên stream copy).
+        """
+        if self._download_slots is None:
+            self._download_slots = asyncio.Semaphore(AUDIO_CACHE_MAX_DOWNLOADS)
+        tmp_path = os.path.join(self.directory, f"{video_id}.part")
+        try:
+            async with self._download_slots:
+                ok = await self._download(stream_url, tmp_path, ['-c:a', 'copy'])
+                if not ok:
+                    # Luồng không phải Opus: chuyển mã một lần duy nhất
+                    ok = await self._download(stream_url, tmp_path, ['-c:a', 'libopus', '-b:a', '128k'])
+            if not ok:
+                logger.warning(f"Không thể lưu âm thanh {video_id} vào bộ nhớ đệm trên đĩa.")
+                return
+            digest, size, is_new = await asyncio.to_thread(self._commit_file, tmp_path)
+            if is_new:
+                self.total_bytes += size
+            self._index[video_id] = {'digest': digest, 'size': size, 'last_access': time.time()}
+            self.stores += 1
+            removed = self._evict()
+            await asyncio.to_thread(self._finish_store, removed, self.snapshot())
+            logger.info(f"Đã lưu {video_id} vào bộ nhớ đệm trên đĩa ({size / 1024:.0f} KiB).")
+        except Exception as e:
+            logger.error(f"Lỗi khi lưu {video_id} vào bộ nhớ đệm trên đĩa: {e}")
+        finally:
+            self._downloading.discard(video_id)
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+
+    async def _download(self, stream_url, tmp_path, codec_args):
+        args = [FFMPEG_PATH, '-nostdin', '-loglevel', 'error', '-y',
+                '-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+        if PROXY_URL:
+            args += ['-http_proxy', PROXY_URL]
+        args += ['-i', stream_url, '-vn', '-map_metadata', '-1', *codec_args, '-f', 'opus', tmp_path]
+        process = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            logger.warning(f"FFmpeg lỗi khi tải âm thanh: {stderr.decode(errors='ignore').strip()[-300:]}")
+            return False
+        return True
+
+    def _commit_file(self, tmp_path):
+        # Băm nội dung rồi chuyển file vào thư mục objects (bỏ qua nếu nội dung đã tồn tại)
+        sha256 = hashlib.sha256()
+        with open(tmp_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        size = os.path.getsize(tmp_path)
+        path = self._object_path(digest)
+        if os.path.isfile(path):
+            os.remove(tmp_path)
+            return digest, size, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return digest, size, True
+
+    def _finish_store(self, removed, data):
+        for path in removed:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        self.write_index(data)
+
+    def stats(self):
+        """
+        Trả về các chỉ số của bộ nhớ đệm trên đĩa.
+        """
+        return {
+            'entries': len(self._index),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'downloading': len(self._downloading),
+        }
+
+disk_audio_cache = DiskAudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES) if AUDIO_CACHE_DIR else None
+
+# -----------------------------#
+#      Hàng Đợi Bài Hát         #
+# -----------------------------#
+
+class Track:
+    """
+    Một bài hát trong hàng đợi. Dùng __slots__ để hàng đợi hàng nghìn bài vẫn nhỏ gọn.
+    url là URL luồng âm thanh (None nếu chưa phân giải, ví dụ bài từ danh sách phát).
+    """
+    __slots__ = ('url', 'title', 'thumbnail', 'duration', 'duration_seconds',
+                 'webpage_url', 'video_id', 'expires_at', 'requested_at', '_label')
+
+    def __init__(self, url, title, thumbnail=None, duration="Unknown", duration_seconds=None,
+                 webpage_url=None, video_id=None, expires_at=None):
+        self.url = url
+        self.title = title
+        self.thumbnail = thumbnail
+        self.duration = duration
+        self.duration_seconds = duration_seconds
+        self.webpage_url = webpage_url
+        self.video_id = video_id
+        self.expires_at = expires_at
+        self.requested_at = None  # Thời điểm (monotonic) người dùng yêu cầu phát ngay, để đo độ trễ bắt đầu phát
+        self._label = None
+
+    def queue_label(self):
+        """
+        Dòng hiển thị của bài trong hàng đợi, được dựng lại chỉ khi tên hoặc thời lượng thay đổi
+        (ví dụ bài từ danh sách phát vừa được phân giải).
+        """
+        if self._label is None or self._label[0] != self.title or self._label[1] != self.duration:
+            self._label = (self.title, self.duration, f"{truncate_label(self.title, 80)} - {self.duration}")
+        return self._label[2]
+
+    def __repr__(self):
+        return f"Track({self.video_id!r}, {self.title!r})"
+
+class TrackQueue:
+    """
+    Hàng đợi bài hát dựa trên list với chỉ số đầu (head): lấy bài đầu, xem trước và truy cập theo vị trí là O(1);
+    xóa/di chuyển giữa hàng đợi chỉ dịch chuyển con trỏ trong list (memmove), không sao chép các bài.
+    Vị trí dùng trong các phương thức bắt đầu từ 0.
+    """
+    def __init__(self):
+        self._items = []
+        self._head = 0
+        self._not_empty = asyncio.Event()
+
+    def __len__(self):
+        return len(self._items) - self._head
+
+    def __iter__(self):
+        return itertools.islice(self._items, self._head, None)
+
+    def __getitem__(self, index):
+        return self._items[self._head + self._check_index(index)]
+
+    def _check_index(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError("Vị trí không hợp lệ trong hàng đợi")
+        return index
+
+    def _compact(self):
+        # Bỏ phần đã lấy ra ở đầu list khi nó chiếm quá nửa
+        if self._head and self._head * 2 >= len(self._items):
+            del self._items[:self._head]
+            self._head = 0
+
+    def _update_event(self):
+        if len(self):
+            self._not_empty.set()
+        else:
+            self._not_empty.clear()
+
+    def empty(self):
+        return len(self) == 0
+
+    def append(self, track):
+        self._items.append(track)
+        self._not_empty.set()
+
+    def extend(self, tracks):
+        self._items.extend(tracks)
+        self._update_event()
+
+    def insert(self, index, track):
+        """
+        Chèn bài vào vị trí index (0 = phát tiếp theo).
+        """
+        self._items.insert(self._head + max(0, min(index, len(self))), track)
+        self._not_empty.set()
+
+    def popleft(self):
+        """
+        Lấy bài đầu hàng đợi; trả về None nếu hàng đợi trống.
+        """
+        if not len(self):
+            return None
+        track = self._items[self._head]
+        self._items[self._head] = None
+        self._head += 1
+        self._compact()
+        self._update_event()
+        return track
+
+    def peek(self, count=1, start=0):
+        """
+        Xem trước tối đa count bài từ vị trí start mà không lấy ra.
+        """
+        return self._items[self._head + start:self._head + start + count]
+
+    def remove(self, index):
+        """
+        Xóa và trả về bài ở vị trí index.
+        """
+        track = self._items.pop(self._head + self._check_index(index))
+        self._update_event()
+        return track
+
+    def move(self, source, destination):
+        """
+        Di chuyển bài ở vị trí source tới vị trí destination.
+        """
+        self._check_index(source)
+        self._check_index(destination)
+        track = self._items.pop(self._head + source)
+        self._items.insert(self._head + destination, track)
+        return track
+
+    def shuffle(self):
+        """
+        Xáo trộn hàng đợi tại chỗ.
+        """
+        self._compact()
+        items = self._items
+        # Fisher-Yates trên phần còn lại của hàng đợi, không tạo list mới
+        for i in range(len(items) - 1, self._head, -1):
+            j = random.randint(self._head, i)
+            items[i], items[j] = items[j], items[i]
+
+    def skip_to(self, index):
+        """
+        Bỏ các bài trước vị trí index để bài đó trở thành bài đầu hàng đợi. Trả về số bài đã bỏ.
+        """
+        self._check_index(index)
+        end = self._head + index
+        for i in range(self._head, end):
+            self._items[i] = None
+        self._head = end
+        self._compact()
+        return index
+
+    def clear(self):
+        self._items.clear()
+        self._head = 0
+        self._not_empty.clear()
+
+    async def wait_not_empty(self):
+        """
+        Chờ tới khi hàng đợi có ít nhất một bài.
+        """
+        await self._not_empty.wait()
+
+HISTORY_SIZE = int(os.getenv('HISTORY_SIZE', '100'))      # Số bài đã phát được giữ trong bộ nhớ mỗi guild
+HISTORY_SPILL_DIR = os.getenv('HISTORY_SPILL_DIR')         # Bỏ trống để không ghi lịch sử cũ xuống đĩa
+HISTORY_SPILL_BATCH = 20                                   # Ghi xuống đĩa mỗi khi có đủ số bài bị đẩy ra
+HISTORY_SPILL_MAX_BYTES = 1024 * 1024                      # Xoay vòng file lịch sử khi vượt quá kích thước này
+
+class HistoryEntry:
+    """
+    Một bài trong lịch sử phát (không giữ URL luồng vì sẽ hết hạn).
+    """
+    __slots__ = ('video_id', 'title', 'duration', 'duration_seconds', 'webpage_url', 'played_at')
+
+    def __init__(self, track, played_at):
+        self.video_id = track.video_id
+        self.title = track.title
+        self.duration = track.duration
+        self.duration_seconds = track.duration_seconds
+        self.webpage_url = track.webpage_url
+        self.played_at = played_at
+
+    def to_track(self):
+        return Track(
+            url=None,
+            title=self.title,
+            duration=self.duration,
+            duration_seconds=self.duration_seconds,
+            webpage_url=self.webpage_url,
+            video_id=self.video_id,
+        )
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        entry = cls.__new__(cls)
+        for slot in cls.__slots__:
+            setattr(entry, slot, data.get(slot))
+        return entry
+
+class PlayHistory:
+    """
+    Lịch sử phát có dung lượng cố định (ring buffer). Các bài cũ bị đẩy ra có thể được ghi nối tiếp
+    vào file JSONL của guild (HISTORY_SPILL_DIR) theo lô, trong thread riêng.
+    """
+    def __init__(self, guild_id, capacity=HISTORY_SIZE, spill_dir=HISTORY_SPILL_DIR):
+        self._entries = deque(maxlen=capacity)
+        self.spill_path = os.path.join(spill_dir, f"{guild_id}.jsonl") if spill_dir else None
+        self._spill_pending = []
+        self.total_played = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def record(self, track):
+        """
+        Ghi nhận một bài vừa bắt đầu phát. Phát lặp liên tiếp cùng một bài chỉ cập nhật thời điểm.
+        """
+        now = time.time()
+        self.total_played += 1
+        if self._entries and track.video_id and self._entries[-1].video_id == track.video_id:
+            self._entries[-1].played_at = now
+            return
+        if len(self._entries) == self._entries.maxlen:
+            evicted = self._entries[0]
+            if self.spill_path:
+                self._spill_pending.append(evicted.to_dict())
+                if len(self._spill_pending) >= HISTORY_SPILL_BATCH:
+                    self.flush()
+        self._entries.append(HistoryEntry(track, now))
+
+    def recent(self, count):
+        """
+        count bài phát gần nhất, mới nhất trước.
+        """
+        return list(itertools.islice(reversed(self._entries), count))
+
+    def restore(self, entries):
+        """
+        Nạp lại các bài đã lưu (cũ nhất trước), ví dụ khi khôi phục MusicPlayer đã bị giải phóng.
+        """
+        self._entries.extend(HistoryEntry.from_dict(entry) for entry in entries)
+
+    def pop(self):
+        """
+        Lấy ra bài mới nhất khỏi lịch sử (dùng cho !back); None nếu trống.
+        """
+        return self._entries.pop() if self._entries else None
+
+    def flush(self):
+        """
+        Ghi các bài đang chờ xuống file lịch sử trong thread riêng.
+        """
+        if not self._spill_pending:
+            return None
+        pending, self._spill_pending = self._spill_pending, []
+        return asyncio.create_task(asyncio.to_thread(self._write_spill, pending))
+
+    def _write_spill(self, records):
+        try:
+            os.makedirs(os.path.dirname(self.spill_path) or '.', exist_ok=True)
+            if os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) > HISTORY_SPILL_MAX_BYTES:
+                os.replace(self.spill_path, self.spill_path + '.1')
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.spilled += len(records)
+        except OSError as e:
+            logger.warning(f"Không thể ghi lịch sử phát vào {self.spill_path}: {e}")
+
+def estimate_object_bytes(obj):
+    """
+    Ước lượng bộ nhớ của một bản ghi có __slots__ (đối tượng và các giá trị thuộc tính).
+    """
+    return sys.getsizeof(obj) + sum(
+        sys.getsizeof(getattr(obj, slot, None)) for slot in getattr(obj, '__slots__', ())
+    )
+
+# -----------------------------#
+#        Tự Động Phát           #
+# -----------------------------#
+
+AUTOPLAY_NO_REPEAT = int(os.getenv('AUTOPLAY_NO_REPEAT', '5'))          # Không phát lại N bài vừa phát gần nhất
+AUTOPLAY_RELATED = os.getenv('AUTOPLAY_RELATED', '0') == '1'           # Thêm bài liên quan (YouTube mix) làm ứng viên
+AUTOPLAY_RELATED_MAX = 50          # Số bài liên quan tối đa giữ cho mỗi guild
+AUTOPLAY_RECENCY_SECONDS = 1800    # Bài vừa phát bị giảm trọng số, hồi phục dần trong 30 phút
+AUTOPLAY_MIN_WEIGHT = 0.05
+AUTOPLAY_MAX_ATTEMPTS = 3          # Số ứng viên thử tối đa mỗi lần hết hàng đợi
+
+class AutoplayEngine:
+    """
+    Chọn bài để tự động phát khi hết hàng đợi, từ các bài gần đây (recent_tracks) và bài liên quan.
+    Dùng "túi xáo trộn có trọng số": mỗi lần túi rỗng, các ứng viên được xếp theo khóa
+    Efraimidis-Spirakis random() ** (1 / trọng số) một lần; mỗi lần chọn chỉ lấy phần tử cuối túi (O(1) khấu hao).
+    Trọng số tăng theo số lần phát trong lịch sử và giảm với bài vừa phát; các bài trong cửa sổ
+    AUTOPLAY_NO_REPEAT bài gần nhất bị bỏ qua.
+    """
+    def __init__(self, music_player):
+        self.music_player = music_player
+        self.related = OrderedDict()  # video_id -> metadata của bài liên quan
+        self._related_seed = None
+        self._related_task = None
+        self._bag = []
+        self._next = None
+        self.picks = 0
+        self.repeats_skipped = 0
+        self.rebuilds = 0
+
+    def _meta(self, video_id):
+        # Tra cứu trực tiếp trong hai nguồn ứng viên (O(1)), bài gần đây được ưu tiên
+        meta = self.music_player.recent_tracks.get(video_id)
+        return meta if meta is not None else self.related.get(video_id)
+
+    def _candidate_ids(self):
+        recent = self.music_player.recent_tracks
+        yield from recent.keys()
+        yield from (video_id for video_id in self.related if video_id not in recent)
+
+    def _recent_window(self):
+        window = {entry.video_id for entry in self.music_player.history.recent(AUTOPLAY_NO_REPEAT)}
+        if self.music_player.current_song:
+            window.add(self.music_player.current_song.video_id)
+        return window
+
+    def _rebuild(self):
+        play_counts = Counter()
+        last_played = {}
+        for entry in self.music_player.history:
+            play_counts[entry.video_id] += 1
+            last_played[entry.video_id] = entry.played_at
+        now = time.time()
+        keyed = []
+        for video_id in self._candidate_ids():
+            weight = 1.0 + play_counts[video_id]
+            if video_id in last_played:
+                weight *= min(1.0, (now - last_played[video_id]) / AUTOPLAY_RECENCY_SECONDS)
+            weight = max(weight, AUTOPLAY_MIN_WEIGHT)
+            keyed.append((random.random() ** (1.0 / weight), video_id))
+        # Khóa lớn nhất nằm cuối túi để pop() lấy ra trước
+        keyed.sort()
+        self._bag = [video_id for _, video_id in keyed]
+        self.rebuilds += 1
+
+    def _select(self):
+        if not self.music_player.recent_tracks and not self.related:
+            return None
+        window = self._recent_window()
+        deferred = None
+        for _ in range(2):
+            if not self._bag:
+                self._rebuild()
+            while self._bag:
+                video_id = self._bag.pop()
+                meta = self._meta(video_id)
+                if meta is None:
+                    continue
+                if video_id in window:
+                    self.repeats_skipped += 1
+                    deferred = deferred or (video_id, meta)
+                    continue
+                return self._make_track(video_id, meta)
+        # Chỉ còn các bài vừa phát: chấp nhận lặp lại thay vì dừng hẳn
+        if deferred and deferred[0] != getattr(self.music_player.current_song, 'video_id', None):
+            return self._make_track(*deferred)
+        return None
+
+    def _make_track(self, video_id, meta):
+        return Track(
+            url=None,
+            title=meta['title'],
+            thumbnail=meta.get('thumbnail'),
+            duration=meta.get('duration', "Unknown"),
+            webpage_url=meta['url'],
+            video_id=video_id,
+        )
+
+    def peek_next(self):
+        """
+        Bài sẽ được tự động phát tiếp theo (được chọn trước để có thể lấy trước URL luồng).
+        """
+        if self._next is None:
+            self._next = self._select()
+        return self._next
+
+    def take(self):
+        track = self.peek_next()
+        self._next = None
+        if track:
+            self.picks += 1
+        return track
+
+    def discard(self, track):
+        """
+        Bỏ ứng viên không phát được.
+        """
+        self.music_player.recent_tracks.pop(track.video_id, None)
+        self.related.pop(track.video_id, None)
+        if self._next is track:
+            self._next = None
+
+    def note_playing(self, track):
+        """
+        Khi bài cuối hàng đợi bắt đầu phát, lấy trước danh sách bài liên quan (mix) của nó.
+        """
+        if not AUTOPLAY_RELATED or not track.video_id or track.video_id == self._related_seed:
+            return
+        if not self.music_player.music_queue.empty():
+            return
+        if self._related_task and not self._related_task.done():
+            return
+        self._related_seed = track.video_id
+        self._related_task = asyncio.create_task(self._fetch_related(track.video_id))
+
+    async def _fetch_related(self, video_id):
+        try:
+            playlist = await extraction_scheduler.submit(
+                self.music_player.guild_id, extract_playlist_entries,
+                f"https://www.youtube.com/watch?v={video_id}&list=RD{video_id}", AUTOPLAY_RELATED_MAX
+            )
+        except ExtractionQueueFull:
+            return
+        except Exception as e:
+            logger.warning(f"Không thể lấy bài liên quan cho {video_id}: {e}")
+            return
+        if not playlist:
+            return
+        for entry in playlist['entries']:
+            if entry['id'] == video_id:
+                continue
+            self.related[entry['id']] = {
+                "url": f"https://www.youtube.com/watch?v={entry['id']}",
+                "title": entry['title'],
+                "thumbnail": None,
+                "duration": format_duration_seconds(entry.get('duration')),
+            }
+            self.related.move_to_end(entry['id'])
+        while len(self.related) > AUTOPLAY_RELATED_MAX:
+            self.related.popitem(last=False)
+        self._bag = []  # Xếp lại túi với các ứng viên mới ở lần chọn sau
+
+    def close(self):
+        if self._related_task and not self._related_task.done():
+            self._related_task.cancel()
+
+    def stats(self):
+        return {
+            "picks": self.picks,
+            "repeats_skipped": self.repeats_skipped,
+            "rebuilds": self.rebuilds,
+            "related": len(self.related),
+        }
+
+# -----------------------------#
+#        Định Nghĩa MusicPlayer#
+# -----------------------------#
+
+PLAYER_IDLE_TIMEOUT = int(os.getenv('PLAYER_IDLE_TIMEOUT', '3600'))  # Giải phóng MusicPlayer không hoạt động (0 = tắt)
+PLAYER_STATE_DIR = os.getenv('PLAYER_STATE_DIR', os.path.join(current_dir, 'data', 'players'))  # Bỏ trống để không lưu
+PLAYER_REAP_INTERVAL = 60              # Chu kỳ kiểm tra các MusicPlayer không hoạt động
+PLAYER_STATE_RETENTION = 7 * 86400     # Bỏ trạng thái đã lưu nếu guild không quay lại trong 7 ngày
+
+class MusicPlayer:
+    """
+    Lớp quản lý phát nhạc cho mỗi guild.
+    """    
+    def __init__(self, guild_id, text_channel):
+        self.guild_id = guild_id
+        self.voice_client = None
+        self.voice_channel = None  # Kênh thoại mà bot đang kết nối
+        self.current_song = None
+        self.is_paused = False
+        self.is_looping = False
+        self.stopping = False  # Đang xử lý lệnh stop: play_next/tự động phát không được bắt đầu bài mới
+        self.volume = 100  # Âm lượng (%) áp dụng khi bắt đầu phát mỗi bài
+        self.music_queue = TrackQueue()
+        self.panel = ControlPanelRenderer(self)  # Bảng điều khiển (embed + nút) của guild
+        self.disconnect_task = None
+        # Các bài đã phân giải trong 1 giờ qua (chỉ metadata, URL luồng nằm trong stream_cache dùng chung)
+        self.recent_tracks = TTLCache(maxsize=100, ttl=3600)
+        self.text_channel = text_channel  # Kênh TextChannel để gửi thông báo
+        self.history = PlayHistory(guild_id)  # Các bài đã phát gần đây (giới hạn HISTORY_SIZE)
+        self.is_playing_from_cache = False  # Trạng thái đang phát từ bộ nhớ đệm
+        self.prefetch_task = None  # Tác vụ lấy trước URL luồng cho các bài sắp phát
+        self.prepared_source = None  # Nguồn FFmpeg đã khởi chạy sẵn cho bài kế tiếp
+        self.last_active = time.monotonic()  # Lần cuối guild có hoạt động (phát nhạc, lệnh, nút bấm)
+        self.autoplay = AutoplayEngine(self)  # Chọn bài tự động phát khi hết hàng đợi
+        self.voice_timing = VoiceTiming()  # Nhịp gửi gói thoại của guild
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def is_idle(self, now, timeout):
+        """
+        MusicPlayer có thể được giải phóng: không còn trong kênh thoại và không hoạt động quá timeout giây.
+        """
+        if self.voice_client and self.voice_client.is_connected():
+            return False
+        return now - self.last_active > timeout
+
+    def to_state(self):
+        """
+        Trạng thái cần giữ lại khi giải phóng (không có URL luồng vì sẽ hết hạn).
+        """
+        return {
+            "text_channel_id": self.text_channel.id if self.text_channel else None,
+            "is_looping": self.is_looping,
+            "volume": self.volume,
+            "queue": [
+                {
+                    "title": track.title,
+                    "duration": track.duration_seconds,
+                    "id": track.video_id,
+                }
+                for track in self.music_queue if track.video_id
+            ],
+            "history": [entry.to_dict() for entry in self.history],
+            "recent_tracks": dict(self.recent_tracks.items()),
+        }
+
+    def restore_state(self, state):
+        """
+        Khôi phục trạng thái đã lưu bởi to_state; các bài trong hàng đợi sẽ được phân giải lại khi sắp phát.
+        """
+        self.is_looping = state.get("is_looping", False)
+        self.volume = state.get("volume", 100)
+        self.music_queue.extend(make_placeholder_song(entry) for entry in state.get("queue", []))
+        self.history.restore(state.get("history", []))
+        for video_id, track in state.get("recent_tracks", {}).items():
+            self.recent_tracks[video_id] = track
+
+    def memory_footprint(self):
+        """
+        Ước lượng bộ nhớ (byte) mà hàng đợi, lịch sử và danh sách bài gần đây của guild đang dùng.
+        """
+        queue_bytes = sys.getsizeof(self.music_queue._items) + sum(
+            estimate_object_bytes(track) for track in self.music_queue
+        )
+        history_bytes = sys.getsizeof(self.history._entries) + sum(
+            estimate_object_bytes(entry) for entry in self.history
+        )
+        recent_bytes = sys.getsizeof(self.recent_tracks) + sum(
+            sys.getsizeof(track) + sum(sys.getsizeof(value) for value in track.values())
+            for track in self.recent_tracks.values()
+        )
+        return {
+            "queue": queue_bytes,
+            "history": history_bytes,
+            "recent": recent_bytes,
+            "total": queue_bytes + history_bytes + recent_bytes,
+        }
+
+# -----------------------------#
+#        Định Nghĩa YouTubeAPI  #
+# -----------------------------#
+
+YOUTUBE_API_BASE = "https://www.googleapis.com/youtube/v3"
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '1000'))
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', str(6 * 3600)))
+SEARCH_DEGRADED_CACHE_TTL = 300         # Kết quả thiếu thời lượng hoặc từ yt-dlp chỉ giữ ngắn hạn
+VIDEO_DETAILS_CACHE_SIZE = 20000
+VIDEO_DETAILS_CACHE_TTL = 7 * 86400     # Thời lượng video hầu như không đổi
+YOUTUBE_QUOTA_COST = {'search': 100, 'videos': 1}  # Chi phí quota của từng endpoint
+YOUTUBE_DAILY_QUOTA = int(os.getenv('YOUTUBE_DAILY_QUOTA', '10000'))
+YOUTUBE_API_RATE = float(os.getenv('YOUTUBE_API_RATE', '5'))     # Số yêu cầu/giây tối đa
+YOUTUBE_API_BURST = int(os.getenv('YOUTUBE_API_BURST', '10'))
+VIDEO_DETAILS_BATCH_WINDOW = 0.05   # Gom các yêu cầu thời lượng trong 50ms thành một lần gọi
+VIDEO_DETAILS_BATCH_SIZE = 50       # Số ID tối đa mỗi lần gọi videos
+
+try:
+    from zoneinfo import ZoneInfo
+    QUOTA_TIMEZONE = ZoneInfo('America/Los_Angeles')
+except Exception:
+    # Không có dữ liệu múi giờ: dùng UTC-8 cố định
+    QUOTA_TIMEZONE = datetime.timezone(datetime.timedelta(hours=-8))
+
+def normalize_query(query):
+    """
+    Chuẩn hóa truy vấn tìm kiếm: bỏ dấu (kể cả đ/Đ), không phân biệt hoa thường, gộp khoảng trắng.
+    """
+    query = query.replace('đ', 'd').replace('Đ', 'D')
+    decomposed = unicodedata.normalize('NFKD', query)
+    without_marks = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(without_marks.casefold().split())
+
+class QuotaExhausted(Exception):
+    """
+    Quota YouTube API trong ngày đã hết.
+    """
+
+class QuotaTracker:
+    """
+    Theo dõi quota YouTube API đã dùng theo từng endpoint, tự đặt lại vào nửa đêm giờ Thái Bình Dương.
+    """
+    def __init__(self, daily_limit):
+        self.daily_limit = daily_limit
+        self.day = self._today()
+        self.spent = Counter()
+        self.exhausted = False
+
+    @staticmethod
+    def _today():
+        return datetime.datetime.now(QUOTA_TIMEZONE).date()
+
+    def _roll_over(self):
+        today = self._today()
+        if today != self.day:
+            self.day = today
+            self.spent.clear()
+            self.exhausted = False
+
+    @property
+    def total_spent(self):
+        return sum(self.spent.values())
+
+    @property
+    def remaining(self):
+        self._roll_over()
+        if self.exhausted:
+            return 0
+        return max(0, self.daily_limit - self.total_spent)
+
+    def can_spend(self, cost):
+        return self.remaining >= cost
+
+    def spend(self, endpoint, cost):
+        self._roll_over()
+        self.spent[endpoint] += cost
+
+    def mark_exhausted(self):
+        """
+        Google báo hết quota (có thể do dùng chung key ở nơi khác): dừng gọi API đến hết ngày.
+        """
+        self._roll_over()
+        self.exhausted = True
+
+class TokenBucket:
+    """
+    Bộ giới hạn tốc độ kiểu token bucket: tối đa rate yêu cầu/giây, cho phép dồn tối đa capacity.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.waits = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.waits += 1
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class VideoDetailsBatcher:
+    """
+    Gom các yêu cầu thời lượng video từ nhiều lượt tìm kiếm đồng thời thành các lần gọi
+    videos?part=contentDetails (tối đa 50 ID mỗi lần).
+    """
+    def __init__(self, fetch, window, max_batch):
+        self._fetch = fetch  # async (ids) -> {video_id: duration}
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # video_id -> Future
+        self._flush_handle = None
+        self._tasks = set()
+        self.batches = 0
+        self.ids_requested = 0
+
+    async def get(self, video_ids):
+        """
+        Lấy thời lượng của các video; trả về dict chỉ gồm các video lấy được.
+        """
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for video_id in video_ids:
+            future = self._pending.get(video_id)
+            if future is None:
+                future = loop.create_future()
+                self._pending[video_id] = future
+            futures[video_id] = future
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        results = await asyncio.gather(*futures.values(), return_exceptions=True)
+        return {
+            video_id: result for video_id, result in zip(futures, results)
+            if result is not None and not isinstance(result, BaseException)
+        }
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        video_ids = list(pending)
+        for start in range(0, len(video_ids), self.max_batch):
+            chunk = {video_id: pending[video_id] for video_id in video_ids[start:start + self.max_batch]}
+            task = asyncio.ensure_future(self._run_batch(chunk))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, futures):
+        self.batches += 1
+        self.ids_requested += len(futures)
+        try:
+            durations = await self._fetch(list(futures))
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for video_id, future in futures.items():
+            if not future.done():
+                future.set_result(durations.get(video_id))
+
+class YouTubeAPI:
+    """
+    Lớp quản lý các yêu cầu tới YouTube API.
+    Theo dõi quota, giới hạn tốc độ, gom yêu cầu thời lượng và chuyển sang tìm bằng yt-dlp khi hết quota.
+    """
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.session = None
+        # Bộ nhớ đệm kết quả tìm kiếm theo truy vấn đã chuẩn hóa (LRU + TTL)
+        self.search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+        # Kết quả kém chất lượng (hết quota, dùng yt-dlp, thiếu thời lượng) để thử lại API sớm
+        self.degraded_search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_DEGRADED_CACHE_TTL)
+        # Bộ nhớ đệm thời lượng video dùng chung giữa các truy vấn
+        self.duration_cache = TTLCache(maxsize=VIDEO_DETAILS_CACHE_SIZE, ttl=VIDEO_DETAILS_CACHE_TTL)
+        self.quota = QuotaTracker(YOUTUBE_DAILY_QUOTA)
+        self.rate_limiter = TokenBucket(YOUTUBE_API_RATE, YOUTUBE_API_BURST)
+        self.details_batcher = VideoDetailsBatcher(
+            self._fetch_durations, VIDEO_DETAILS_BATCH_WINDOW, VIDEO_DETAILS_BATCH_SIZE
+        )
+        self.call_counts = Counter()       # (endpoint, status) -> số lần gọi
+        self.call_latency = {}             # endpoint -> Histogram thời gian gọi (ms)
+        self.search_hits = 0
+        self.search_misses = 0
+        self.details_hits = 0
+        self.details_misses = 0
+        self.fallback_searches = 0
+
+    async def init_session(self):
+        """
+        Khởi tạo session aiohttp.
+        """
+        self.session = aiohttp.ClientSession()
+
+    async def close(self):
+        """
+        Đóng session aiohttp.
+        """
+        if self.session:
+            await self.session.close()
+
+    async def _api_get(self, endpoint, params):
+        """
+        Gọi một endpoint của YouTube Data API sau khi kiểm tra quota và giới hạn tốc độ.
+        Trả về dữ liệu JSON, None nếu lỗi, hoặc ném QuotaExhausted.
+        """
+        cost = YOUTUBE_QUOTA_COST[endpoint]
+        if not self.quota.can_spend(cost):
+            raise QuotaExhausted(f"Không đủ quota cho {endpoint} (còn {self.quota.remaining}).")
+        await self.rate_limiter.acquire()
+        self.quota.spend(endpoint, cost)
+        started_at = time.monotonic()
+        async with self.session.get(f"{YOUTUBE_API_BASE}/{endpoint}", params={**params, 'key': self.api_key}) as resp:
+            status = resp.status
+            data = await resp.json(content_type=None)
+        self.call_counts[(endpoint, status)] += 1
+        self.call_latency.setdefault(endpoint, Histogram()).observe((time.monotonic() - started_at) * 1000)
+        if status == 200:
+            return data
+        error = (data or {}).get('error', {}) if isinstance(data, dict) else {}
+        reasons = {item.get('reason') for item in error.get('errors', [])}
+        if status == 403 and reasons & {'quotaExceeded', 'dailyLimitExceeded'}:
+            self.quota.mark_exhausted()
+            raise QuotaExhausted(f"YouTube API báo hết quota khi gọi {endpoint}.")
+        logger.error(f"Lỗi YouTube API {endpoint}: {status} {error.get('message', '')}")
+        return None
+
+    async def _fetch_durations(self, video_ids):
+        data = await self._api_get('videos', {'part': 'contentDetails', 'id': ','.join(video_ids)})
+        if data is None:
+            return {}
+        durations = {}
+        for item in data.get('items', []):
+            durations[item['id']] = parse_duration(item['contentDetails']['duration'])
+        return durations
+
+    async def _search_api(self, query, max_results):
+        data = await self._api_get('search', {
+            'part': 'snippet',
+            'q': query,
+            'type': 'video',
+            'maxResults': max_results,
+        })
+        if data is None:
+            return None
+        items = data.get('items', [])
+        video_ids = [item['id']['videoId'] for item in items]
+        if not video_ids:
+            return []
+
+        # Chỉ hỏi thời lượng của các video chưa có trong bộ nhớ đệm, gom chung với các lượt tìm khác
+        missing_ids = [video_id for video_id in video_ids if video_id not in self.duration_cache]
+        self.details_hits += len(video_ids) - len(missing_ids)
+        self.details_misses += len(missing_ids)
+        if missing_ids:
+            for video_id, duration in (await self.details_batcher.get(missing_ids)).items():
+                self.duration_cache[video_id] = duration
+
+        results = []
+        for item in items:
+            video_id = item['id']['videoId']
+            results.append({
+                'title': item['snippet']['title'],
+                'url': f"https://www.youtube.com/watch?v={video_id}",
+                'thumbnail': item['snippet']['thumbnails']['default']['url'],
+                'duration': self.duration_cache.get(video_id, "Unknown")
+            })
+        return results
+
+    async def search_youtube(self, query, max_results=10, guild_id=None):
+        """
+        Tìm kiếm video trên YouTube dựa trên truy vấn.
+        """
+        cache_key = (normalize_query(query), max_results)
+        cached = self.search_cache.get(cache_key)
+        if cached is None:
+            cached = self.degraded_search_cache.get(cache_key)
+        if cached is not None:
+            self.search_hits += 1
+            logger.info(f"Lấy kết quả tìm kiếm '{query}' từ bộ nhớ đệm.")
+            return [dict(result) for result in cached]
+        self.search_misses += 1
+
+        results = None
+        degraded = False
+        if self.api_key and self.session:
+            try:
+                results = await self._search_api(query, max_results)
+            except QuotaExhausted as e:
+                logger.warning(f"{e} Chuyển sang tìm kiếm bằng yt-dlp.")
+            except Exception as e:
+                logger.error(f"Lỗi khi tìm kiếm YouTube: {e}")
+
+        if results is None:
+            # Hết quota hoặc API lỗi: tìm bằng yt-dlp (ytsearch) qua bộ lập lịch trích xuất
+            self.fallback_searches += 1
+            degraded = True
+            try:
+                results = await extraction_scheduler.submit(guild_id, search_with_ytdlp, query, max_results)
+            except ExtractionQueueFull:
+                raise
+            except Exception as e:
+                logger.error(f"Lỗi khi tìm kiếm bằng yt-dlp: {e}")
+                return None
+            if results is None:
+                return None
+
+        if degraded or any(result['duration'] == "Unknown" for result in results):
+            self.degraded_search_cache[cache_key] = results
+        else:
+            self.degraded_search_cache.pop(cache_key, None)
+            self.search_cache[cache_key] = results
+        return [dict(result) for result in results]
+
+    def stats(self):
+        """
+        Trả về các chỉ số của bộ nhớ đệm tìm kiếm, quota và các lần gọi API.
+        """
+        search_lookups = self.search_hits + self.search_misses
+        details_lookups = self.details_hits + self.details_misses
+        return {
+            'search_entries': len(self.search_cache) + len(self.degraded_search_cache),
+            'search_hits': self.search_hits,
+            'search_misses': self.search_misses,
+            'search_hit_ratio': self.search_hits / search_lookups if search_lookups else 0.0,
+            'details_entries': len(self.duration_cache),
+            'details_hit_ratio': self.details_hits / details_lookups if details_lookups else 0.0,
+            'quota_spent': self.quota.total_spent,
+            'quota_by_endpoint': dict(self.quota.spent),
+            'quota_remaining': self.quota.remaining,
+            'details_batches': self.details_batcher.batches,
+            'details_batched_ids': self.details_batcher.ids_requested,
+            'rate_limited': self.rate_limiter.waits,
+            'fallback_searches': self.fallback_searches,
+            'calls': dict(self.call_counts),
+        }
+
+# -----------------------------#
+#     Đo Độ Trễ Event Loop      #
+# -----------------------------#
+
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))    # Chu kỳ đo độ trễ của event loop (giây)
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.1'))  # Ghi stack khi event loop bị chặn lâu hơn mức này
+VOICE_FRAME_SECONDS = 0.02      # Mỗi gói Opus 20ms; AudioPlayer đọc một gói mỗi 20ms
+VOICE_GAP_SECONDS = 2.0         # Khoảng nghỉ dài hơn được coi là tạm dừng, không tính vào độ trễ
+
+class Histogram:
+    """
+    Histogram với các mốc cố định (mili giây): đếm theo bucket, tổng, giá trị lớn nhất và ước lượng phân vị.
+    """
+    DEFAULT_BOUNDS = (1, 2, 5, 10, 20, 25, 30, 40, 50, 100, 250, 500, 1000, 5000)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Bucket cuối cho giá trị lớn hơn mốc lớn nhất
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Ước lượng phân vị q (0-1) bằng mốc trên của bucket chứa nó.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    @classmethod
+    def merged(cls, histograms, bounds=DEFAULT_BOUNDS):
+        """
+        Gộp nhiều histogram cùng mốc thành một (ví dụ nhịp gói thoại của mọi guild).
+        """
+        result = cls(bounds)
+        for histogram in histograms:
+            result.counts = [a + b for a, b in zip(result.counts, histogram.counts)]
+            result.count += histogram.count
+            result.total += histogram.total
+            result.max = max(result.max, histogram.max)
+        return result
+
+    def summary(self):
+        return (f"TB {self.mean():.1f}ms | p50 {self.quantile(0.5):g}ms | p99 {self.quantile(0.99):g}ms | "
+                f"max {self.max:.0f}ms ({self.count} mẫu)")
+
+# Histogram dùng chung cho trang metrics
+TRACK_START_BOUNDS = (100, 250, 500, 1000, 2000, 3000, 5000, 10000, 20000, 30000)
+track_start_latency = Histogram(TRACK_START_BOUNDS)  # Từ lúc yêu cầu phát đến gói âm thanh đầu tiên
+resolution_latency = {}  # Lần thử yt-dlp thành công (1, 2, ...), 'store' hoặc 'failed' -> Histogram
+
+class LoopLagMonitor:
+    """
+    Đo độ trễ lập lịch của event loop: một tác vụ ngủ LOOP_LAG_INTERVAL rồi ghi độ trễ thực tế vào histogram.
+    Một thread giám sát kiểm tra nhịp của tác vụ này; khi event loop bị chặn quá LOOP_LAG_THRESHOLD,
+    nó lấy stack của thread event loop (sys._current_frames) và ghi log để biết đoạn code nào gây chặn.
+    """
+    def __init__(self):
+        self.lag = Histogram()
+        self.stalls = 0
+        self.last_stall = None  # (thời điểm, thời gian bị chặn, dòng code cuối cùng trong stack)
+        self._heartbeat = None
+        self._loop_thread_id = None
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._task:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._run())
+        self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._watchdog.start()
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            now = time.monotonic()
+            self._heartbeat = now
+            self.lag.observe(max(0.0, now - started - LOOP_LAG_INTERVAL) * 1000)
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(LOOP_LAG_THRESHOLD / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL
+            if blocked < LOOP_LAG_THRESHOLD or reported == heartbeat:
+                continue
+            reported = heartbeat  # Mỗi lần bị chặn chỉ ghi một stack
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            self.stalls += 1
+            self.last_stall = (time.time(), blocked, f"{stack[-1].filename}:{stack[-1].lineno} ({stack[-1].name})")
+            logger.warning(
+                f"Event loop bị chặn hơn {blocked * 1000:.0f}ms, stack hiện tại:\n" + ''.join(traceback.format_list(stack[-15:]))
+            )
+
+    async def close(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {'lag': self.lag, 'stalls': self.stalls, 'last_stall': self.last_stall}
+
+class VoiceTiming:
+    """
+    Thời điểm AudioPlayer đọc gói của một guild: histogram khoảng cách giữa hai lần đọc (lý tưởng 20ms),
+    histogram thời gian mỗi lần đọc nguồn và số gói bị trễ (ước lượng từ các khoảng cách từ 40ms trở lên).
+    """
+    def __init__(self):
+        self.intervals = Histogram()
+        self.read_time = Histogram()
+        self.late_frames = 0
+        self.frames = 0
+        self.gaps = 0
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'late_frames': self.late_frames,
+            'late_ratio': self.late_frames / self.frames if self.frames else 0.0,
+            'gaps': self.gaps,
+        }
+
+class TimedSource(discord.AudioSource):
+    """
+    Bọc nguồn âm thanh được giao cho voice_client để đo nhịp đọc gói trong thread AudioPlayer
+    (bị trễ khi GIL bị giữ lâu hoặc nguồn đọc chậm).
+    """
+    def __init__(self, source, timing, requested_at=None):
+        self.source = source
+        self.timing = timing
+        self.requested_at = requested_at  # Có giá trị nếu bài được yêu cầu phát ngay: đo độ trễ tới gói đầu tiên
+        self._last_read = None
+
+    def read(self):
+        started = time.perf_counter()
+        timing = self.timing
+        if self._last_read is not None:
+            interval = started - self._last_read
+            if interval > VOICE_GAP_SECONDS:
+                timing.gaps += 1  # Tạm dừng/tiếp tục, không phải trễ
+            else:
+                timing.intervals.observe(interval * 1000)
+                if interval >= VOICE_FRAME_SECONDS * 2:
+                    timing.late_frames += int(interval / VOICE_FRAME_SECONDS) - 1
+        data = self.source.read()
+        self._last_read = time.perf_counter()
+        timing.read_time.observe((self._last_read - started) * 1000)
+        timing.frames += 1
+        if self.requested_at is not None and data:
+            track_start_latency.observe((time.monotonic() - self.requested_at) * 1000)
+            self.requested_at = None
+        return data
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+# -----------------------------#
+#         Trang Metrics         #
+# -----------------------------#
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))          # Cổng HTTP cho trang /metrics (0 = tắt)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')       # Mặc định chỉ nghe trên máy cục bộ
+
+class MetricsWriter:
+    """
+    Ghi các chỉ số theo định dạng văn bản của Prometheus (text exposition 0.0.4).
+    Histogram nội bộ đo bằng mili giây được xuất theo giây như quy ước của Prometheus.
+    """
+    def __init__(self):
+        self.lines = []
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        escaped = (
+            (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels.items()
+        )
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    def _header(self, name, kind, help_text):
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def gauge(self, name, help_text, samples):
+        """
+        samples: số, hoặc danh sách (labels, giá trị).
+        """
+        self._header(name, 'gauge', help_text)
+        self._samples(name, samples)
+
+    def counter(self, name, help_text, samples):
+        self._header(name, 'counter', help_text)
+        self._samples(name + '_total', samples)
+
+    def _samples(self, name, samples):
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{self._labels(labels)} {value}")
+
+    def histogram(self, name, help_text, samples):
+        """
+        samples: Histogram, hoặc danh sách (labels, Histogram).
+        """
+        self._header(name, 'histogram', help_text)
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, histogram in samples:
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.bounds, histogram.counts):
+                cumulative += bucket_count
+                self.lines.append(f"{name}_bucket{self._labels({**labels, 'le': bound / 1000})} {cumulative}")
+            self.lines.append(f"{name}_bucket{self._labels({**labels, 'le': '+Inf'})} {histogram.count}")
+            self.lines.append(f"{name}_sum{self._labels(labels)} {histogram.total / 1000}")
+            self.lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+def render_metrics():
+    """
+    Thu thập chỉ số hiện tại của bot cho trang /metrics.
+    """
+    writer = MetricsWriter()
+    players = list(bot.music_players.values())
+    queue_lengths = [len(player.music_queue) for player in players]
+    writer.gauge('musicbot_guilds', 'Số server bot đang tham gia.', len(bot.guilds))
+    writer.gauge('musicbot_voice_clients', 'Số kết nối thoại đang mở.', len(bot.voice_clients))
+    writer.gauge('musicbot_music_players', 'Số MusicPlayer đang giữ trong bộ nhớ.', len(players))
+    writer.gauge('musicbot_queue_tracks', 'Tổng số bài trong hàng đợi của mọi server.', sum(queue_lengths))
+    writer.gauge('musicbot_queue_tracks_max', 'Số bài trong hàng đợi dài nhất.', max(queue_lengths, default=0))
+    writer.gauge('musicbot_shard_latency_seconds', 'Độ trễ heartbeat gateway của từng shard.', [
+        ({'shard': shard_id}, shard['latency'])
+        for shard_id, shard in bot.shard_stats().items() if not math.isnan(shard['latency'])
+    ])
+
+    cache_stats = stream_cache.stats()
+    writer.gauge('musicbot_stream_cache_entries', 'Số URL luồng trong bộ nhớ đệm.', cache_stats['entries'])
+    writer.counter('musicbot_stream_cache_hits', 'Số lần trúng bộ nhớ đệm URL luồng.', cache_stats['hits'])
+    writer.counter('musicbot_stream_cache_misses', 'Số lần trượt bộ nhớ đệm URL luồng.', cache_stats['misses'])
+    writer.gauge('musicbot_stream_cache_hit_ratio', 'Tỉ lệ trúng bộ nhớ đệm URL luồng.', cache_stats['hit_ratio'])
+    writer.histogram('musicbot_resolution_seconds', 'Thời gian phân giải URL luồng theo lần thử yt-dlp thành công.', [
+        ({'attempt': attempt}, histogram) for attempt, histogram in sorted(resolution_latency.items(), key=str)
+    ])
+    scheduler_stats = extraction_scheduler.stats()
+    writer.gauge('musicbot_extraction_queue_depth', 'Số yêu cầu trích xuất đang chờ.', scheduler_stats['queue_depth'])
+    writer.counter('musicbot_extraction_rejected', 'Số yêu cầu trích xuất bị từ chối vì hàng đợi đầy.', scheduler_stats['rejected'])
+
+    api = bot.youtube_api
+    writer.counter('musicbot_youtube_api_calls', 'Số lần gọi YouTube API theo endpoint và mã trạng thái HTTP.', [
+        ({'endpoint': endpoint, 'status': status}, count) for (endpoint, status), count in sorted(api.call_counts.items())
+    ])
+    writer.histogram('musicbot_youtube_api_seconds', 'Thời gian gọi YouTube API theo endpoint.', [
+        ({'endpoint': endpoint}, histogram) for endpoint, histogram in sorted(api.call_latency.items())
+    ])
+    writer.gauge('musicbot_youtube_quota_remaining', 'Quota YouTube API còn lại trong ngày.', api.quota.remaining)
+
+    ffmpeg_stats = ffmpeg_supervisor.stats()
+    writer.gauge('musicbot_ffmpeg_processes', 'Số tiến trình FFmpeg phát nhạc đang chạy.', ffmpeg_stats['active'])
+    writer.counter('musicbot_ffmpeg_spawned', 'Số tiến trình FFmpeg đã khởi chạy.', ffmpeg_stats['spawned'])
+    writer.counter('musicbot_ffmpeg_exits', 'Số tiến trình FFmpeg đã kết thúc theo lý do.', [
+        ({'reason': reason}, count) for reason, count in sorted(ffmpeg_stats['exit_reasons'].items(), key=str)
+    ])
+
+    writer.histogram('musicbot_track_start_seconds', 'Thời gian từ lúc yêu cầu phát đến gói âm thanh đầu tiên.', track_start_latency)
+    loop_stats = bot.loop_monitor.stats()
+    writer.histogram('musicbot_event_loop_lag_seconds', 'Độ trễ lập lịch của event loop.', loop_stats['lag'])
+    writer.counter('musicbot_event_loop_stalls', 'Số lần event loop bị chặn quá ngưỡng.', loop_stats['stalls'])
+    writer.histogram('musicbot_voice_frame_interval_seconds', 'Khoảng cách giữa hai lần gửi gói thoại (mọi server).',
+                     Histogram.merged(player.voice_timing.intervals for player in players))
+    writer.counter('musicbot_voice_frames', 'Số gói thoại đã gửi.', sum(player.voice_timing.frames for player in players))
+    writer.counter('musicbot_voice_late_frames', 'Số gói thoại bị trễ.', sum(player.voice_timing.late_frames for player in players))
+    return writer.render()
+
+class MetricsServer:
+    """
+    Máy chủ HTTP (aiohttp) phục vụ GET /metrics cho Prometheus.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def _handle_metrics(self, request):
+        return web.Response(
+            body=render_metrics().encode(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Trang metrics: http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+# -----------------------------#
+#        Định Nghĩa Bot         #
+# -----------------------------#
+
+PRESENCE_ROTATE_SECONDS = float(os.getenv('PRESENCE_ROTATE_SECONDS', '30'))
+PRESENCE_MIN_INTERVAL = float(os.getenv('PRESENCE_MIN_INTERVAL', '15'))
+
+class PresenceScheduler:
+    """
+    Cập nhật trạng thái (presence) của bot từ một tác vụ nền duy nhất, tổng hợp trên tất cả các guild.
+    Các sự kiện của từng guild chỉ đánh dấu trạng thái đã đổi; presence được gửi tối đa một lần
+    mỗi PRESENCE_MIN_INTERVAL giây, xoay vòng mỗi PRESENCE_ROTATE_SECONDS giây và bỏ qua nếu không đổi.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self._changed = asyncio.Event()
+        self._task = None
+        self._rotation = 0
+        self._last_rotation = time.monotonic()
+        self._current = None
+        self._last_update = 0.0
+        self.updates = 0
+        self.skipped = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self):
+        """
+        Báo trạng thái phát nhạc của một guild đã thay đổi.
+        """
+        self._changed.set()
+
+    def build_activity(self):
+        """
+        Chọn presence từ trạng thái của tất cả các guild; trả về (loại, nội dung).
+        """
+        playing = sorted(
+            (player for player in self.bot.music_players.values() if player.current_song and player.voice_client),
+            key=lambda player: player.guild_id
+        )
+        if not playing:
+            return discord.ActivityType.listening, "!play + Tên Bài Hát"
+        if len(playing) == 1:
+            return discord.ActivityType.playing, f": {playing[0].current_song.title}"
+        # Nhiều guild: xoay vòng giữa tổng số server và tên từng bài đang phát
+        candidates = [(discord.ActivityType.listening, f"nhạc ở {len(playing)} server")]
+        candidates += [(discord.ActivityType.playing, f": {player.current_song.title}") for player in playing]
+        return candidates[self._rotation % len(candidates)]
+
+    def advance_rotation(self):
+        """
+        Chuyển sang presence kế tiếp nếu đã đủ PRESENCE_ROTATE_SECONDS kể từ lần xoay trước,
+        bất kể trong lúc đó có bao nhiêu lần notify. Trả về số giây còn lại tới lần xoay kế tiếp.
+        """
+        now = time.monotonic()
+        if now - self._last_rotation >= PRESENCE_ROTATE_SECONDS:
+            self._rotation += 1
+            self._last_rotation = now
+        return self._last_rotation + PRESENCE_ROTATE_SECONDS - now
+
+    async def apply(self):
+        activity_type, name = self.build_activity()
+        if (activity_type, name) == self._current:
+            self.skipped += 1
+            return
+        await self.bot.change_presence(activity=discord.Activity(type=activity_type, name=name))
+        self._current = (activity_type, name)
+        self._last_update = time.monotonic()
+        self.updates += 1
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        while True:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=self.advance_rotation())
+            except asyncio.TimeoutError:
+                pass
+            self.advance_rotation()
+            # Giữ khoảng cách tối thiểu giữa hai lần gửi presence lên gateway
+            wait = self._last_update + PRESENCE_MIN_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._changed.clear()
+            try:
+                await self.apply()
+            except Exception as e:
+                logger.error(f"Lỗi khi cập nhật trạng thái bot: {e}")
+
+    def stats(self):
+        return {"updates": self.updates, "skipped": self.skipped}
+
+class MyBot(commands.AutoShardedBot):
+    """
+    Lớp Bot kế thừa từ commands.AutoShardedBot để quản lý các chức năng bot.
+    Mỗi shard có kết nối gateway riêng; một tiến trình có thể chỉ chạy một phần shard (SHARD_IDS).
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.youtube_api = YouTubeAPI(YOUTUBE_API_KEY)
+        self.music_players = {}  # Dictionary để quản lý MusicPlayer cho từng guild
+        self.warm_task = None  # Tác vụ nạp sẵn kết quả phân giải khi khởi động
+        self.presence = PresenceScheduler(self)  # Cập nhật trạng thái bot chung cho mọi guild
+        self.loop_monitor = LoopLagMonitor()  # Đo độ trễ event loop và ghi stack khi bị chặn
+        self.metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+        self.reaper_task = None  # Tác vụ giải phóng các MusicPlayer không hoạt động
+        self.player_stats = Counter()  # Số MusicPlayer đã giải phóng/khôi phục
+
+    async def setup_hook(self):
+        """
+        Hook để khởi tạo các tài nguyên cần thiết khi bot đã sẵn sàng.
+        """
+        await self.youtube_api.init_session()
+        extraction_scheduler.start()
+        if LOOP_LAG_INTERVAL > 0:
+            self.loop_monitor.start()
+        if self.metrics_server:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"Không thể mở trang metrics trên {METRICS_HOST}:{METRICS_PORT}: {e}")
+        if audio_worker_pool:
+            audio_worker_pool.start()
+        self.presence.start()
+        if PLAYER_IDLE_TIMEOUT > 0:
+            self.reaper_task = asyncio.create_task(reap_idle_players())
+        if disk_audio_cache:
+            await asyncio.to_thread(disk_audio_cache.load)
+        if resolution_store:
+            # Không chặn quá trình khởi động; các bài chưa nạp vẫn được đọc theo nhu cầu
+            self.warm_task = asyncio.create_task(warm_stream_cache())
+
+    async def close(self):
+        """
+        Đóng các tài nguyên khi bot tắt.
+        """
+        await self.presence.close()
+        await self.loop_monitor.close()
+        if self.metrics_server:
+            await self.metrics_server.close()
+        if self.reaper_task:
+            self.reaper_task.cancel()
+        await self.youtube_api.close()
+        await extraction_scheduler.close()
+        if audio_worker_pool:
+            await asyncio.to_thread(audio_worker_pool.close)
+        get_ydl_pool().close()
+        for player in self.music_players.values():
+            spill = player.history.flush()
+            if spill:
+                await spill
+        if disk_audio_cache:
+            await disk_audio_cache.flush()
+        if resolution_store:
+            await asyncio.to_thread(resolution_store.close)
+        await super().close()
+
+    def shard_for_guild(self, guild_id):
+        """
+        Shard phụ trách một guild (theo công thức của Discord).
+        """
+        return (guild_id >> 22) % (self.shard_count or 1)
+
+    def shard_stats(self):
+        """
+        Chỉ số của từng shard trong tiến trình: độ trễ gateway, số guild, số kết nối thoại và MusicPlayer.
+        """
+        stats = {
+            shard_id: {'latency': shard.latency, 'closed': shard.is_closed(), 'guilds': 0, 'voice': 0, 'players': 0}
+            for shard_id, shard in self.shards.items()
+        }
+        for guild in self.guilds:
+            if guild.shard_id in stats:
+                stats[guild.shard_id]['guilds'] += 1
+        for voice_client in self.voice_clients:
+            shard_id = voice_client.guild.shard_id
+            if shard_id in stats:
+                stats[shard_id]['voice'] += 1
+        for guild_id in self.music_players:
+            shard_id = self.shard_for_guild(guild_id)
+            if shard_id in stats:
+                stats[shard_id]['players'] += 1
+        return stats
+
+# Instantiate the bot after defining classes
+bot = MyBot(command_prefix='!', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+
+@bot.before_invoke
+async def bind_command_shard(ctx):
+    """
+    Gắn shard của guild vào log của lệnh (và các tác vụ được tạo ra từ lệnh).
+    """
+    if ctx.guild:
+        current_shard.set(ctx.guild.shard_id)
+
+# Helper function to get or create MusicPlayer for a guild
+async def get_music_player(guild_id, text_channel):
+    """
+    Lấy hoặc tạo MusicPlayer cho một guild cụ thể.
+    """
+    music_player = await find_music_player(guild_id, text_channel)
+    if music_player is None:
+        music_player = bot.music_players[guild_id] = MusicPlayer(guild_id, text_channel)
+    music_player.touch()
+    return music_player
+
+def player_state_path(guild_id):
+    return os.path.join(PLAYER_STATE_DIR, f"{guild_id}.json")
+
+async def find_music_player(guild_id, text_channel=None):
+    """
+    Lấy MusicPlayer của guild; nếu đã bị giải phóng thì khôi phục từ trạng thái đã lưu (nếu có).
+    Trả về None nếu guild chưa có MusicPlayer.
+    """
+    music_player = bot.music_players.get(guild_id)
+    if music_player or not PLAYER_STATE_DIR:
+        return music_player
+    try:
+        # Đọc file trong luồng riêng để không chặn event loop khi đĩa chậm
+        state = await asyncio.to_thread(read_player_state, guild_id)
+    except FileNotFoundError:
+        return bot.music_players.get(guild_id)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Không thể đọc trạng thái đã lưu của guild {guild_id}: {e}")
+        return bot.music_players.get(guild_id)
+    # Trong lúc chờ đọc file, một lệnh khác có thể đã tạo MusicPlayer cho guild
+    music_player = bot.music_players.get(guild_id)
+    if music_player or state is None:
+        return music_player
+    text_channel = text_channel or bot.get_channel(state.get("text_channel_id") or 0)
+    music_player = bot.music_players[guild_id] = MusicPlayer(guild_id, text_channel)
+    music_player.restore_state(state)
+    bot.player_stats['restored'] += 1
+    logger.info(f"Đã khôi phục MusicPlayer cho guild {guild_id} ({len(music_player.music_queue)} bài trong hàng đợi).")
+    return music_player
+
+def read_player_state(guild_id):
+    """
+    Đọc và xóa trạng thái đã lưu của guild. Trả về None nếu trạng thái đã quá hạn lưu giữ.
+    """
+    path = player_state_path(guild_id)
+    state = None
+    if time.time() - os.path.getmtime(path) < PLAYER_STATE_RETENTION:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    os.remove(path)
+    return state
+
+def write_player_state(guild_id, state):
+    path = player_state_path(guild_id)
+    os.makedirs(PLAYER_STATE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+async def evict_music_player(guild_id):
+    """
+    Giải phóng MusicPlayer của guild, lưu hàng đợi và lịch sử xuống đĩa nếu được bật.
+    """
+    music_player = bot.music_players.pop(guild_id, None)
+    if not music_player:
+        return
+    for task in (music_player.disconnect_task, music_player.prefetch_task):
+        if task and not task.done():
+            task.cancel()
+    discard_prepared_source(music_player)
+    music_player.autoplay.close()
+    await music_player.panel.clear()
+    spill = music_player.history.flush()
+    if spill:
+        await spill
+    state = music_player.to_state()
+    if PLAYER_STATE_DIR and (state["queue"] or state["history"]):
+        try:
+            await asyncio.to_thread(write_player_state, guild_id, state)
+        except OSError as e:
+            logger.warning(f"Không thể lưu trạng thái của guild {guild_id}: {e}")
+    bot.player_stats['evicted'] += 1
+    logger.info(f"Đã giải phóng MusicPlayer không hoạt động của guild {guild_id}.")
+
+async def reap_idle_players():
+    """
+    Tác vụ nền: định kỳ giải phóng các MusicPlayer không hoạt động quá PLAYER_IDLE_TIMEOUT giây.
+    """
+    while True:
+        await asyncio.sleep(PLAYER_REAP_INTERVAL)
+        now = time.monotonic()
+        idle = [guild_id for guild_id, player in bot.music_players.items() if player.is_idle(now, PLAYER_IDLE_TIMEOUT)]
+        for guild_id in idle:
+            try:
+                await evict_music_player(guild_id)
+            except Exception as e:
+                logger.error(f"Lỗi khi giải phóng MusicPlayer của guild {guild_id}: {e}")
+
+# -----------------------------#
+#    Định Nghĩa Các Lớp UI      #
+# -----------------------------#
+
+class MusicControlView(View):
+    """
+    Lớp View để quản lý các nút điều khiển nhạc (Pause, Resume, Skip, Loop).
+    """
+    def __init__(self, music_player):
+        super().__init__(timeout=None)
+        self.music_player = music_player
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        # Gắn shard của guild vào log của các nút bấm
+        current_shard.set(bot.shard_for_guild(self.music_player.guild_id))
+        return True
+
+    @discord.ui.button(label="Tạm Dừng", style=discord.ButtonStyle.primary, emoji="⏸️")
+    async def pause(self, interaction: discord.Interaction, button: Button):
+        try:
+            if self.music_player.voice_client and self.music_player.voice_client.is_playing():
+                self.music_player.voice_client.pause()
+                self.music_player.is_paused = True
+                await interaction.response.send_message("⏸️ Nhạc đã tạm dừng!", ephemeral=True)
+                await send_control_panel(self.music_player)
+            else:
+                await interaction.response.send_message("❗ Không có nhạc nào đang phát.", ephemeral=True)
+        except Exception as e:
+            logger.error(f"Lỗi trong nút Tạm Dừng: {e}")
+            await interaction.response.send_message("❗ Đã xảy ra lỗi khi tạm dừng nhạc.", ephemeral=True)
+
+    @discord.ui.button(label="Tiếp Tục", style=discord.ButtonStyle.success, emoji="▶️")
+    async def resume(self, interaction: discord.Interaction, button: Button):
+        try:
+            if self.music_player.voice_client and self.music_player.is_paused:
+                self.music_player.voice_client.resume()
+                self.music_player.is_paused = False
+                await interaction.response.send_message("▶️ Nhạc đã tiếp tục!", ephemeral=True)
+                await send_control_panel(self.music_player)
+            else:
+                await interaction.response.send_message("❗ Không có nhạc nào đang tạm dừng.", ephemeral=True)
+        except Exception as e:
+            logger.error(f"Lỗi trong nút Tiếp Tục: {e}")
+            await interaction.response.send_message("❗ Đã xảy ra lỗi khi tiếp tục nhạc.", ephemeral=True)
+
+    @discord.ui.button(label="Bỏ Qua", style=discord.ButtonStyle.danger, emoji="⏭️")
+    async def skip(self, interaction: discord.Interaction, button: Button):
+        try:
+            if self.music_player.voice_client and self.music_player.voice_client.is_playing():
+                self.music_player.voice_client.stop()
+                await interaction.response.send_message("⏭️ Đã bỏ qua bài hát!", ephemeral=True)
+            else:
+                await interaction.response.send_message("❗ Không có nhạc nào đang phát.", ephemeral=True)
+        except Exception as e:
+            logger.error(f"Lỗi trong nút Bỏ Qua: {e}")
+            await interaction.response.send_message("❗ Đã xảy ra lỗi khi bỏ qua nhạc.", ephemeral=True)
+
+    @discord.ui.button(label="Lặp Bài Hát", style=discord.ButtonStyle.secondary, emoji="🔁")
+    async def loop(self, interaction: discord.Interaction, button: Button):
+        try:
+            self.music_player.is_looping = not self.music_player.is_looping
+            state = "bật" if self.music_player.is_looping else "tắt"
+            await interaction.response.send_message(f"🔁 Lặp bài hát đã {state}!", ephemeral=True)
+            await send_control_panel(self.music_player)
+        except Exception as e:
+            logger.error(f"Lỗi trong nút Lặp Bài Hát: {e}")
+            await interaction.response.send_message("❗ Đã xảy ra lỗi khi thay đổi chế độ lặp.", ephemeral=True)
+
+    @discord.ui.button(label="Trang Trước", style=discord.ButtonStyle.secondary, emoji="⬅️", row=1)
+    async def previous_page(self, interaction: discord.Interaction, button: Button):
+        try:
+            await self.music_player.panel.turn_page(interaction, -1)
+        except Exception as e:
+            logger.error(f"Lỗi trong nút Trang Trước: {e}")
+            await interaction.response.send_message("❗ Đã xảy ra lỗi khi chuyển trang hàng đợi.", ephemeral=True)
+
+    @discord.ui.button(label="Trang Sau", style=discord.ButtonStyle.secondary, emoji="➡️", row=1)
+    async def next_page(self, interaction: discord.Interaction, button: Button):
+        try:
+            await self.music_player.panel.turn_page(interaction, 1)
+        except Exception as e:
+            logger.error(f"Lỗi trong nút Trang Sau: {e}")
+            await interaction.response.send_message("❗ Đã xảy ra lỗi khi chuyển trang hàng đợi.", ephemeral=True)
+
+    def sync_pages(self, page, pages):
+        """
+        Ẩn nút chuyển trang khi hàng đợi chỉ có một trang, vô hiệu hóa nút ở trang đầu/cuối.
+        """
+        for button, disabled in ((self.previous_page, page <= 0), (self.next_page, page >= pages - 1)):
+            if pages <= 1:
+                if button in self.children:
+                    self.remove_item(button)
+                continue
+            if button not in self.children:
+                self.add_item(button)
+            button.disabled = disabled
+
+PANEL_DEBOUNCE_SECONDS = float(os.getenv('PANEL_DEBOUNCE_SECONDS', '1.0'))
+
+class ControlPanelRenderer:
+    """
+    Hiển thị bảng điều khiển của một guild: gom các thay đổi trạng thái trong khoảng PANEL_DEBOUNCE_SECONDS,
+    sửa trực tiếp tin nhắn hiện có thay vì xóa rồi gửi lại, và bỏ qua nếu nội dung không đổi.
+    """
+    def __init__(self, music_player):
+        self.music_player = music_player
+        self.message = None
+        self.view = None
+        self._last_rendered = None
+        self._dirty = False
+        self._task = None
+        self._lock = asyncio.Lock()
+        self.queue_page = 0  # Trang hàng đợi đang xem (bắt đầu từ 0)
+        self._rest_calls = deque()  # Thời điểm các lần gọi REST trong 60 giây gần nhất
+        self.rest_calls = 0
+        self.renders = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    def request_update(self):
+        """
+        Đánh dấu cần vẽ lại; lần vẽ thực sự diễn ra sau khoảng debounce.
+        """
+        if self._dirty:
+            self.coalesced += 1
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self._dirty:
+                await asyncio.sleep(PANEL_DEBOUNCE_SECONDS)
+                self._dirty = False
+                await self.flush()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Lỗi khi cập nhật bảng điều khiển cho guild {self.music_player.guild_id}: {e}")
+
+    def _record_rest_call(self):
+        now = time.monotonic()
+        self._rest_calls.append(now)
+        self.rest_calls += 1
+        while self._rest_calls and now - self._rest_calls[0] > 60:
+            self._rest_calls.popleft()
+
+    def rest_calls_per_minute(self):
+        """
+        Số lần gọi REST (gửi/sửa/xóa tin nhắn) trong 60 giây gần nhất.
+        """
+        now = time.monotonic()
+        while self._rest_calls and now - self._rest_calls[0] > 60:
+            self._rest_calls.popleft()
+        return len(self._rest_calls)
+
+    async def flush(self):
+        """
+        Vẽ bảng điều khiển ngay: sửa tin nhắn cũ nếu còn, ngược lại gửi tin nhắn mới.
+        """
+        async with self._lock:
+            embed = self._render()
+            rendered = embed.to_dict()
+            if self.message and rendered == self._last_rendered:
+                self.skipped += 1
+                return
+            if self.message:
+                try:
+                    self._record_rest_call()
+                    await self.message.edit(embed=embed, view=self.view)
+                except discord.NotFound:
+                    self.message = None
+            if not self.message:
+                self._record_rest_call()
+                self.message = await self.music_player.text_channel.send(embed=embed, view=self.view)
+            self._last_rendered = rendered
+            self.renders += 1
+        bot.presence.notify()
+
+    def _render(self):
+        # Giữ trang đang xem trong phạm vi khi hàng đợi ngắn lại
+        pages = queue_page_count(self.music_player.music_queue)
+        self.queue_page = max(0, min(self.queue_page, pages - 1))
+        if self.view is None:
+            self.view = MusicControlView(self.music_player)
+        self.view.sync_pages(self.queue_page, pages)
+        return build_control_embed(self.music_player)
+
+    async def turn_page(self, interaction, step):
+        """
+        Chuyển trang hàng đợi từ nút bấm: sửa tin nhắn qua phản hồi tương tác, không chờ debounce.
+        """
+        async with self._lock:
+            self.queue_page += step
+            embed = self._render()
+            await interaction.response.edit_message(embed=embed, view=self.view)
+            self._last_rendered = embed.to_dict()
+            self.renders += 1
+
+    async def clear(self):
+        """
+        Hủy các lần vẽ đang chờ và xóa tin nhắn bảng điều khiển.
+        """
+        self._dirty = False
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._task = None
+        async with self._lock:
+            if self.message:
+                try:
+                    self._record_rest_call()
+                    await self.message.delete()
+                except discord.NotFound:
+                    pass
+                except Exception as e:
+                    logger.error(f"Lỗi khi xóa control message: {e}")
+            self.message = None
+            self._last_rendered = None
+            self.queue_page = 0
+            if self.view:
+                self.view.stop()
+                self.view = None
+
+class SongSelect(Select):
+    """
+    Lớp Select để người dùng chọn bài hát từ kết quả tìm kiếm.
+    """
+    def __init__(self, music_player, songs, user_voice_channel):
+        options = [
+            discord.SelectOption(
+                label=truncate_label(f"{idx + 1}. {song['title']} - {song['duration']}", 100),
+                value=str(idx)
+            ) for idx, song in enumerate(songs)
+        ]
+        super().__init__(
+            placeholder="Chọn bài hát bạn muốn phát...",
+            min_values=1,
+            max_values=1,
+            options=options
+        )
+        self.music_player = music_player
+        self.songs = songs
+        self.user_voice_channel = user_voice_channel
+
+    async def callback(self, interaction: discord.Interaction):
+        try:
+            selected_index = int(self.values[0])
+            selected_song = self.songs[selected_index]
+            await interaction.response.defer()
+            await interaction.message.delete()
+            await process_song_selection_from_selection(self.music_player, selected_song, self.user_voice_channel)
+        except Exception as e:
+            logger.error(f"Lỗi trong SongSelect callback: {e}")
+            await interaction.response.send_message("❗ Đã xảy ra lỗi khi chọn bài hát.", ephemeral=True)
+
+class SongSelectionView(View):
+    """
+    Lớp View chứa Select để chọn bài hát.
+    """
+    def __init__(self, music_player, songs, user_voice_channel):
+        super().__init__(timeout=60)
+        self.music_player = music_player
+        self.songs = songs
+        self.user_voice_channel = user_voice_channel
+        self.add_item(SongSelect(music_player, songs, user_voice_channel))
+
+    async def on_timeout(self):
+        try:
+            await self.message.edit(content="⏰ Thời gian chọn bài hát đã hết.", view=None)
+        except Exception as e:
+            logger.error(f"Lỗi khi timeout SongSelectionView: {e}")
+
+    async def send(self, message):
+        self.message = await message.edit(view=self)
+
+# -----------------------------#
+#     Giám Sát Tiến Trình FFmpeg #
+# -----------------------------#
+
+FFMPEG_MAX_PROCESSES = int(os.getenv('FFMPEG_MAX_PROCESSES', '0'))  # Số luồng FFmpeg tối đa trên toàn máy (0 = không giới hạn)
+FFMPEG_SLOT_DIR = os.getenv('FFMPEG_SLOT_DIR', os.path.join(tempfile.gettempdir(), 'musicbot-ffmpeg-slots'))
+FFMPEG_SLOT_WAIT = float(os.getenv('FFMPEG_SLOT_WAIT', '15'))  # Chờ tối đa bao lâu khi đã đủ luồng
+FFMPEG_SLOT_POLL_INTERVAL = 0.5
+FFMPEG_STDERR_TAIL_BYTES = 4096
+FFMPEG_USAGE_SAMPLE_FRAMES = 250  # Đọc CPU/RSS mỗi 250 gói (~5 giây phát)
+FFMPEG_EXIT_WAIT = 2.0            # Chờ FFmpeg tự thoát sau khi đã đọc hết dữ liệu trước khi phân loại
+FFMPEG_HTTP_403 = re.compile(r'HTTP error 403|Server returned 403 Forbidden')
+FFMPEG_HTTP_404 = re.compile(r'HTTP error 404|Server returned 404')
+FFMPEG_BUSY_MESSAGE = "🚦 Máy chủ đang phát quá nhiều luồng cùng lúc, vui lòng thử lại sau ít phút."
+
+class FFmpegCapacityError(Exception):
+    """
+    Đã đạt giới hạn số tiến trình FFmpeg trên máy và hết thời gian chờ.
+    """
+
+class HostSlot:
+    """
+    Một chỗ trong giới hạn FFmpeg toàn máy: giữ khóa flock trên file slot-N.lock.
+    Khóa tự được nhả khi đóng file, kể cả khi tiến trình bot bị dừng đột ngột.
+    """
+    def __init__(self, limiter, index, fd=None):
+        self.limiter = limiter
+        self.index = index
+        self._fd = fd
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.limiter._release(self)
+
+class HostSlotLimiter:
+    """
+    Giới hạn số luồng FFmpeg đồng thời trên toàn máy (dùng chung giữa các tiến trình bot qua fcntl.flock).
+    Khi không có fcntl, chỉ giới hạn trong tiến trình hiện tại.
+    """
+    def __init__(self, limit, directory):
+        self.limit = limit
+        self.directory = directory
+        self._local = set()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            for index in range(self.limit):
+                if index in self._local:
+                    continue
+                fd = None
+                if fcntl:
+                    os.makedirs(self.directory, exist_ok=True)
+                    fd = os.open(os.path.join(self.directory, f"slot-{index}.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        os.close(fd)
+                        continue  # Đang được tiến trình khác dùng
+                self._local.add(index)
+                return HostSlot(self, index, fd)
+        return None
+
+    def _release(self, slot):
+        with self._lock:
+            self._local.discard(slot.index)
+            if slot._fd is not None:
+                os.close(slot._fd)
+
+class StderrTail:
+    """
+    Nhận stderr của FFmpeg (qua thread đọc của discord.py) và chỉ giữ phần cuối để xác định lý do thoát.
+    """
+    def __init__(self, limit=FFMPEG_STDERR_TAIL_BYTES):
+        self.limit = limit
+        self.data = b''
+
+    def write(self, chunk):
+        self.data = (self.data + chunk)[-self.limit:]
+
+    def text(self):
+        return self.data.decode(errors='ignore').strip()
+
+def read_proc_usage(pid):
+    """
+    Đọc thời gian CPU (giây) và RSS (byte) của một tiến trình từ /proc; (None, None) nếu không đọc được.
+    Vẫn đọc được khi tiến trình đã thoát nhưng chưa được thu hồi (zombie).
+    """
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu = (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+        rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        return cpu, rss
+    except (OSError, IndexError, ValueError):
+        return None, None
+
+def classify_ffmpeg_exit(returncode, stderr_text, stopped):
+    """
+    Phân loại lý do FFmpeg kết thúc từ mã thoát và stderr.
+    """
+    if stopped and returncode in (None, -9, -15):
+        return 'stopped'
+    if returncode == 0:
+        return 'eof'
+    if FFMPEG_HTTP_403.search(stderr_text):
+        return 'http_403'
+    if FFMPEG_HTTP_404.search(stderr_text):
+        return 'http_404'
+    text = stderr_text.lower()
+    if any(word in text for word in ('timed out', 'connection reset', 'connection refused', 'network', 'i/o error')):
+        return 'network'
+    if 'invalid data' in text or 'could not find codec' in text:
+        return 'invalid_data'
+    return f'exit_{returncode}'
+
+class FFmpegProcessInfo:
+    """
+    Thông tin theo dõi của một tiến trình FFmpeg phát nhạc.
+    """
+    __slots__ = ('pid', 'label', 'mode', 'started_at', 'bytes_read', 'cpu_seconds', 'rss_bytes',
+                 'returncode', 'reason', 'stderr', 'ended_at')
+
+    def __init__(self, label, mode):
+        self.pid = None
+        self.label = label
+        self.mode = mode
+        self.started_at = time.time()
+        self.bytes_read = 0
+        self.cpu_seconds = None
+        self.rss_bytes = None
+        self.returncode = None
+        self.reason = None
+        self.stderr = StderrTail()
+        self.ended_at = None
+
+class FFmpegSupervisor:
+    """
+    Theo dõi mọi tiến trình FFmpeg phát nhạc (thời điểm bắt đầu, số byte đã đọc, CPU/RSS, lý do thoát)
+    và áp dụng giới hạn số luồng trên toàn máy (FFMPEG_MAX_PROCESSES).
+    """
+    def __init__(self, limit, slot_dir):
+        self.limiter = HostSlotLimiter(limit, slot_dir) if limit > 0 else None
+        self.active = {}
+        self.finished = deque(maxlen=50)
+        self.exit_reasons = Counter()
+        self.spawned = 0
+        self.rejected = 0
+        self.waited = 0
+        self.log_exits = True  # Tắt trong tiến trình worker âm thanh (tiến trình chính ghi log thay)
+        self._lock = threading.Lock()
+
+    async def acquire_slot(self, wait=FFMPEG_SLOT_WAIT):
+        """
+        Lấy một chỗ trong giới hạn toàn máy, chờ tối đa wait giây. Trả về None nếu không giới hạn.
+        """
+        if not self.limiter:
+            return None
+        slot = self.limiter.try_acquire()
+        if slot:
+            return slot
+        self.waited += 1
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            await asyncio.sleep(FFMPEG_SLOT_POLL_INTERVAL)
+            slot = self.limiter.try_acquire()
+            if slot:
+                return slot
+        self.rejected += 1
+        raise FFmpegCapacityError(f"Đã đạt giới hạn {self.limiter.limit} tiến trình FFmpeg")
+
+    def started(self, info):
+        with self._lock:
+            self.active[info.pid] = info
+            self.spawned += 1
+
+    def ended(self, info):
+        with self._lock:
+            self.active.pop(info.pid, None)
+            self.finished.append(info)
+            self.exit_reasons[info.reason] += 1
+        if self.log_exits and info.reason not in ('eof', 'stopped'):
+            logger.warning(
+                f"FFmpeg (pid {info.pid}, {info.label}) kết thúc bất thường: {info.reason} - {info.stderr.text()[-200:]}"
+            )
+
+    def snapshot(self):
+        """
+        Danh sách tiến trình đang chạy kèm CPU/RSS hiện tại (đọc từ /proc).
+        """
+        with self._lock:
+            active = list(self.active.values())
+        for info in active:
+            cpu_seconds, rss_bytes = read_proc_usage(info.pid)
+            if cpu_seconds is not None:
+                info.cpu_seconds, info.rss_bytes = cpu_seconds, rss_bytes
+        return active
+
+    def stats(self):
+        active = self.snapshot()
+        return {
+            'active': len(active),
+            'limit': self.limiter.limit if self.limiter else 0,
+            'spawned': self.spawned,
+            'waited': self.waited,
+            'rejected': self.rejected,
+            'cpu_seconds': sum(info.cpu_seconds or 0 for info in active),
+            'rss_bytes': sum(info.rss_bytes or 0 for info in active),
+            'bytes_read': sum(info.bytes_read for info in active),
+            'exit_reasons': dict(self.exit_reasons),
+        }
+
+ffmpeg_supervisor = FFmpegSupervisor(FFMPEG_MAX_PROCESSES, FFMPEG_SLOT_DIR)
+
+class SupervisedOpusAudio(discord.FFmpegOpusAudio):
+    """
+    FFmpegOpusAudio được FFmpegSupervisor theo dõi: đếm byte đã đọc, giữ phần cuối stderr,
+    ghi CPU/RSS và lý do thoát khi dọn dẹp, rồi nhả chỗ trong giới hạn toàn máy.
+    """
+    def __init__(self, source, *, info, slot=None, **kwargs):
+        self.info = info
+        self.slot = slot
+        self._finalized = False
+        self._cleanup_lock = threading.Lock()  # cleanup có thể được gọi đồng thời từ nhiều thread
+        self._frames = 0
+        self._eof = False
+        super().__init__(source, stderr=info.stderr, **kwargs)
+        info.pid = self._process.pid
+        ffmpeg_supervisor.started(info)
+
+    def read(self):
+        # Lấy mẫu CPU/RSS định kỳ vì khi hết dữ liệu discord.py đã thu hồi tiến trình (không còn /proc)
+        self._frames += 1
+        if self._frames % FFMPEG_USAGE_SAMPLE_FRAMES == 0:
+            self._sample_usage()
+        data = super().read()
+        if not data:
+            self._eof = True
+        self.info.bytes_read += len(data)
+        return data
+
+    def _sample_usage(self):
+        cpu_seconds, rss_bytes = read_proc_usage(self.info.pid)
+        if cpu_seconds is not None:
+            self.info.cpu_seconds, self.info.rss_bytes = cpu_seconds, rss_bytes
+
+    def cleanup(self):
+        with self._cleanup_lock:
+            if not self._finalized:
+                self._finalized = True
+                self._finalize()
+
+    def _finalize(self):
+        info = self.info
+        process = self._process
+        self._sample_usage()
+        returncode = process.poll() if process else None
+        if process and returncode is None and self._eof:
+            # Đã đọc hết dữ liệu nhưng FFmpeg chưa kịp thoát: chờ mã thoát thật thay vì coi là bị dừng
+            with contextlib.suppress(subprocess.TimeoutExpired):
+                returncode = process.wait(timeout=FFMPEG_EXIT_WAIT)
+        stopped = returncode is None
+        try:
+            super().cleanup()
+        finally:
+            if process and returncode is None:
+                returncode = process.returncode
+            info.returncode = returncode
+            info.ended_at = time.time()
+            info.reason = classify_ffmpeg_exit(returncode, info.stderr.text(), stopped)
+            ffmpeg_supervisor.ended(info)
+            if self.slot:
+                self.slot.release()
+
+# -----------------------------#
+#    Tiến Trình Worker Âm Thanh #
+# -----------------------------#
+
+AUDIO_WORKERS = int(os.getenv('AUDIO_WORKERS', '0'))  # Số tiến trình chạy FFmpeg và đọc gói Opus (0 = trong tiến trình bot)
+AUDIO_WORKER_WINDOW = int(os.getenv('AUDIO_WORKER_WINDOW', '250'))  # Số gói worker được gửi trước (250 gói = 5 giây)
+AUDIO_WORKER_BATCH = 10          # Số gói gom trong một tin nhắn IPC
+AUDIO_WORKER_CREDIT_STEP = 50    # Trả lại quyền gửi sau mỗi 50 gói đã phát
+AUDIO_WORKER_STALL_TIMEOUT = 10  # Kết thúc bài nếu worker không gửi gói nào trong 10 giây
+
+class AudioWorkerJob:
+    """
+    Một bài đang phát trong tiến trình worker: chạy FFmpeg, đọc gói Opus và gửi về tiến trình bot
+    theo từng lô, chỉ khi còn quyền gửi (credit) để bộ đệm phía bot không tăng vô hạn.
+    """
+    def __init__(self, job_id, source, ffmpeg_kwargs, label, mode, window, send):
+        self.job_id = job_id
+        self.source = source
+        self.ffmpeg_kwargs = ffmpeg_kwargs
+        self.info = FFmpegProcessInfo(label, mode)
+        self.credits = window
+        self.send = send
+        self.audio = None
+        self.stopped = False
+        self._cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name=f'audio-job-{job_id}', daemon=True)
+
+    def grant(self, credits):
+        with self._cond:
+            self.credits += credits
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self.stopped = True
+            self._cond.notify()
+        if self.audio:
+            self.audio.cleanup()  # Dừng FFmpeg để read() đang chờ trả về ngay
+
+    def _run(self):
+        try:
+            self.audio = SupervisedOpusAudio(self.source, info=self.info, **self.ffmpeg_kwargs)
+        except Exception as e:
+            self.send(('end', self.job_id, {'reason': 'spawn_failed', 'stderr': str(e)}))
+            return
+        self.send(('started', self.job_id, self.info.pid))
+        try:
+            while True:
+                with self._cond:
+                    while self.credits <= 0 and not self.stopped:
+                        self._cond.wait()
+                    if self.stopped:
+                        break
+                    count = min(self.credits, AUDIO_WORKER_BATCH)
+                frames = []
+                for _ in range(count):
+                    data = self.audio.read()
+                    if not data:
+                        break
+                    frames.append(data)
+                if frames:
+                    with self._cond:
+                        self.credits -= len(frames)
+                    self.send(('frames', self.job_id, frames))
+                if len(frames) < count:
+                    break  # Hết dữ liệu hoặc FFmpeg đã dừng
+        finally:
+            self.audio.cleanup()
+            info = self.info
+            self.send(('end', self.job_id, {
+                'returncode': info.returncode,
+                'reason': info.reason,
+                'cpu_seconds': info.cpu_seconds,
+                'rss_bytes': info.rss_bytes,
+                'bytes_read': info.bytes_read,
+                'stderr': info.stderr.text(),
+            }))
+
+def audio_worker_main(conn):
+    """
+    Vòng lặp của tiến trình worker âm thanh: nhận lệnh open/credit/close từ tiến trình bot qua Pipe.
+    """
+    configure_process_logging()
+    ffmpeg_supervisor.log_exits = False
+    jobs = {}
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            try:
+                conn.send(message)
+            except (OSError, EOFError):
+                pass  # Tiến trình bot đã đóng kết nối
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        kind, job_id = message[0], message[1]
+        if kind == 'open':
+            # Bỏ các job đã kết thúc trước khi thêm job mới
+            for finished_id in [key for key, job in jobs.items() if not job.thread.is_alive()]:
+                del jobs[finished_id]
+            job = jobs[job_id] = AudioWorkerJob(job_id, *message[2:], send)
+            job.thread.start()
+        elif kind == 'credit':
+            if job_id in jobs:
+                jobs[job_id].grant(message[2])
+        elif kind == 'close':
+            if job_id in jobs:
+                jobs.pop(job_id).stop()
+        elif kind == 'shutdown':
+            break
+    for job in jobs.values():
+        job.stop()
+
+class RemoteOpusSource(discord.AudioSource):
+    """
+    Nguồn Opus của một bài phát trong tiến trình worker: nhận gói qua IPC vào bộ đệm
+    và trả lại quyền gửi cho worker khi voice_client đã phát xong một phần.
+    """
+    def __init__(self, worker, job_id, info, slot=None):
+        self.worker = worker
+        self.job_id = job_id
+        self.info = info
+        self.slot = slot
+        self.ended = False
+        self._closed = False
+        self._frames = deque()
+        self._consumed = 0
+        self._cond = threading.Condition()
+
+    def read(self):
+        with self._cond:
+            if not self._frames and not self.ended:
+                if not self._cond.wait_for(lambda: self._frames or self.ended, AUDIO_WORKER_STALL_TIMEOUT):
+                    self.worker.pool.stalls += 1
+                    logger.warning(f"Worker âm thanh không gửi dữ liệu cho {self.info.label}, kết thúc bài.")
+            if not self._frames:
+                return b''
+            data = self._frames.popleft()
+            self._consumed += 1
+            grant = self._consumed >= AUDIO_WORKER_CREDIT_STEP and not self.ended
+            if grant:
+                self._consumed = 0
+        self.info.bytes_read += len(data)
+        if grant:
+            self.worker.send(('credit', self.job_id, AUDIO_WORKER_CREDIT_STEP))
+        return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._frames.clear()
+            ended = self.ended
+        if not ended:
+            self.worker.send(('close', self.job_id))
+
+    def on_started(self, pid):
+        self.info.pid = pid
+        ffmpeg_supervisor.started(self.info)
+
+    def on_frames(self, frames):
+        with self._cond:
+            if not self._closed:
+                self._frames.extend(frames)
+                self._cond.notify()
+        self.worker.pool.frames += len(frames)
+
+    def on_end(self, result):
+        with self._cond:
+            if self.ended:
+                return
+            self.ended = True
+            self._cond.notify()
+        info = self.info
+        info.returncode = result.get('returncode')
+        info.reason = result.get('reason')
+        info.cpu_seconds = result.get('cpu_seconds')
+        info.rss_bytes = result.get('rss_bytes')
+        info.stderr.write(result.get('stderr', '').encode())
+        info.ended_at = time.time()
+        if info.pid is not None:
+            ffmpeg_supervisor.ended(info)
+        if self.slot:
+            self.slot.release()
+
+class AudioWorker:
+    """
+    Phía tiến trình bot của một worker âm thanh: tiến trình con, Pipe và thread nhận tin nhắn.
+    """
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.jobs = {}
+        self.process = None
+        self.conn = None
+        self._send_lock = threading.Lock()
+
+    def start(self, context):
+        self._fail_jobs()
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=audio_worker_main, args=(child_conn,), name=f'audio-worker-{self.index}', daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        threading.Thread(target=self._receive, args=(self.conn,), name=f'audio-worker-{self.index}-recv', daemon=True).start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def send(self, message):
+        with self._send_lock:
+            try:
+                self.conn.send(message)
+            except (OSError, ValueError) as e:
+                logger.error(f"Không gửi được lệnh tới worker âm thanh {self.index}: {e}")
+
+    def _receive(self, conn):
+        while True:
+            try:
+                kind, job_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            source = self.jobs.get(job_id)
+            if source is None:
+                continue
+            if kind == 'frames':
+                source.on_frames(payload)
+            elif kind == 'started':
+                source.on_started(payload)
+            elif kind == 'end':
+                self.jobs.pop(job_id, None)
+                source.on_end(payload)
+        if conn is self.conn:
+            self._fail_jobs()
+
+    def _fail_jobs(self):
+        # Worker đã thoát: kết thúc các bài đang phát để voice_client chuyển bài
+        for job_id, source in list(self.jobs.items()):
+            self.jobs.pop(job_id, None)
+            source.on_end({'reason': 'worker_lost'})
+
+    def close(self):
+        if self.is_alive():
+            self.send(('shutdown', None))
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+        if self.conn:
+            self.conn.close()
+
+class AudioWorkerPool:
+    """
+    Các tiến trình worker âm thanh: mỗi worker chạy FFmpeg và đọc gói Opus cho nhiều bài, gửi về tiến trình bot
+    qua multiprocessing Pipe. Kết nối thoại (mã hóa, gửi UDP) vẫn ở tiến trình bot vì phiên thoại gắn với phiên gateway.
+    Dùng kiểu khởi tạo 'spawn' để không fork tiến trình bot đang có nhiều thread.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.workers = []
+        self._context = multiprocessing.get_context('spawn')
+        self._job_ids = itertools.count(1)
+        self.opened = 0
+        self.frames = 0
+        self.stalls = 0
+        self.respawned = 0
+
+    def start(self):
+        if self.workers:
+            return
+        self.workers = [AudioWorker(self, index) for index in range(self.size)]
+        for worker in self.workers:
+            worker.start(self._context)
+        logger.info(f"Đã khởi chạy {self.size} worker âm thanh.")
+
+    def _pick_worker(self):
+        if not self.workers:
+            self.start()
+        for worker in self.workers:
+            if not worker.is_alive():
+                logger.warning(f"Worker âm thanh {worker.index} đã dừng, khởi chạy lại.")
+                worker.start(self._context)
+                self.respawned += 1
+        return min(self.workers, key=lambda worker: len(worker.jobs))
+
+    def open(self, info, source, ffmpeg_kwargs, slot=None):
+        """
+        Giao một bài cho worker ít việc nhất và trả về nguồn Opus nhận gói từ worker đó.
+        """
+        worker = self._pick_worker()
+        job_id = next(self._job_ids)
+        remote = RemoteOpusSource(worker, job_id, info, slot)
+        worker.jobs[job_id] = remote
+        worker.send(('open', job_id, source, ffmpeg_kwargs, info.label, info.mode, AUDIO_WORKER_WINDOW))
+        self.opened += 1
+        return remote
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'alive': sum(1 for worker in self.workers if worker.is_alive()),
+            'jobs': [len(worker.jobs) for worker in self.workers],
+            'opened': self.opened,
+            'frames': self.frames,
+            'stalls': self.stalls,
+            'respawned': self.respawned,
+        }
+
+audio_worker_pool = AudioWorkerPool(AUDIO_WORKERS) if AUDIO_WORKERS > 0 else None
+
+# -----------------------------#
+#        Nguồn Âm Thanh         #
+# -----------------------------#
+
+GAPLESS_LEAD_SECONDS = int(os.getenv('GAPLESS_LEAD_SECONDS', '10'))  # Khởi chạy FFmpeg bài kế tiếp trước bao lâu (0 = tắt)
+GAPLESS_PRIME_FRAMES = 50       # Số gói Opus (20ms/gói) đọc sẵn trước khi chuyển bài
+GAPLESS_MAX_AGE = 120           # Bỏ nguồn đã chuẩn bị nếu quá cũ (ví dụ khi tạm dừng lâu)
+
+LOUDNESS_NORMALIZE = os.getenv('LOUDNESS_NORMALIZE', '0') == '1'            # Cân bằng độ lớn giữa các bài
+LOUDNESS_TARGET_LUFS = float(os.getenv('LOUDNESS_TARGET_LUFS', '-14'))       # Độ lớn mục tiêu (EBU R128)
+LOUDNESS_TOLERANCE_DB = 1.5      # Chênh lệch nhỏ hơn mức này thì stream copy, không mã hóa lại
+LOUDNESS_MAX_TRUE_PEAK = -1.0    # Không tăng âm lượng quá mức làm đỉnh vượt -1 dBTP
+LOUDNESS_MAX_ANALYSES = 2        # Số bài được phân tích độ lớn cùng lúc
+LOUDNESS_ANALYSIS_TIMEOUT = 600
+LOUDNORM_JSON_REGEX = re.compile(r'\{[^{}]*"input_i"[^{}]*\}')
+
+ffmpeg_mode_counts = Counter()   # Số nguồn FFmpeg theo chế độ: copy hoặc mã hóa lại (gain)
+
+def compute_gain_db(loudness, volume=100):
+    """
+    Tính mức khuếch đại (dB) cho bài từ kết quả phân tích độ lớn và âm lượng (%) của guild.
+    """
+    gain_db = 0.0
+    if LOUDNESS_NORMALIZE and loudness:
+        integrated, true_peak = loudness
+        gain_db = LOUDNESS_TARGET_LUFS - integrated
+        if true_peak is not None:
+            gain_db = min(gain_db, LOUDNESS_MAX_TRUE_PEAK - true_peak)
+    if volume != 100:
+        gain_db += 20 * math.log10(volume / 100)
+    return gain_db
+
+def ffmpeg_output_options(gain_db=None):
+    """
+    Tùy chọn đầu ra FFmpeg: stream copy nếu không cần đổi âm lượng, ngược lại mã hóa lại với bộ lọc volume.
+    Chỉ ghi lỗi ra stderr để bộ giám sát biết lý do FFmpeg thoát.
+    """
+    if gain_db is None or abs(gain_db) < LOUDNESS_TOLERANCE_DB:
+        return '-vn -c:a copy -loglevel error'  # Stream copy để giảm tải CPU
+    return f'-vn -af volume={gain_db:.2f}dB -c:a libopus -loglevel error'
+
+class LoudnessAnalyzer:
+    """
+    Phân tích độ lớn (EBU R128, bộ lọc loudnorm của FFmpeg) một lần cho mỗi bài, trong nền.
+    Kết quả được giữ trong bộ nhớ và lưu vào ResolutionStore để dùng lại sau khi khởi động lại.
+    """
+    def __init__(self):
+        self._cache = TTLCache(maxsize=20000, ttl=7 * 86400)
+        self._pending = set()
+        self._slots = None
+        self.analyzed = 0
+        self.failed = 0
+
+    async def lookup(self, video_id):
+        """
+        Lấy (integrated LUFS, true peak) của bài nếu đã phân tích, hoặc None.
+        """
+        if not video_id:
+            return None
+        loudness = self._cache.get(video_id)
+        if loudness is None and resolution_store:
+            loudness = await asyncio.to_thread(resolution_store.get_loudness, video_id)
+            if loudness:
+                self._cache[video_id] = loudness
+        return loudness
+
+    def schedule(self, song):
+        """
+        Phân tích độ lớn của bài trong nền nếu chưa có (bài đang phát vẫn dùng stream copy).
+        """
+        video_id = song.video_id
+        if not LOUDNESS_NORMALIZE or not video_id or video_id in self._pending or video_id in self._cache:
+            return
+        source = song.url
+        if disk_audio_cache and disk_audio_cache.contains(video_id):
+            source = disk_audio_cache.peek(video_id)
+        if not source:
+            return
+        self._pending.add(video_id)
+        asyncio.create_task(self._analyze(video_id, source))
+
+    async def _analyze(self, video_id, source):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(LOUDNESS_MAX_ANALYSES)
+        try:
+            async with self._slots:
+                result = await asyncio.wait_for(analyze_loudness(source), timeout=LOUDNESS_ANALYSIS_TIMEOUT)
+            if result is None:
+                self.failed += 1
+                return
+            integrated, true_peak, lra = result
+            self._cache[video_id] = (integrated, true_peak)
+            self.analyzed += 1
+            logger.info(f"Độ lớn của {video_id}: {integrated:.1f} LUFS, đỉnh {true_peak:.1f} dBTP.")
+            if resolution_store:
+                await asyncio.to_thread(resolution_store.put_loudness, video_id, integrated, true_peak, lra)
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Không thể phân tích độ lớn của {video_id}: {e}")
+        finally:
+            self._pending.discard(video_id)
+
+    def stats(self):
+        return {'analyzed': self.analyzed, 'failed': self.failed, 'pending': len(self._pending)}
+
+async def analyze_loudness(source):
+    """
+    Chạy FFmpeg loudnorm (chỉ đo, không xuất âm thanh) và trả về (integrated, true_peak, lra) hoặc None.
+    """
+    args = [FFMPEG_PATH, '-nostdin', '-hide_banner', '-nostats']
+    if '://' in source:
+        args += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+        if PROXY_URL:
+            args += ['-http_proxy', PROXY_URL]
+    args += ['-i', source, '-vn', '-af', f'loudnorm=I={LOUDNESS_TARGET_LUFS}:print_format=json', '-f', 'null', '-']
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        with contextlib.suppress(ProcessLookupError):
+            process.kill()
+        raise
+    output = stderr.decode(errors='ignore')
+    match = LOUDNORM_JSON_REGEX.search(output)
+    if process.returncode != 0 or not match:
+        logger.warning(f"FFmpeg lỗi khi phân tích độ lớn: {output.strip()[-300:]}")
+        return None
+    data = json.loads(match.group(0))
+    integrated = float(data['input_i'])
+    if not math.isfinite(integrated):
+        return None  # Bài im lặng
+    return integrated, float(data['input_tp']), float(data['input_lra'])
+
+loudness_analyzer = LoudnessAnalyzer()
+
+async def get_track_gain(music_player, song):
+    """
+    Mức khuếch đại (dB) để phát bài ở guild; lên lịch phân tích độ lớn nếu bài chưa được phân tích.
+    """
+    loudness = await loudness_analyzer.lookup(song.video_id)
+    if loudness is None:
+        loudness_analyzer.schedule(song)
+    return compute_gain_db(loudness, music_player.volume)
+
+def build_ffmpeg_source(song, gain_db=None, slot=None):
+    """
+    Tạo nguồn FFmpeg (được giám sát) cho bài hát, khởi chạy tiến trình FFmpeg ngay lập tức
+    (trong tiến trình worker âm thanh nếu bật AUDIO_WORKERS).
+    Phát từ file trên đĩa nếu bài đã có trong bộ nhớ đệm âm thanh.
+    Chỉ mã hóa lại khi cần đổi âm lượng (gain_db), ngược lại stream copy.
+    slot là chỗ trong giới hạn FFmpeg toàn máy, được nhả khi nguồn bị dọn dẹp.
+    """
+    options = ffmpeg_output_options(gain_db)
+    mode = 'copy' if '-c:a copy' in options else 'gain'
+    ffmpeg_mode_counts[mode] += 1
+    info = FFmpegProcessInfo(song.video_id or song.title, mode)
+    try:
+        local_path = disk_audio_cache.lookup(song.video_id) if disk_audio_cache else None
+        if local_path:
+            logger.info(f"Phát {song.title} từ bộ nhớ đệm trên đĩa.")
+            source, ffmpeg_kwargs = local_path, {'executable': FFMPEG_PATH, 'options': options}
+        else:
+            before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+            if PROXY_URL:
+                before_options += f' -http_proxy {PROXY_URL}'
+            source, ffmpeg_kwargs = song.url, {
+                'executable': FFMPEG_PATH,
+                'before_options': before_options,
+                'options': options,
+            }
+
+        if audio_worker_pool:
+            # FFmpeg chạy trong tiến trình worker, tiến trình này chỉ nhận các gói Opus
+            return audio_worker_pool.open(info, source, ffmpeg_kwargs, slot)
+        return SupervisedOpusAudio(source, info=info, slot=slot, **ffmpeg_kwargs)
+    except Exception:
+        if slot:
+            slot.release()
+        raise
+
+class PrimedSource(discord.AudioSource):
+    """
+    Bọc một nguồn Opus đã được khởi chạy và đọc sẵn vài gói đầu tiên,
+    để khi chuyển bài có thể phát ngay không phải chờ FFmpeg kết nối và phân tích luồng.
+    """
+    def __init__(self, source, song):
+        self.source = source
+        self.song = song
+        self.url = song.url
+        self.created_at = time.monotonic()
+        self.priming = None
+        self._buffer = deque()
+        self._eof = False
+
+    def prime(self, frames):
+        """
+        Đọc sẵn tối đa frames gói (chạy trong thread, trước khi giao cho voice_client).
+        """
+        for _ in range(frames):
+            data = self.source.read()
+            if not data:
+                self._eof = True
+                break
+            self._buffer.append(data)
+        return len(self._buffer)
+
+    def read(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        if self._eof:
+            return b''
+        return self.source.read()
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self._buffer.clear()
+        self.source.cleanup()
+
+BROADCAST_MODE = os.getenv('BROADCAST_MODE', '0') == '1'  # Dùng chung một FFmpeg cho các guild phát cùng một bài
+BROADCAST_MAX_BUFFER_BYTES = int(os.getenv('BROADCAST_MAX_BUFFER_BYTES', str(16 * 1024 * 1024)))  # Giới hạn bộ đệm mỗi bài
+BROADCAST_READ_TIMEOUT = 10      # Coi như luồng bị treo nếu không có gói mới trong 10 giây
+
+class BroadcastStream:
+    """
+    Một tiến trình FFmpeg (một kết nối tới googlevideo) cho một bài, đọc trong thread riêng vào bộ đệm gói Opus chung.
+    Mỗi guild đọc qua BroadcastSource với vị trí riêng; bộ đệm giữ từ đầu bài để guild vào sau vẫn phát từ đầu,
+    chỉ cắt bớt phần mọi guild đã đọc qua khi vượt BROADCAST_MAX_BUFFER_BYTES.
+    """
+    def __init__(self, key, upstream):
+        self.key = key
+        self.upstream = upstream
+        self._frames = []
+        self._base = 0          # Chỉ số gói của phần tử đầu tiên trong _frames
+        self.buffered_bytes = 0
+        self.eof = False
+        self.closed = False
+        self.consumers = set()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._reader, name=f"broadcast-{key[0]}", daemon=True)
+        self._thread.start()
+
+    @property
+    def joinable(self):
+        # Guild mới chỉ dùng chung nếu bộ đệm còn giữ từ gói đầu tiên
+        return not self.closed and self._base == 0
+
+    def _min_offset(self):
+        return min((consumer.offset for consumer in self.consumers), default=self._base + len(self._frames))
+
+    def _trim(self):
+        drop = self._min_offset() - self._base
+        if drop <= 0:
+            return False
+        self.buffered_bytes -= sum(len(frame) for frame in self._frames[:drop])
+        del self._frames[:drop]
+        self._base += drop
+        return True
+
+    def _reader(self):
+        try:
+            while not self.closed:
+                data = self.upstream.read()
+                with self._cond:
+                    if not data:
+                        break
+                    self._frames.append(data)
+                    self.buffered_bytes += len(data)
+                    # Chờ các guild đọc bớt nếu bộ đệm đầy (không đọc trước quá xa)
+                    while (self.buffered_bytes > BROADCAST_MAX_BUFFER_BYTES and not self.closed
+                           and not self._trim()):
+                        self._cond.wait(1)
+                    self._cond.notify_all()
+        except Exception as e:
+            logger.warning(f"Lỗi khi đọc luồng phát chung {self.key[0]}: {e}")
+        finally:
+            with self._cond:
+                self.eof = True
+                self._cond.notify_all()
+            self.upstream.cleanup()
+
+    def read_frame(self, consumer):
+        with self._cond:
+            while consumer.offset >= self._base + len(self._frames) and not self.eof and not self.closed:
+                if not self._cond.wait(BROADCAST_READ_TIMEOUT):
+                    logger.warning(f"Luồng phát chung {self.key[0]} không có dữ liệu mới, dừng phát.")
+                    return b''
+            consumer.offset = max(consumer.offset, self._base)
+            index = consumer.offset - self._base
+            if index >= len(self._frames):
+                return b''
+            consumer.offset += 1
+            if self.buffered_bytes > BROADCAST_MAX_BUFFER_BYTES:
+                self._cond.notify_all()  # Đánh thức thread đọc đang chờ bộ đệm trống bớt
+            return self._frames[index]
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._frames = []
+            self.buffered_bytes = 0
+            self._cond.notify_all()
+        self.upstream.cleanup()  # Làm read() của thread đọc kết thúc
+
+class BroadcastSource(discord.AudioSource):
+    """
+    Nguồn âm thanh của một guild đọc từ BroadcastStream dùng chung, ở vị trí riêng.
+    """
+    def __init__(self, hub, stream):
+        self.hub = hub
+        self.stream = stream
+        self.offset = 0
+        self._released = False
+
+    def read(self):
+        return self.stream.read_frame(self)
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if not self._released:
+            self._released = True
+            self.hub.release(self)
+
+class BroadcastHub:
+    """
+    Quản lý các BroadcastStream theo (video_id, mức gain), đếm số guild đang dùng mỗi luồng
+    và đóng FFmpeg khi guild cuối cùng ngừng phát.
+    """
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.shared = 0
+
+    def _key(self, song, gain_db):
+        mode = 'copy' if '-c:a copy' in ffmpeg_output_options(gain_db) else round(gain_db, 1)
+        return (song.video_id, mode)
+
+    def _add_consumer(self, stream):
+        consumer = BroadcastSource(self, stream)
+        stream.consumers.add(consumer)
+        return consumer
+
+    def join(self, song, gain_db):
+        """
+        Dùng chung luồng đang phát của bài nếu có; None nếu cần mở FFmpeg mới.
+        """
+        with self._lock:
+            stream = self._streams.get(self._key(song, gain_db))
+            if stream and stream.joinable:
+                self.shared += 1
+                return self._add_consumer(stream)
+        return None
+
+    def attach(self, song, gain_db, upstream):
+        """
+        Đăng ký nguồn FFmpeg vừa mở làm luồng dùng chung cho bài và trả về nguồn cho guild hiện tại.
+        """
+        key = self._key(song, gain_db)
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream and stream.joinable:
+                # Guild khác vừa mở cùng bài trong lúc chờ: dùng luồng đó, bỏ FFmpeg vừa mở
+                self.shared += 1
+                consumer = self._add_consumer(stream)
+            else:
+                stream = self._streams[key] = BroadcastStream(key, upstream)
+                self.opened += 1
+                upstream = None
+                consumer = self._add_consumer(stream)
+        if upstream:
+            upstream.cleanup()
+        return consumer
+
+    def release(self, consumer):
+        stream = consumer.stream
+        with self._lock:
+            stream.consumers.discard(consumer)
+            if stream.consumers:
+                return
+            if self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+        stream.close()
+
+    def stats(self):
+        with self._lock:
+            streams = list(self._streams.values())
+        return {
+            'streams': len(streams),
+            'consumers': sum(len(stream.consumers) for stream in streams),
+            'buffered_bytes': sum(stream.buffered_bytes for stream in streams),
+            'opened': self.opened,
+            'shared': self.shared,
+        }
+
+broadcast_hub = BroadcastHub() if BROADCAST_MODE else None
+
+async def open_audio_source(song, gain_db=None, wait=FFMPEG_SLOT_WAIT):
+    """
+    Mở nguồn âm thanh cho bài: dùng chung luồng FFmpeg giữa các guild khi bật BROADCAST_MODE,
+    ngược lại khởi chạy FFmpeg mới sau khi có chỗ trong giới hạn toàn máy (FFmpegCapacityError nếu hết chờ).
+    """
+    shared = broadcast_hub and song.video_id
+    if shared:
+        consumer = broadcast_hub.join(song, gain_db)
+        if consumer:
+            return consumer
+    slot = await ffmpeg_supervisor.acquire_slot(wait)
+    source = build_ffmpeg_source(song, gain_db, slot)
+    if shared:
+        return broadcast_hub.attach(song, gain_db, source)
+    return source
+
+async def prepare_next_source(music_player):
+    """
+    Khởi chạy và đọc sẵn FFmpeg cho bài kế tiếp trong khi bài hiện tại sắp kết thúc.
+    """
+    song = get_next_song(music_player)
+    if not song or not song.url or not music_player.voice_client:
+        return
+    prepared = music_player.prepared_source
+    if prepared and prepared.song is song and prepared.url == song.url:
+        return
+    discard_prepared_source(music_player)
+    gain_db = await get_track_gain(music_player, song)
+    try:
+        # Không chờ chỗ FFmpeg cho việc chuẩn bị trước; bài sẽ được mở bình thường khi tới lượt
+        prepared = PrimedSource(await open_audio_source(song, gain_db, wait=0), song)
+    except Exception as e:
+        logger.warning(f"Không thể khởi chạy sẵn FFmpeg cho {song.title}: {e}")
+        return
+    music_player.prepared_source = prepared
+    prepared.priming = asyncio.ensure_future(asyncio.to_thread(prepared.prime, GAPLESS_PRIME_FRAMES))
+    try:
+        frames = await asyncio.shield(prepared.priming)
+        logger.info(f"Đã chuẩn bị sẵn {frames} gói âm thanh cho {song.title} (guild {music_player.guild_id}).")
+    except Exception as e:
+        logger.warning(f"Lỗi khi đọc sẵn FFmpeg cho {song.title}: {e}")
+        if music_player.prepared_source is prepared:
+            discard_prepared_source(music_player)
+
+def discard_prepared_source(music_player):
+    """
+    Hủy nguồn FFmpeg đã chuẩn bị sẵn (nếu có).
+    """
+    prepared = music_player.prepared_source
+    music_player.prepared_source = None
+    if prepared:
+        try:
+            prepared.cleanup()
+        except Exception as e:
+            logger.warning(f"Lỗi khi hủy nguồn đã chuẩn bị: {e}")
+
+async def take_prepared_source(music_player, song):
+    """
+    Lấy nguồn đã chuẩn bị nếu đúng là bài sắp phát, ngược lại hủy nó và trả về None.
+    """
+    prepared = music_player.prepared_source
+    if not prepared:
+        return None
+    if (prepared.song is not song or prepared.url != song.url
+            or time.monotonic() - prepared.created_at > GAPLESS_MAX_AGE):
+        discard_prepared_source(music_player)
+        return None
+    music_player.prepared_source = None
+    try:
+        await asyncio.wait_for(asyncio.shield(prepared.priming), timeout=5)
+    except Exception:
+        prepared.cleanup()
+        return None
+    return prepared
+
+async def start_playback(music_player, song):
+    """
+    Bắt đầu phát bài hát, ưu tiên dùng nguồn FFmpeg đã khởi chạy sẵn.
+    """
+    guild_id = music_player.guild_id
+    source = await take_prepared_source(music_player, song)
+    if source is None:
+        source = await open_audio_source(song, await get_track_gain(music_player, song))
+    if disk_audio_cache:
+        disk_audio_cache.note_play(song)
+    music_player.history.record(song)
+    music_player.autoplay.note_playing(song)
+    music_player.touch()
+    requested_at, song.requested_at = song.requested_at, None  # Chỉ đo lần phát đầu tiên, không tính lặp bài
+    music_player.voice_client.play(
+        TimedSource(source, music_player.voice_timing, requested_at),
+        after=lambda e: asyncio.run_coroutine_threadsafe(play_next(guild_id), bot.loop)
+    )
+    schedule_prefetch(music_player)
+
+# -----------------------------#
+#      Định Nghĩa Các Hàm       #
+# -----------------------------#
+
+def build_control_embed(music_player):
+    """
+    Tạo embed bảng điều khiển nhạc từ trạng thái hiện tại của guild.
+    """
+    if music_player.current_song:
+        if music_player.is_playing_from_cache:
+            status_message = f"🎵 Phát từ bộ nhớ: **{music_player.current_song.title}** ({music_player.current_song.duration})"
+        else:
+            status_message = f"🎵 Đang phát: **{music_player.current_song.title}** ({music_player.current_song.duration})"
+    else:
+        status_message = "🎵 Không có bài hát nào đang được phát."
     
     # Set embed color based on playback status
     embed_color = discord.Color.blue() if music_player.is_playing_from_cache else (
@@ -453,245 +4301,487 @@ async def send_control_panel(music_player):
         name="🔄 Lặp",
         value="Bật" if music_player.is_looping else "Tắt"
     )
-    embed.add_field(
-        name="📋 Hàng đợi",
-        value=generate_queue_list(music_player.music_queue),
-        inline=False
-    )    # Custom footer based on playback state
-    if music_player.is_playing_from_cache:
-        footer_text = "🔄 Đang Phát lại các bài hát trước đó | Điều khiển bằng các nút bên dưới"
-    else:
-        footer_text = "Điều khiển nhạc bằng các nút bên dưới!"
-    
-    embed.set_footer(text=footer_text)
+    embed.add_field(
+        name="🔊 Âm lượng",
+        value=f"{music_player.volume}%"
+    )
+    embed.add_field(
+        name="📋 Hàng đợi",
+        value=generate_queue_list(music_player.music_queue, music_player.panel.queue_page),
+        inline=False
+    )    # Custom footer based on playback state
+    if music_player.is_playing_from_cache:
+        footer_text = "🔄 Đang Phát lại các bài hát trước đó | Điều khiển bằng các nút bên dưới"
+    else:
+        footer_text = "Điều khiển nhạc bằng các nút bên dưới!"
+    
+    embed.set_footer(text=footer_text)
+
+    if music_player.current_song and music_player.current_song.thumbnail:
+        embed.set_thumbnail(url=music_player.current_song.thumbnail)
+    return embed
+
+async def send_control_panel(music_player):
+    """
+    Yêu cầu cập nhật bảng điều khiển nhạc; các thay đổi liên tiếp được gom lại và hiển thị một lần.
+    """
+    music_player.touch()
+    music_player.panel.request_update()
+
+def remember_recent_track(music_player, audio_data):
+    """
+    Ghi nhớ metadata bài hát vừa phân giải cho guild để phát lại khi hết hàng đợi.
+    """
+    music_player.recent_tracks[audio_data['video_id']] = {
+        "url": audio_data['webpage_url'],
+        "title": audio_data['title'],
+        "thumbnail": audio_data['thumbnail'],
+        "duration": audio_data['duration'],
+    }
+
+async def get_audio_stream_url(music_player, url, force_refresh=False):
+    """
+    Lấy URL luồng âm thanh từ cache hoặc YouTube.
+    """
+    cache_key = extract_video_id(url) or url
+    if force_refresh:
+        stream_cache.invalidate(cache_key)
+    cached = stream_cache.get(cache_key)
+    if cached:
+        logger.info(f"Lấy URL âm thanh từ bộ nhớ đệm cho guild {music_player.guild_id}.")
+        remember_recent_track(music_player, cached)
+        return cached
+
+    # Gộp các yêu cầu đồng thời cho cùng một video vào một lần trích xuất duy nhất
+    # (yêu cầu làm mới không được gộp với lượt phân giải thường, vốn có thể trả lại URL đã lưu)
+    flight_key = (cache_key, 'refresh') if force_refresh else cache_key
+    audio_data = await inflight_resolutions.run(
+        flight_key, lambda: resolve_audio_stream(url, cache_key, music_player.guild_id, force_refresh)
+    )
+    if not audio_data:
+        return None
+    remember_recent_track(music_player, audio_data)
+    return dict(audio_data)
+
+async def resolve_audio_stream(url, cache_key, guild_id, force_refresh=False):
+    """
+    Trích xuất URL luồng âm thanh bằng yt-dlp và lưu vào bộ nhớ đệm dùng chung.
+    Khi force_refresh, bỏ qua URL đã lưu (vừa bị từ chối hoặc sắp hết hạn) và luôn trích xuất lại.
+    """
+    # Thử lấy kết quả đã lưu trên đĩa từ lần chạy trước (URL luồng còn hạn)
+    stored = None
+    if resolution_store and not force_refresh:
+        stored = await asyncio.to_thread(resolution_store.get, cache_key)
+        if stored and stored['expires_at'] and stored['expires_at'] - STREAM_URL_EXPIRY_MARGIN > time.time():
+            resolution_latency.setdefault('store', Histogram()).observe(0)
+            logger.info(f"Lấy URL âm thanh từ dữ liệu đã lưu cho guild {guild_id}.")
+            stream_cache.set(cache_key, stored)
+            return stored
+
+    started_at = time.monotonic()
+    info = await extraction_scheduler.submit(guild_id, extract_stream_info, url, guild_id)
+    # Thời gian phân giải (gồm cả chờ trong hàng đợi trích xuất) theo lần thử thành công
+    resolution_latency.setdefault(info['attempt'] if info else 'failed', Histogram()).observe(
+        (time.monotonic() - started_at) * 1000
+    )
+    if not info:
+        # Trích xuất thất bại: dùng tạm URL đã lưu nếu nó chỉ nằm trong khoảng an toàn, chưa thật sự hết hạn
+        if stored and stored['expires_at'] and stored['expires_at'] > time.time():
+            logger.warning(f"Trích xuất {cache_key} thất bại, dùng URL đã lưu sắp hết hạn cho guild {guild_id}.")
+            return stored
+        return None
 
-    if music_player.current_song and music_player.current_song['thumbnail']:
-        embed.set_thumbnail(url=music_player.current_song['thumbnail'])
+    audio_data = {
+        "url": info['url'],
+        "title": info['title'],
+        "thumbnail": info['thumbnail'],
+        "duration": format_duration_seconds(info['duration']),
+        "duration_seconds": info['duration'],
+        "video_id": info['id'] or cache_key,
+        "webpage_url": info['webpage_url'] or url,
+        "expires_at": parse_stream_expiry(info['url']),
+    }
 
-    view = MusicControlView(music_player)
-    music_player.current_control_message = await channel.send(embed=embed, view=view)
-    await update_bot_status(music_player)
+    # Lưu vào bộ nhớ đệm dùng chung theo ID video
+    stream_cache.set(cache_key, audio_data)
+    if resolution_store:
+        try:
+            await asyncio.to_thread(resolution_store.put, cache_key, audio_data, info)
+        except Exception as e:
+            logger.warning(f"Không thể lưu dữ liệu phân giải cho {cache_key}: {e}")
+    return audio_data
 
-async def update_bot_status(music_player):
+def make_song_info(audio_data, duration=None):
     """
-    Cập nhật trạng thái của bot dựa trên trạng thái nhạc hiện tại.
+    Tạo Track cho hàng đợi từ kết quả phân giải.
     """
-    if music_player.current_song:
-        await bot.change_presence(
-            activity=discord.Activity(
-                type=discord.ActivityType.playing,
-                name=f": {music_player.current_song['title']}"
-            )
-        )
-    elif not music_player.music_queue.empty():
-        next_song = music_player.music_queue._queue[0]
-        await bot.change_presence(
-            activity=discord.Activity(
-                type=discord.ActivityType.playing,
-                name=f"!play {next_song['title']}"
-            )
-        )
-    else:
-        await bot.change_presence(
-            activity=discord.Activity(
-                type=discord.ActivityType.listening,
-                name="!play + Tên Bài Hát"
-            )
-        )
+    return Track(
+        url=audio_data["url"],
+        title=audio_data["title"],
+        thumbnail=audio_data["thumbnail"],
+        duration=duration or audio_data["duration"],
+        duration_seconds=audio_data.get("duration_seconds"),
+        webpage_url=audio_data.get("webpage_url"),
+        video_id=audio_data.get("video_id"),
+        expires_at=audio_data.get("expires_at"),
+    )
 
-async def get_audio_stream_url(music_player, url):
+def make_placeholder_song(entry):
     """
-    Lấy URL luồng âm thanh từ cache hoặc YouTube.
+    Tạo bài hát chưa phân giải (chưa có URL luồng) từ một mục của danh sách phát.
+    URL luồng và ảnh được lấy sau, khi bài sắp được phát.
     """
-    if url in music_player.audio_cache:
-        logger.info(f"Lấy URL âm thanh từ bộ nhớ đệm cho guild {music_player.guild_id}.")
-        return music_player.audio_cache[url]
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'noplaylist': True,
-        'default_search': 'auto',
-        'nocheckcertificate': True,
-        'no_warnings': True,
-        'ignoreerrors': True,
-        'restrictfilenames': True,
-        'skip_download': True,
-        'cachedir': False,
-        'extractor_args': {
-            'youtube': {
-                'skip': ['hls', 'dash'],
-                'player_skip': ['configs', 'webpage'],
-            }
-        },
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'Accept-Language': 'en-us,en;q=0.5',
-            'Accept-Encoding': 'gzip,deflate',
-            'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
-            'Connection': 'close'
-        }
-    }
+    return Track(
+        url=None,
+        title=entry["title"],
+        duration=format_duration_seconds(entry.get("duration")),
+        duration_seconds=entry.get("duration"),
+        webpage_url=f"https://www.youtube.com/watch?v={entry['id']}",
+        video_id=entry["id"],
+    )
 
-    if PROXY_URL:
-        ydl_opts['proxy'] = PROXY_URL
-
-    # Thêm hỗ trợ cookies nếu có
-    if COOKIES_PATH:
-        ydl_opts['cookiefile'] = COOKIES_PATH
-        logger.info(f"Sử dụng cookies từ {COOKIES_PATH}")
-
-    # Thử nhiều lần với các cấu hình khác nhau
-    retry_configs = [
-        {},  # Cấu hình mặc định
-        {'extractor_args': {'youtube': {'skip': ['dash']}}},  # Bỏ qua DASH
-        {'format': 'worst'},  # Chất lượng thấp nhất
-    ]
+def stream_needs_refresh(song):
+    """
+    Kiểm tra bài hát chưa có URL luồng hoặc URL sắp hết hạn.
+    """
+    if not song.url:
+        return True
+    expires_at = song.expires_at
+    return bool(expires_at) and expires_at - time.time() < STREAM_REFRESH_MARGIN
 
-    for attempt, extra_opts in enumerate(retry_configs, 1):
-        try:
-            current_opts = {**ydl_opts, **extra_opts}
-            logger.info(f"Thử lấy URL âm thanh lần {attempt} cho guild {music_player.guild_id}")
-            
-            with yt_dlp.YoutubeDL(current_opts) as ydl:
-                # Sử dụng asyncio.to_thread để chạy hàm đồng bộ trong một thread
-                info = await asyncio.to_thread(ydl.extract_info, url, download=False)
-                if info is None:
-                    logger.warning(f"yt_dlp trả về None cho thông tin video tại {url} (lần thử {attempt}).")
-                    continue
+async def probe_stream_url(stream_url):
+    """
+    Mở trước kết nối HTTP tới URL luồng (chỉ đọc 1 byte) để kiểm tra URL còn dùng được.
+    """
+    session = bot.youtube_api.session
+    if not session or session.closed:
+        return True
+    try:
+        async with session.get(
+            stream_url,
+            headers={'Range': 'bytes=0-0'},
+            proxy=PROXY_URL,
+            timeout=aiohttp.ClientTimeout(total=10)
+        ) as resp:
+            return resp.status < 400
+    except Exception as e:
+        # Lỗi mạng tạm thời không có nghĩa là URL đã hỏng
+        logger.warning(f"Không thể kiểm tra trước URL luồng: {e}")
+        return True
 
-                # Lấy luồng âm thanh trực tiếp
-                audio_url = info.get('url')
-                title = info.get('title', 'URL Provided')
-                thumbnail = info.get('thumbnail')
-                
-                if not audio_url:
-                    logger.warning(f"Không tìm thấy URL âm thanh trong lần thử {attempt}")
-                    continue
-                
-                logger.info(f"Thành công lấy URL âm thanh cho guild {music_player.guild_id} ở lần thử {attempt}")
-                
-                # Lấy thời lượng từ info nếu có
-                duration = "Unknown"
-                if info.get('duration'):
-                    duration_seconds = info.get('duration')
-                    minutes, seconds = divmod(int(duration_seconds), 60)
-                    hours, minutes = divmod(minutes, 60)
-                    if hours > 0:
-                        duration = f"{hours}:{minutes:02}:{seconds:02}"
-                    else:
-                        duration = f"{minutes}:{seconds:02}"
-                
-                # Lưu trữ vào bộ nhớ đệm dưới dạng dict
-                music_player.audio_cache[url] = {
-                    "url": audio_url,
-                    "title": title,
-                    "thumbnail": thumbnail,
-                    "duration": duration
-                }
+async def refresh_song_stream(music_player, song, validate=False):
+    """
+    Đảm bảo bài hát có URL luồng còn hạn; lấy lại từ YouTube nếu sắp hết hạn hoặc bị từ chối.
+    Trả về False nếu không thể lấy URL luồng.
+    """
+    webpage_url = song.webpage_url
+    if not webpage_url:
+        return bool(song.url)
+    if disk_audio_cache and song.video_id in disk_audio_cache:
+        # Phát từ file trên đĩa nên không cần URL luồng còn hạn
+        return True
+    if not stream_needs_refresh(song):
+        if not validate or await probe_stream_url(song.url):
+            return True
+        logger.info(f"URL luồng của {song.title} bị từ chối, lấy lại cho guild {music_player.guild_id}.")
+    audio_data = await get_audio_stream_url(music_player, webpage_url, force_refresh=bool(song.url))
+    if not audio_data:
+        return False
+    song.url = audio_data['url']
+    song.expires_at = audio_data.get('expires_at')
+    if not song.thumbnail:
+        # Bài từ danh sách phát: bổ sung metadata sau lần phân giải đầu tiên
+        song.thumbnail = audio_data.get('thumbnail')
+        song.duration_seconds = song.duration_seconds or audio_data.get('duration_seconds')
+        if song.duration == "Unknown":
+            song.duration = audio_data.get('duration', "Unknown")
+    return True
 
-                return music_player.audio_cache[url]
-                
-        except Exception as e:
-            logger.warning(f"Lần thử {attempt} thất bại: {e}")
-            if attempt == len(retry_configs):
-                logger.error(f"Tất cả các lần thử đều thất bại cho URL {url}")
-            continue
-    
-    # Nếu tất cả các lần thử đều thất bại
-    logger.error(f"Không thể lấy audio stream URL tại {url} sau {len(retry_configs)} lần thử")
-    return None
+async def prefetch_upcoming(music_player, delay=0, gapless_delay=None):
+    """
+    Kiểm tra và lấy lại trước URL luồng của các bài sắp phát, ngay trước khi bài hiện tại kết thúc.
+    Nếu có gapless_delay, khởi chạy sẵn FFmpeg cho bài kế tiếp sau chừng đó giây (tính từ lúc gọi).
+    """
+    started = time.monotonic()
+    try:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        upcoming = music_player.music_queue.peek(PREFETCH_LOOKAHEAD)
+        autoplay_next = None
+        if music_player.is_looping and music_player.current_song:
+            upcoming.insert(0, music_player.current_song)
+        elif not upcoming:
+            # Hàng đợi trống: lấy trước bài sẽ được tự động phát
+            autoplay_next = music_player.autoplay.peek_next()
+            if autoplay_next:
+                upcoming.append(autoplay_next)
+        for song in upcoming:
+            if not await refresh_song_stream(music_player, song, validate=True):
+                logger.warning(f"Không thể lấy trước luồng cho {song.title} (guild {music_player.guild_id}).")
+                if song is autoplay_next:
+                    music_player.autoplay.discard(song)
+
+        # Khởi chạy sẵn FFmpeg cho bài kế tiếp ngay trước khi bài hiện tại kết thúc
+        if gapless_delay is not None:
+            await asyncio.sleep(max(0, gapless_delay - (time.monotonic() - started)))
+            await prepare_next_source(music_player)
+    except ExtractionQueueFull:
+        logger.warning(f"Bỏ qua lấy trước luồng cho guild {music_player.guild_id} vì hàng đợi trích xuất đầy.")
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.error(f"Lỗi khi lấy trước luồng cho guild {music_player.guild_id}: {e}")
+
+def get_next_song(music_player):
+    """
+    Bài sẽ được phát khi bài hiện tại kết thúc (nếu đã biết trước).
+    """
+    if music_player.is_looping and music_player.current_song:
+        return music_player.current_song
+    if not music_player.music_queue.empty():
+        return music_player.music_queue[0]
+    return music_player.autoplay.peek_next()
+
+def schedule_prefetch(music_player):
+    """
+    Hẹn giờ lấy trước các bài sắp phát, PREFETCH_LEAD_SECONDS giây trước khi bài hiện tại kết thúc.
+    """
+    if music_player.prefetch_task and not music_player.prefetch_task.done():
+        music_player.prefetch_task.cancel()
+    delay = 0
+    # Không biết thời lượng (ví dụ phát trực tiếp): không khởi chạy sẵn, tránh giữ thêm một FFmpeg suốt cả bài
+    gapless_delay = None
+    if music_player.current_song and music_player.current_song.duration_seconds:
+        delay = max(0, music_player.current_song.duration_seconds - PREFETCH_LEAD_SECONDS)
+        if GAPLESS_LEAD_SECONDS > 0:
+            # Bài ngắn hơn khoảng chuẩn bị: khởi chạy sẵn ngay
+            gapless_delay = max(0, music_player.current_song.duration_seconds - GAPLESS_LEAD_SECONDS)
+    music_player.prefetch_task = asyncio.create_task(prefetch_upcoming(music_player, delay, gapless_delay))
 
 async def process_song_selection(ctx, song, user_voice_channel):
     """
     Xử lý bài hát được chọn từ lệnh play.
     """
-    music_player = get_music_player(ctx.guild.id, ctx.channel)
+    music_player = await get_music_player(ctx.guild.id, ctx.channel)
     await process_song_selection_from_selection(music_player, song, user_voice_channel)
 
+async def ensure_voice_connection(music_player, user_voice_channel):
+    """
+    Hủy hẹn giờ ngắt kết nối và kết nối (hoặc di chuyển) bot vào kênh thoại của người dùng.
+    Trả về False nếu không thể kết nối.
+    """
+    # Hủy tác vụ ngắt kết nối nếu có
+    if music_player.disconnect_task and not music_player.disconnect_task.cancelled():
+        music_player.disconnect_task.cancel()
+        music_player.disconnect_task = None
+
+    # Kiểm tra và kết nối vào kênh thoại nếu chưa kết nối
+    if not music_player.voice_client:
+        if not user_voice_channel:
+            await music_player.text_channel.send("❗ Bạn cần vào một kênh thoại trước!")
+            return False
+        try:
+            music_player.voice_client = await user_voice_channel.connect()
+            music_player.voice_channel = user_voice_channel
+        except Exception as e:
+            logger.error(f"Lỗi khi kết nối kênh thoại: {e}")
+            await music_player.text_channel.send("❗ Không thể kết nối vào kênh thoại.")
+            return False
+    elif music_player.voice_client.channel != user_voice_channel:
+        try:
+            await music_player.voice_client.move_to(user_voice_channel)
+            music_player.voice_channel = user_voice_channel
+        except Exception as e:
+            logger.error(f"Lỗi khi di chuyển kênh thoại: {e}")
+            await music_player.text_channel.send("❗ Không thể di chuyển vào kênh thoại.")
+            return False
+    return True
+
 async def process_song_selection_from_selection(music_player, song, user_voice_channel):
     """
     Xử lý bài hát được chọn từ giao diện chọn bài hát.
+    Trả về True nếu bài đã được phát hoặc thêm vào hàng đợi.
     """
+    requested_at = time.monotonic()
     try:
         logger.info(f"Đang xử lý bài hát: {song['title']} cho guild {music_player.guild_id}")
 
-        # Hủy tác vụ ngắt kết nối nếu có
-        if music_player.disconnect_task and not music_player.disconnect_task.cancelled():
-            music_player.disconnect_task.cancel()
-            music_player.disconnect_task = None
-
-        # Kiểm tra và kết nối vào kênh thoại nếu chưa kết nối
-        if not music_player.voice_client:
-            if not user_voice_channel:
-                await music_player.text_channel.send("❗ Bạn cần vào một kênh thoại trước!")
-                return
-            try:
-                music_player.voice_client = await user_voice_channel.connect()
-                music_player.voice_channel = user_voice_channel
-            except Exception as e:
-                logger.error(f"Lỗi khi kết nối kênh thoại: {e}")
-                await music_player.text_channel.send("❗ Không thể kết nối vào kênh thoại.")
-                return
-        elif music_player.voice_client.channel != user_voice_channel:
-            try:
-                await music_player.voice_client.move_to(user_voice_channel)
-                music_player.voice_channel = user_voice_channel
-            except Exception as e:
-                logger.error(f"Lỗi khi di chuyển kênh thoại: {e}")
-                await music_player.text_channel.send("❗ Không thể di chuyển vào kênh thoại.")
-                return
+        if not await ensure_voice_connection(music_player, user_voice_channel):
+            return False
 
         # Lấy URL luồng âm thanh
-        audio_data = await get_audio_stream_url(music_player, song['url'])
+        try:
+            audio_data = await get_audio_stream_url(music_player, song['url'])
+        except ExtractionQueueFull:
+            await music_player.text_channel.send(EXTRACTION_BUSY_MESSAGE)
+            return False
         if not audio_data:
             await music_player.text_channel.send("❗ Không thể lấy luồng âm thanh của bài hát này.")
-            return
-        current_song_info = {
-            "url": audio_data["url"],
-            "title": audio_data["title"],
-            "thumbnail": audio_data["thumbnail"],
-            "duration": song['duration']
-        }
-        
-        # Thêm bài hát đã phát vào danh sách đã phát
-        music_player.played_songs.append(current_song_info)
+            return False
+        current_song_info = make_song_info(audio_data, song['duration'])
+
 
         if music_player.voice_client.is_playing() or music_player.voice_client.is_paused():
-            await music_player.music_queue.put(current_song_info)
+            music_player.music_queue.append(current_song_info)
             await send_control_panel(music_player)
+            return True
         else:
             music_player.current_song = current_song_info
+            current_song_info.requested_at = requested_at
             music_player.is_playing_from_cache = False  # Đánh dấu không phát từ cache
             try:
-                logger.info(f"Đang cố gắng phát: {current_song_info['title']} cho guild {music_player.guild_id}")
+                logger.info(f"Đang cố gắng phát: {current_song_info.title} cho guild {music_player.guild_id}")
                 
-                before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
-                if PROXY_URL:
-                    before_options += f' -http_proxy {PROXY_URL}'
-
-                music_player.voice_client.play(
-                    discord.FFmpegOpusAudio(
-                        executable=FFMPEG_PATH,
-                        source=current_song_info['url'],
-                        before_options=before_options,
-                        options='-vn -c:a copy -loglevel quiet'  # Stream copy để giảm tải CPU
-                    ),
-                    after=lambda e: asyncio.run_coroutine_threadsafe(play_next(music_player.guild_id), bot.loop)
-                )
-                logger.info(f"Đã phát: {current_song_info['title']} cho guild {music_player.guild_id}")
+                await start_playback(music_player, current_song_info)
+                logger.info(f"Đã phát: {current_song_info.title} cho guild {music_player.guild_id}")
                 await send_control_panel(music_player)
+            except FFmpegCapacityError as e:
+                logger.warning(f"{e}, chưa phát được {current_song_info.title} cho guild {music_player.guild_id}")
+                await pause_for_ffmpeg_capacity(music_player, current_song_info)
             except Exception as e:
                 logger.error(f"Lỗi khi phát nhạc: {e}")
                 await music_player.text_channel.send("❗ Có lỗi xảy ra khi phát nhạc.")
+                return False
+            return True
     except Exception as e:
         logger.error(f"Lỗi trong process_song_selection_from_selection: {e}")
         await music_player.text_channel.send("❗ Đã xảy ra lỗi khi xử lý bài hát.")
+    return False
+
+async def process_playlist(ctx, url, user_voice_channel):
+    """
+    Thêm danh sách phát/mix vào hàng đợi: các bài được thêm dưới dạng chưa phân giải và
+    chỉ lấy URL luồng khi sắp phát. Bài đầu được phát ngay, phần còn lại được thêm dần trong nền:
+    - URL có video cụ thể (watch?v=...&list=...): phát video đó, chỉ thêm tối đa PLAYLIST_WATCH_MAX_TRACKS bài.
+    - URL danh sách phát: chỉ lấy trang đầu để phát bài đầu tiên, sau đó mới tải cả danh sách.
+    Bài đầu không phát được thì báo lại và thử bài kế tiếp trong danh sách.
+    """
+    music_player = await get_music_player(ctx.guild.id, ctx.channel)
+    lead_id = extract_video_id(url)
+    # Chỉ thêm cả danh sách khi người dùng gửi link danh sách phát; link video kèm list= chỉ thêm một phần
+    limit = PLAYLIST_WATCH_MAX_TRACKS if lead_id else PLAYLIST_MAX_TRACKS
+    if not await ensure_voice_connection(music_player, user_voice_channel):
+        return
+    listing_task = None
+    try:
+        if lead_id:
+            listing_task = asyncio.create_task(
+                extraction_scheduler.submit(ctx.guild.id, extract_playlist_entries, url, limit)
+            )
+            # Phát ngay video trong URL trong lúc danh sách đang được tải
+            lead_played = await process_song_selection_from_selection(music_player, {
+                'url': f"https://www.youtube.com/watch?v={lead_id}",
+                'title': lead_id,
+                'thumbnail': None,
+                'duration': None,
+            }, user_voice_channel)
+            playlist = await listing_task
+            head, listing_task = [], None
+            entries = [entry for entry in (playlist['entries'] if playlist else []) if entry['id'] != lead_id]
+            if not lead_played:
+                if not music_player.voice_client or not entries:
+                    return
+                # Video trong URL không phát được: chuyển sang các bài của danh sách
+                await ctx.send("↪️ Bỏ qua video trong link, phát các bài của danh sách.")
+                lead_index = await play_playlist_lead(ctx, music_player, entries, user_voice_channel)
+                if lead_index is None:
+                    return
+                entries = entries[lead_index + 1:]
+        else:
+            # Trang đầu trả về nhanh; cả danh sách (tới PLAYLIST_MAX_TRACKS bài) được tải song song
+            playlist = await extraction_scheduler.submit(
+                ctx.guild.id, extract_playlist_entries, url, PLAYLIST_HEAD_TRACKS
+            )
+            head = playlist['entries'] if playlist else []
+            if not head:
+                await ctx.send("❗ Không thể lấy danh sách bài hát của danh sách phát này.")
+                return
+            if len(head) >= PLAYLIST_HEAD_TRACKS and limit > PLAYLIST_HEAD_TRACKS:
+                listing_task = asyncio.create_task(
+                    extraction_scheduler.submit(ctx.guild.id, extract_playlist_entries, url, limit)
+                )
+            lead_index = await play_playlist_lead(ctx, music_player, head, user_voice_channel)
+            if lead_index is None:
+                if listing_task:
+                    listing_task.cancel()
+                return
+            entries = head[lead_index + 1:]
+    except ExtractionQueueFull:
+        await ctx.send(EXTRACTION_BUSY_MESSAGE)
+        return
+
+    if not music_player.voice_client:
+        return  # Đã dừng (lệnh stop) trong lúc phát bài đầu
+    music_player.music_queue.extend(make_placeholder_song(entry) for entry in entries)
+    added = len(entries)
+    if listing_task:
+        try:
+            full = await listing_task
+        except ExtractionQueueFull:
+            full = None
+        rest = full['entries'][len(head):] if full else []
+        if music_player.voice_client:
+            music_player.music_queue.extend(make_placeholder_song(entry) for entry in rest)
+            added += len(rest)
+    if not playlist or not added:
+        return
+    message = f"📃 Đã thêm **{added}** bài từ **{playlist['title']}** vào hàng đợi."
+    if lead_id and len(playlist['entries']) >= limit:
+        list_id = parse_qs(urlparse(url if re.match(r'^https?://', url) else f"https://{url}").query)['list'][0]
+        message += (f" Chỉ lấy {limit} bài đầu; gửi link <https://www.youtube.com/playlist?list={list_id}> "
+                    f"để thêm cả danh sách.")
+    await ctx.send(message)
+
+    voice_client = music_player.voice_client
+    if voice_client and not voice_client.is_playing() and not voice_client.is_paused():
+        await play_next(ctx.guild.id)
+    else:
+        # Lấy trước các bài mới nếu chúng nằm ngay sau bài đang phát
+        if music_player.prefetch_task is None or music_player.prefetch_task.done():
+            music_player.prefetch_task = asyncio.create_task(prefetch_upcoming(music_player))
+        await send_control_panel(music_player)
+
+async def play_playlist_lead(ctx, music_player, entries, user_voice_channel):
+    """
+    Phát (hoặc thêm vào hàng đợi) bài đầu tiên phát được trong các bài đầu danh sách.
+    Trả về vị trí của bài đó, hoặc None nếu không bài nào phát được.
+    """
+    candidates = entries[:PLAYLIST_LEAD_ATTEMPTS]
+    for index, entry in enumerate(candidates):
+        if await process_song_selection_from_selection(music_player, {
+            'url': f"https://www.youtube.com/watch?v={entry['id']}",
+            'title': entry['title'],
+            'thumbnail': None,
+            'duration': None,
+        }, user_voice_channel):
+            return index
+        if not music_player.voice_client:
+            return None  # Đã dừng hoặc mất kết nối thoại
+        if index + 1 < len(candidates):
+            await ctx.send(f"↪️ Bỏ qua **{entry['title']}**, thử bài tiếp theo trong danh sách.")
+    await ctx.send("❗ Không phát được bài nào ở đầu danh sách phát này.")
+    return None
+
+async def pause_for_ffmpeg_capacity(music_player, song):
+    """
+    Không mở được FFmpeg vì máy đã đạt giới hạn: đưa bài trở lại đầu hàng đợi và báo cho người dùng.
+    Bài sẽ được phát khi có yêu cầu phát tiếp theo.
+    """
+    if song is not None:
+        music_player.music_queue.insert(0, song)
+    music_player.is_playing_from_cache = False
+    music_player.current_song = None
+    await music_player.text_channel.send(FFMPEG_BUSY_MESSAGE)
+    if music_player.disconnect_task is None or music_player.disconnect_task.done():
+        music_player.disconnect_task = asyncio.create_task(disconnect_after_delay(music_player.guild_id))
+    bot.presence.notify()
+    await send_control_panel(music_player)
 
 async def play_next(guild_id):
     """
     Phát bài hát tiếp theo trong hàng đợi hoặc từ bộ nhớ đệm.
     """
+    current_shard.set(bot.shard_for_guild(guild_id))  # Được gọi từ luồng phát nhạc, không kế thừa shard
     try:
         music_player = bot.music_players.get(guild_id)
         if not music_player:
@@ -703,94 +4793,103 @@ async def play_next(guild_id):
             logger.error(f"Không tìm thấy kênh text cho MusicPlayer của guild {guild_id}.")
             return
 
-        if music_player.current_control_message:
-            try:
-                await music_player.current_control_message.delete()
-            except discord.NotFound:
-                pass
-            music_player.current_control_message = None
+        if not music_player.voice_client or music_player.stopping:
+            return  # Đã ngắt kết nối hoặc đang dừng (lệnh stop)
 
+        # Phát bài tiếp theo trước, cập nhật bảng điều khiển sau để chuyển bài không bị ngắt quãng
         if music_player.is_looping and music_player.current_song:
             try:
-                logger.info(f"Lặp lại bài hát: {music_player.current_song['title']} cho guild {guild_id}")
-
-                before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
-                if PROXY_URL:
-                    before_options += f' -http_proxy {PROXY_URL}'
-
-                music_player.voice_client.play(
-                    discord.FFmpegOpusAudio(
-                        executable=FFMPEG_PATH,
-                        source=music_player.current_song["url"],
-                        before_options=before_options,
-                        options='-vn -c:a copy -loglevel quiet'  # Stream copy để giảm tải CPU
-                    ),
-                    after=lambda e: asyncio.run_coroutine_threadsafe(play_next(guild_id), bot.loop)
-                )
-                logger.info(f"Đã phát lại: {music_player.current_song['title']} cho guild {guild_id}")
+                logger.info(f"Lặp lại bài hát: {music_player.current_song.title} cho guild {guild_id}")
+                await refresh_song_stream(music_player, music_player.current_song)
+
+                await start_playback(music_player, music_player.current_song)
+                logger.info(f"Đã phát lại: {music_player.current_song.title} cho guild {guild_id}")
                 await send_control_panel(music_player)
+            except FFmpegCapacityError as e:
+                logger.warning(f"{e}, dừng lặp bài cho guild {guild_id}")
+                await pause_for_ffmpeg_capacity(music_player, music_player.current_song)
             except Exception as e:
                 logger.error(f"Lỗi khi phát lại bài hát: {e}")
-        elif not music_player.music_queue.empty():
-            next_song = await music_player.music_queue.get()
-            # Đảm bảo next_song là dict
-            if isinstance(next_song, tuple):
-                logger.error(f"Expected dict but got tuple in music_queue for guild {guild_id}.")
-                next_song = {
-                    "url": next_song[0],
-                    "title": next_song[1],
-                    "thumbnail": next_song[2],
-                    "duration": "Unknown"
-                }
+            return
+
+        # Dùng vòng lặp thay vì gọi đệ quy play_next khi phải bỏ qua bài không lấy được luồng
+        autoplay_attempts = 0
+        while True:
+            from_autoplay = music_player.music_queue.empty()
+            if from_autoplay:
+                # Hàng đợi trống: tự động phát một bài từ các bài gần đây/liên quan
+                next_song = music_player.autoplay.take() if autoplay_attempts < AUTOPLAY_MAX_ATTEMPTS else None
+                if next_song is None:
+                    await finish_queue(music_player)
+                    return
+                autoplay_attempts += 1
+            else:
+                next_song = music_player.music_queue.popleft()
+
+            # Thường đã được lấy trước nên không tốn thời gian; chỉ lấy lại nếu URL đã hết hạn
+            try:
+                refreshed = await refresh_song_stream(music_player, next_song)
+            except ExtractionQueueFull:
+                # Hệ thống đang bận: dừng lại và chờ yêu cầu mới
+                logger.warning(f"Dừng phát cho guild {guild_id} vì hàng đợi trích xuất đầy.")
+                if not from_autoplay:
+                    music_player.music_queue.insert(0, next_song)
+                music_player.is_playing_from_cache = False
+                music_player.current_song = None
+                music_player.disconnect_task = asyncio.create_task(disconnect_after_delay(guild_id))
+                bot.presence.notify()
+                return
+            if music_player.stopping or not music_player.voice_client:
+                return  # Lệnh stop đến trong lúc lấy luồng
+            if not refreshed:
+                if from_autoplay:
+                    music_player.autoplay.discard(next_song)
+                else:
+                    await channel.send(f"❗ Không thể lấy luồng âm thanh của **{next_song.title}**, bỏ qua.")
+                continue
+
+            # Đánh dấu đang phát tự động mà không spam thông báo
+            music_player.is_playing_from_cache = from_autoplay
             music_player.current_song = next_song
             try:
-                logger.info(f"Đang phát bài tiếp theo: {next_song['title']} cho guild {guild_id}")
-
-                before_options = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
-                if PROXY_URL:
-                    before_options += f' -http_proxy {PROXY_URL}'
-
-                music_player.voice_client.play(
-                    discord.FFmpegOpusAudio(
-                        executable=FFMPEG_PATH,
-                        source=next_song["url"],
-                        before_options=before_options,
-                        options='-vn -c:a copy -loglevel quiet'  # Stream copy để giảm tải CPU
-                    ),
-                    after=lambda e: asyncio.run_coroutine_threadsafe(play_next(guild_id), bot.loop)
-                )                
-                logger.info(f"Đã phát bài tiếp theo: {next_song['title']} cho guild {guild_id}")
+                logger.info(f"Đang phát bài tiếp theo: {next_song.title} cho guild {guild_id}")
+
+                await start_playback(music_player, next_song)
+                logger.info(f"Đã phát bài tiếp theo: {next_song.title} cho guild {guild_id}")
                 await send_control_panel(music_player)
+            except FFmpegCapacityError as e:
+                logger.warning(f"{e}, dừng phát cho guild {guild_id}")
+                await pause_for_ffmpeg_capacity(music_player, None if from_autoplay else next_song)
             except Exception as e:
                 logger.error(f"Lỗi khi phát bài tiếp theo: {e}")
-        else:            # Hàng đợi trống, cố gắng nạp lại từ bộ nhớ đệm một bài hát
-            cache_songs = list(music_player.audio_cache.values())
-            if cache_songs:
-                # Đánh dấu đang phát từ cache mà không spam thông báo
-                music_player.is_playing_from_cache = True
-                # Chọn một bài hát ngẫu nhiên từ cache
-                song = random.choice(cache_songs)
-                # Đảm bảo song là dict đầy đủ với tất cả các trường cần thiết
-                if 'duration' not in song:
-                    song['duration'] = "Unknown"
-                await music_player.music_queue.put(song)  # Đảm bảo song là dict
-                await play_next(guild_id)  # Gọi lại play_next để bắt đầu phát
-            else:
-                music_player.current_song = None
-                music_player.is_playing_from_cache = False
-                await channel.send("🎵 Hết hàng đợi và bộ nhớ đệm trống. Bot sẽ ngắt kết nối sau 15 phút nếu không có yêu cầu mới.")
-                music_player.disconnect_task = asyncio.create_task(disconnect_after_delay(guild_id))
-                await update_bot_status(music_player)
+            return
     except Exception as e:
         logger.error(f"Lỗi trong play_next cho guild {guild_id}: {e}")
 
+async def finish_queue(music_player):
+    """
+    Hết hàng đợi và không có bài để tự động phát: xóa bảng điều khiển và hẹn giờ ngắt kết nối.
+    """
+    music_player.current_song = None
+    music_player.is_playing_from_cache = False
+    await music_player.panel.clear()
+    await music_player.text_channel.send("🎵 Hết hàng đợi và bộ nhớ đệm trống. Bot sẽ ngắt kết nối sau 15 phút nếu không có yêu cầu mới.")
+    music_player.disconnect_task = asyncio.create_task(disconnect_after_delay(music_player.guild_id))
+    bot.presence.notify()
+
 async def disconnect_after_delay(guild_id):
     """
     Ngắt kết nối bot khỏi kênh thoại sau 15 phút không hoạt động.
     """
     try:
-        await asyncio.sleep(900)  # 15 phút
         music_player = bot.music_players.get(guild_id)
+        if music_player:
+            try:
+                # Không ngắt kết nối nếu hàng đợi có bài mới trong lúc chờ
+                await asyncio.wait_for(music_player.music_queue.wait_not_empty(), timeout=900)  # 15 phút
+                return
+            except asyncio.TimeoutError:
+                pass
         if not music_player:
             logger.error(f"Không tìm thấy MusicPlayer cho guild {guild_id} khi ngắt kết nối.")
             return
@@ -808,7 +4907,7 @@ async def disconnect_after_delay(guild_id):
             music_player.voice_client = None
             music_player.voice_channel = None  # Reset voice_channel sau khi ngắt kết nối
             # music_player.text_channel = None  # Không reset text_channel để có thể tiếp tục sử dụng
-            await update_bot_status(music_player)
+            bot.presence.notify()
     except asyncio.CancelledError:
         logger.info(f"Tác vụ ngắt kết nối đã bị hủy cho guild {guild_id}.")
     except Exception as e:
@@ -829,10 +4928,16 @@ async def play(ctx, *, query: str):
             await ctx.send("❗ Bạn cần vào một kênh thoại trước!")
             return
 
-        music_player = get_music_player(ctx.guild.id, ctx.channel)
-        if is_url(query):            
+        music_player = await get_music_player(ctx.guild.id, ctx.channel)
+        if is_playlist_url(query):
+            await process_playlist(ctx, query, user_voice.channel)
+        elif is_url(query):            
             url = query
-            audio_data = await get_audio_stream_url(music_player, url)
+            try:
+                audio_data = await get_audio_stream_url(music_player, url)
+            except ExtractionQueueFull:
+                await ctx.send(EXTRACTION_BUSY_MESSAGE)
+                return
             if not audio_data:
                 await ctx.send("❗ Không thể lấy luồng âm thanh của URL này.")
                 return
@@ -844,7 +4949,11 @@ async def play(ctx, *, query: str):
             }, user_voice.channel)
         else:
             await ctx.send(f"🔍 Đang tìm kiếm **{query}** trên YouTube...")
-            search_results = await bot.youtube_api.search_youtube(query)
+            try:
+                search_results = await bot.youtube_api.search_youtube(query, guild_id=ctx.guild.id)
+            except ExtractionQueueFull:
+                await ctx.send(EXTRACTION_BUSY_MESSAGE)
+                return
 
             if not search_results:
                 await ctx.send("❌ Không tìm thấy kết quả nào cho tìm kiếm của bạn.")
@@ -884,34 +4993,483 @@ async def stop(ctx):
             music_player.disconnect_task.cancel()
             music_player.disconnect_task = None
 
-        # Xóa hàng đợi một cách an toàn
-        while not music_player.music_queue.empty():
-            try:
-                music_player.music_queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
+        if music_player.prefetch_task and not music_player.prefetch_task.done():
+            music_player.prefetch_task.cancel()
+            music_player.prefetch_task = None
+        discard_prepared_source(music_player)
+
+        music_player.music_queue.clear()
 
         music_player.current_song = None
-        if music_player.voice_client.is_playing() or music_player.voice_client.is_paused():
-            music_player.voice_client.stop()
+        # stop() gọi callback after -> play_next; cờ stopping ngăn nó tự động phát bài khác trước khi ngắt kết nối
+        music_player.stopping = True
+        voice_client = music_player.voice_client
+        music_player.voice_client = None
+        try:
+            if voice_client.is_playing() or voice_client.is_paused():
+                voice_client.stop()
 
-        if music_player.current_control_message:
-            try:
-                await music_player.current_control_message.delete()
-            except Exception as e:
-                logger.error(f"Lỗi khi xóa control message: {e}")
-            music_player.current_control_message = None
+            await music_player.panel.clear()
 
-        await music_player.voice_client.disconnect()
-        music_player.voice_client = None
+            await voice_client.disconnect()
+        finally:
+            music_player.stopping = False
         music_player.voice_channel = None  # Reset voice_channel sau khi ngắt kết nối
         # music_player.text_channel = None  # Không reset text_channel để có thể sử dụng lại
         await ctx.send("🛑 Bot đã ngắt kết nối và xóa hàng đợi.")
-        await update_bot_status(music_player)
+        bot.presence.notify()
     except Exception as e:
         logger.error(f"Lỗi trong lệnh stop: {e}")
         await ctx.send("❗ Đã xảy ra lỗi khi ngắt kết nối khỏi kênh thoại.")
 
+def get_queue_position(music_player, position):
+    """
+    Chuyển vị trí người dùng nhập (bắt đầu từ 1) sang chỉ số trong hàng đợi; None nếu không hợp lệ.
+    """
+    if not 1 <= position <= len(music_player.music_queue):
+        return None
+    return position - 1
+
+@bot.command(aliases=['rm'])
+async def remove(ctx, position: int):
+    """
+    Lệnh xóa một bài khỏi hàng đợi theo vị trí.
+    """
+    try:
+        music_player = await find_music_player(ctx.guild.id, ctx.channel)
+        index = get_queue_position(music_player, position) if music_player else None
+        if index is None:
+            await ctx.send("❗ Vị trí không có trong hàng đợi.")
+            return
+        track = music_player.music_queue.remove(index)
+        if index == 0:
+            discard_prepared_source(music_player)
+        await ctx.send(f"🗑️ Đã xóa **{track.title}** khỏi hàng đợi.")
+        await send_control_panel(music_player)
+    except Exception as e:
+        logger.error(f"Lỗi trong lệnh remove: {e}")
+        await ctx.send("❗ Đã xảy ra lỗi khi xóa bài khỏi hàng đợi.")
+
+@bot.command(aliases=['mv'])
+async def move(ctx, source: int, destination: int):
+    """
+    Lệnh di chuyển một bài trong hàng đợi tới vị trí khác.
+    """
+    try:
+        music_player = await find_music_player(ctx.guild.id, ctx.channel)
+        src = get_queue_position(music_player, source) if music_player else None
+        dst = get_queue_position(music_player, destination) if music_player else None
+        if src is None or dst is None:
+            await ctx.send("❗ Vị trí không có trong hàng đợi.")
+            return
+        track = music_player.music_queue.move(src, dst)
+        if 0 in (src, dst):
+            discard_prepared_source(music_player)
+        await ctx.send(f"↕️ Đã chuyển **{track.title}** tới vị trí {destination}.")
+        await send_control_panel(music_player)
+    except Exception as e:
+        logger.error(f"Lỗi trong lệnh move: {e}")
+        await ctx.send("❗ Đã xảy ra lỗi khi di chuyển bài trong hàng đợi.")
+
+@bot.command()
+async def shuffle(ctx):
+    """
+    Lệnh xáo trộn hàng đợi.
+    """
+    try:
+        music_player = await find_music_player(ctx.guild.id, ctx.channel)
+        if not music_player or len(music_player.music_queue) < 2:
+            await ctx.send("❗ Hàng đợi không đủ bài để xáo trộn.")
+            return
+        music_player.music_queue.shuffle()
+        discard_prepared_source(music_player)
+        await ctx.send(f"🔀 Đã xáo trộn {len(music_player.music_queue)} bài trong hàng đợi.")
+        await send_control_panel(music_player)
+    except Exception as e:
+        logger.error(f"Lỗi trong lệnh shuffle: {e}")
+        await ctx.send("❗ Đã xảy ra lỗi khi xáo trộn hàng đợi.")
+
+@bot.command(aliases=['jump'])
+async def skipto(ctx, position: int):
+    """
+    Lệnh bỏ qua tới bài ở vị trí chỉ định trong hàng đợi và phát ngay.
+    """
+    try:
+        music_player = await find_music_player(ctx.guild.id, ctx.channel)
+        index = get_queue_position(music_player, position) if music_player else None
+        if index is None:
+            await ctx.send("❗ Vị trí không có trong hàng đợi.")
+            return
+        music_player.music_queue.skip_to(index)
+        if index:
+            discard_prepared_source(music_player)
+        track = music_player.music_queue[0]
+        voice_client = music_player.voice_client
+        if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+            music_player.is_looping = False  # Tắt lặp để bài được chọn phát ngay
+            voice_client.stop()  # play_next sẽ phát bài đầu hàng đợi
+        await ctx.send(f"⏭️ Bỏ qua tới **{track.title}**.")
+    except Exception as e:
+        logger.error(f"Lỗi trong lệnh skipto: {e}")
+        await ctx.send("❗ Đã xảy ra lỗi khi bỏ qua tới bài đã chọn.")
+
+@bot.command(aliases=['vol'])
+async def volume(ctx, level: int = None):
+    """
+    Lệnh xem hoặc đặt âm lượng (1-200%) của server; áp dụng từ bài tiếp theo.
+    """
+    music_player = await get_music_player(ctx.guild.id, ctx.channel)
+    if level is None:
+        await ctx.send(f"🔊 Âm lượng hiện tại: **{music_player.volume}%**")
+        return
+    if not 1 <= level <= 200:
+        await ctx.send("❗ Âm lượng phải từ 1 đến 200.")
+        return
+    music_player.volume = level
+    # Nguồn đã chuẩn bị sẵn dùng mức âm lượng cũ
+    discard_prepared_source(music_player)
+    await ctx.send(f"🔊 Đã đặt âm lượng **{level}%** (áp dụng từ bài tiếp theo).")
+    await send_control_panel(music_player)
+
+@bot.command()
+async def history(ctx, count: int = 10):
+    """
+    Lệnh xem các bài đã phát gần đây.
+    """
+    music_player = await find_music_player(ctx.guild.id, ctx.channel)
+    if not music_player or not len(music_player.history):
+        await ctx.send("📜 Chưa có bài nào được phát.")
+        return
+    count = max(1, min(count, 25))
+    lines = []
+    now = time.time()
+    for idx, entry in enumerate(music_player.history.recent(count), start=1):
+        minutes_ago = int((now - entry.played_at) // 60)
+        lines.append(f"{idx}. {truncate_label(entry.title, 80)} - {entry.duration} ({minutes_ago} phút trước)")
+    embed = discord.Embed(
+        title="📜 Lịch sử phát",
+        description="\n".join(lines),
+        color=discord.Color.blue()
+    )
+    embed.set_footer(text=f"Tổng số lần phát: {music_player.history.total_played}")
+    await ctx.send(embed=embed)
+
+@bot.command(aliases=['previous', 'prev'])
+async def back(ctx):
+    """
+    Lệnh phát lại bài trước đó; bài đang phát sẽ được phát tiếp ngay sau.
+    """
+    music_player = await find_music_player(ctx.guild.id, ctx.channel)
+    if not music_player or len(music_player.history) < (2 if music_player.current_song else 1):
+        await ctx.send("❗ Không có bài nào trước đó.")
+        return
+    if music_player.current_song:
+        # Bài đang phát là mục mới nhất trong lịch sử; đưa nó lại vào đầu hàng đợi
+        music_player.history.pop()
+        music_player.music_queue.insert(0, music_player.current_song)
+    previous = music_player.history.pop()
+    music_player.music_queue.insert(0, previous.to_track())
+    discard_prepared_source(music_player)
+    music_player.is_looping = False
+    voice_client = music_player.voice_client
+    if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+        voice_client.stop()  # play_next sẽ phát bài đầu hàng đợi
+    elif voice_client:
+        await play_next(ctx.guild.id)
+    await ctx.send(f"⏮️ Phát lại **{previous.title}**.")
+
+@bot.command()
+async def stats(ctx):
+    """
+    Lệnh hiển thị các chỉ số nội bộ của bot (bộ nhớ đệm, hàng đợi xử lý...).
+    """
+    try:
+        embed = discord.Embed(title="📊 Thống kê bot", color=discord.Color.blurple())
+        cache_stats = stream_cache.stats()
+        embed.add_field(
+            name="🗄️ Bộ nhớ đệm luồng",
+            value=(
+                f"Mục: {cache_stats['entries']} ({cache_stats['bytes'] / 1024:.1f} KiB)\n"
+                f"Trúng/Trượt: {cache_stats['hits']}/{cache_stats['misses']} "
+                f"({cache_stats['hit_ratio']:.0%})\n"
+                f"Loại bỏ: {cache_stats['evictions']} | Hết hạn: {cache_stats['expirations']}\n"
+                f"Đang trích xuất: {len(inflight_resolutions)} | Gộp yêu cầu: {inflight_resolutions.followers}"
+            ),
+            inline=False
+        )
+        scheduler_stats = extraction_scheduler.stats()
+        embed.add_field(
+            name="⚙️ Trích xuất yt-dlp",
+            value=(
+                f"Worker: {scheduler_stats['busy']}/{scheduler_stats['workers']} ({scheduler_stats['mode']})\n"
+                f"Hàng đợi: {scheduler_stats['queue_depth']} yêu cầu / {scheduler_stats['queued_guilds']} guild\n"
+                f"Chờ TB/max: {scheduler_stats['avg_wait']:.2f}s/{scheduler_stats['max_wait']:.2f}s\n"
+                f"Xử lý TB/max: {scheduler_stats['avg_service']:.2f}s/{scheduler_stats['max_service']:.2f}s\n"
+                f"Xong: {scheduler_stats['completed']} | Lỗi: {scheduler_stats['failed']} | Từ chối: {scheduler_stats['rejected']}\n"
+                f"YoutubeDL (tiến trình chính): tạo {get_ydl_pool().created}, tái sử dụng {get_ydl_pool().reused}"
+            ),
+            inline=False
+        )
+        panel_rates = {
+            guild_id: player.panel.rest_calls_per_minute() for guild_id, player in bot.music_players.items()
+        }
+        this_panel = bot.music_players[ctx.guild.id].panel if ctx.guild.id in bot.music_players else None
+        embed.add_field(
+            name="🖼️ Bảng điều khiển",
+            value=(
+                f"REST/phút: {sum(panel_rates.values())} (tất cả) | "
+                f"{panel_rates.get(ctx.guild.id, 0)} (server này) | "
+                f"cao nhất {max(panel_rates.values(), default=0)}\n"
+                + (f"Server này: vẽ {this_panel.renders}, gom {this_panel.coalesced}, bỏ qua {this_panel.skipped}"
+                   if this_panel else "Server này: chưa có bảng điều khiển")
+            ),
+            inline=False
+        )
+        shard_stats = bot.shard_stats()
+        latencies = [shard['latency'] for shard in shard_stats.values() if not math.isnan(shard['latency'])]
+        embed.add_field(
+            name="🧩 Shard",
+            value=(
+                f"Tiến trình này: {len(shard_stats)}/{bot.shard_count} shard | "
+                f"Server này thuộc shard {ctx.guild.shard_id}\n"
+                f"Độ trễ TB/max: {sum(latencies) / len(latencies) * 1000 if latencies else 0:.0f}/"
+                f"{max(latencies, default=0) * 1000:.0f} ms"
+            ),
+            inline=False
+        )
+        loop_stats = bot.loop_monitor.stats()
+        this_timing = bot.music_players[ctx.guild.id].voice_timing.stats() if ctx.guild.id in bot.music_players else None
+        embed.add_field(
+            name="⏱️ Độ trễ",
+            value=(
+                f"Event loop: {loop_stats['lag'].summary()} | Bị chặn: {loop_stats['stalls']} lần\n"
+                f"Bắt đầu phát (yêu cầu → gói đầu tiên): {track_start_latency.summary()}\n"
+                + (f"Gói thoại server này: trễ {this_timing['late_frames']}/{this_timing['frames']} "
+                   f"({this_timing['late_ratio']:.2%})" if this_timing else "Gói thoại server này: chưa phát")
+            ),
+            inline=False
+        )
+        presence_stats = bot.presence.stats()
+        embed.add_field(
+            name="🟢 Trạng thái bot",
+            value=f"Đã cập nhật: {presence_stats['updates']} | Bỏ qua (không đổi): {presence_stats['skipped']}",
+            inline=False
+        )
+        player_stats = bot.player_stats
+        embed.add_field(
+            name="👥 MusicPlayer",
+            value=(
+                f"Đang giữ: {len(bot.music_players)} | "
+                f"Đang trong kênh thoại: {sum(1 for p in bot.music_players.values() if p.voice_client)} | "
+                f"Đã giải phóng: {player_stats['evicted']} | Đã khôi phục: {player_stats['restored']}"
+            ),
+            inline=False
+        )
+        loudness_stats = loudness_analyzer.stats()
+        embed.add_field(
+            name="🔊 Cân bằng âm lượng",
+            value=(
+                f"Đã phân tích: {loudness_stats['analyzed']} | Lỗi: {loudness_stats['failed']} | "
+                f"Đang chờ: {loudness_stats['pending']}\n"
+                f"Nguồn FFmpeg: {ffmpeg_mode_counts['copy']} stream copy, {ffmpeg_mode_counts['gain']} mã hóa lại"
+            ),
+            inline=False
+        )
+        if broadcast_hub:
+            broadcast_stats = broadcast_hub.stats()
+            embed.add_field(
+                name="📡 Phát chung",
+                value=(
+                    f"Luồng FFmpeg: {broadcast_stats['streams']} cho {broadcast_stats['consumers']} guild | "
+                    f"Bộ đệm: {broadcast_stats['buffered_bytes'] / 1024 / 1024:.1f} MB\n"
+                    f"Đã mở: {broadcast_stats['opened']} | Dùng chung: {broadcast_stats['shared']}"
+                ),
+                inline=False
+            )
+        ffmpeg_stats = ffmpeg_supervisor.stats()
+        embed.add_field(
+            name="🎛️ Tiến trình FFmpeg",
+            value=(
+                f"Đang chạy: {ffmpeg_stats['active']}"
+                + (f"/{ffmpeg_stats['limit']} (toàn máy)" if ffmpeg_stats['limit'] else "")
+                + f" | CPU: {ffmpeg_stats['cpu_seconds']:.1f}s | RSS: {ffmpeg_stats['rss_bytes'] / 1024 ** 2:.1f} MiB\n"
+                f"Đã khởi chạy: {ffmpeg_stats['spawned']} | Phải chờ: {ffmpeg_stats['waited']} | "
+                f"Từ chối: {ffmpeg_stats['rejected']}\n"
+                f"Lý do thoát: {', '.join(f'{k}: {v}' for k, v in ffmpeg_stats['exit_reasons'].items()) or 'chưa có'}"
+            ),
+            inline=False
+        )
+        if audio_worker_pool:
+            worker_stats = audio_worker_pool.stats()
+            embed.add_field(
+                name="🧵 Worker âm thanh",
+                value=(
+                    f"Đang chạy: {worker_stats['alive']}/{worker_stats['workers']} | "
+                    f"Bài theo worker: {', '.join(map(str, worker_stats['jobs'])) or '-'}\n"
+                    f"Đã mở: {worker_stats['opened']} | Gói đã nhận: {worker_stats['frames']} | "
+                    f"Gián đoạn: {worker_stats['stalls']} | Khởi chạy lại: {worker_stats['respawned']}"
+                ),
+                inline=False
+            )
+        autoplay_stats = Counter()
+        for player in bot.music_players.values():
+            autoplay_stats.update(player.autoplay.stats())
+        embed.add_field(
+            name="🎲 Tự động phát",
+            value=(
+                f"Đã chọn: {autoplay_stats['picks']} | Bỏ qua bài vừa phát: {autoplay_stats['repeats_skipped']} | "
+                f"Xếp lại túi: {autoplay_stats['rebuilds']} | Bài liên quan: {autoplay_stats['related']}"
+            ),
+            inline=False
+        )
+        footprints = {guild_id: player.memory_footprint() for guild_id, player in bot.music_players.items()}
+        this_footprint = footprints.get(ctx.guild.id)
+        embed.add_field(
+            name="💾 Bộ nhớ theo server",
+            value=(
+                (f"Server này: {this_footprint['total'] / 1024:.1f} KB "
+                 f"(hàng đợi {this_footprint['queue'] / 1024:.1f} KB, lịch sử {this_footprint['history'] / 1024:.1f} KB, "
+                 f"gần đây {this_footprint['recent'] / 1024:.1f} KB)\n" if this_footprint else "")
+                + f"Tất cả {len(footprints)} server: {sum(f['total'] for f in footprints.values()) / 1024:.1f} KB | "
+                f"cao nhất {max((f['total'] for f in footprints.values()), default=0) / 1024:.1f} KB"
+            ),
+            inline=False
+        )
+        api_stats = bot.youtube_api.stats()
+        embed.add_field(
+            name="🔎 Tìm kiếm YouTube",
+            value=(
+                f"Bộ nhớ đệm: {api_stats['search_entries']} truy vấn | "
+                f"Trúng/Trượt: {api_stats['search_hits']}/{api_stats['search_misses']} "
+                f"({api_stats['search_hit_ratio']:.0%})\n"
+                f"Thời lượng video: {api_stats['details_entries']} mục ({api_stats['details_hit_ratio']:.0%} trúng), "
+                f"{api_stats['details_batches']} lần gọi gom {api_stats['details_batched_ids']} ID\n"
+                f"Quota hôm nay: {api_stats['quota_spent']} đã dùng "
+                f"({', '.join(f'{k}: {v}' for k, v in api_stats['quota_by_endpoint'].items()) or 'chưa dùng'}), "
+                f"còn {api_stats['quota_remaining']}\n"
+                f"Bị giới hạn tốc độ: {api_stats['rate_limited']} | Tìm bằng yt-dlp: {api_stats['fallback_searches']}"
+            ),
+            inline=False
+        )
+        if resolution_store:
+            store_stats = resolution_store.stats()
+            embed.add_field(
+                name="🗃️ Dữ liệu phân giải đã lưu",
+                value=(
+                    f"Trúng/Trượt: {store_stats['hits']}/{store_stats['misses']} | "
+                    f"Đã ghi: {store_stats['writes']}"
+                ),
+                inline=False
+            )
+        if disk_audio_cache:
+            disk_stats = disk_audio_cache.stats()
+            embed.add_field(
+                name="💾 Bộ nhớ đệm trên đĩa",
+                value=(
+                    f"Bài: {disk_stats['entries']} | "
+                    f"{disk_stats['bytes'] / 1024 ** 2:.1f}/{disk_stats['max_bytes'] / 1024 ** 2:.0f} MiB\n"
+                    f"Trúng/Trượt: {disk_stats['hits']}/{disk_stats['misses']} | "
+                    f"Đã lưu: {disk_stats['stores']} | Loại bỏ: {disk_stats['evictions']} | "
+                    f"Đang tải: {disk_stats['downloading']}"
+                ),
+                inline=False
+            )
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logger.error(f"Lỗi trong lệnh stats: {e}")
+        await ctx.send("❗ Đã xảy ra lỗi khi lấy thống kê.")
+
+@bot.command()
+async def lag(ctx):
+    """
+    Lệnh hiển thị độ trễ event loop (kèm vị trí code gần nhất làm chặn loop) và nhịp gửi gói thoại theo server.
+    """
+    loop_stats = bot.loop_monitor.stats()
+    embed = discord.Embed(title="⏱️ Độ trễ", color=discord.Color.blurple())
+    last_stall = loop_stats['last_stall']
+    embed.add_field(
+        name="Event loop",
+        value=(
+            f"{loop_stats['lag'].summary()}\nBị chặn: {loop_stats['stalls']} lần"
+            + (f"\nGần nhất: {last_stall[1] * 1000:.0f}ms tại `{last_stall[2]}` "
+               f"(<t:{int(last_stall[0])}:R>)" if last_stall else "")
+        ),
+        inline=False
+    )
+    music_player = bot.music_players.get(ctx.guild.id)
+    if music_player:
+        timing = music_player.voice_timing
+        timing_stats = timing.stats()
+        embed.add_field(
+            name="Gói thoại server này",
+            value=(
+                f"Khoảng cách: {timing.intervals.summary()}\n"
+                f"Thời gian đọc nguồn: {timing.read_time.summary()}\n"
+                f"Trễ: {timing_stats['late_frames']}/{timing_stats['frames']} gói ({timing_stats['late_ratio']:.2%}) | "
+                f"Tạm dừng: {timing_stats['gaps']}"
+            ),
+            inline=False
+        )
+    worst = sorted(
+        ((guild_id, player.voice_timing.stats()) for guild_id, player in bot.music_players.items()),
+        key=lambda item: item[1]['late_ratio'], reverse=True
+    )[:5]
+    lines = [
+        f"`{guild_id}` trễ {timing_stats['late_ratio']:.2%} ({timing_stats['late_frames']}/{timing_stats['frames']} gói)"
+        for guild_id, timing_stats in worst if timing_stats['late_frames']
+    ]
+    embed.add_field(name="Server trễ nhiều nhất", value="\n".join(lines) or "Không có", inline=False)
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def shards(ctx):
+    """
+    Lệnh hiển thị độ trễ, số server, kết nối thoại và MusicPlayer của từng shard trong tiến trình này.
+    """
+    shard_stats = bot.shard_stats()
+    lines = []
+    for shard_id, shard in sorted(shard_stats.items())[:QUEUE_LIST_MAX_ITEMS * 2]:
+        latency = "mất kết nối" if shard['closed'] or math.isnan(shard['latency']) else f"{shard['latency'] * 1000:.0f} ms"
+        marker = " ⬅️" if ctx.guild and shard_id == ctx.guild.shard_id else ""
+        lines.append(
+            f"`#{shard_id}` {latency} | {shard['guilds']} server | "
+            f"{shard['voice']} thoại | {shard['players']} MusicPlayer{marker}"
+        )
+    if len(shard_stats) > QUEUE_LIST_MAX_ITEMS * 2:
+        lines.append(f"... và {len(shard_stats) - QUEUE_LIST_MAX_ITEMS * 2} shard khác")
+    embed = discord.Embed(
+        title=f"🧩 Shard ({len(shard_stats)}/{bot.shard_count} trong tiến trình này)",
+        description="\n".join(lines) or "Chưa có shard nào kết nối.",
+        color=discord.Color.blurple()
+    )
+    await ctx.send(embed=embed)
+
+@bot.command()
+async def ffmpeg(ctx):
+    """
+    Lệnh liệt kê các tiến trình FFmpeg đang phát (thời gian chạy, dữ liệu đã đọc, CPU, RSS)
+    và lý do kết thúc của các tiến trình gần đây.
+    """
+    now = time.time()
+    active = ffmpeg_supervisor.snapshot()
+    lines = [
+        f"`{info.pid}` {info.label} ({info.mode}) - {int(now - info.started_at)}s, "
+        f"{info.bytes_read / 1024:.0f} KB, CPU {info.cpu_seconds or 0:.1f}s, "
+        f"RSS {(info.rss_bytes or 0) / 1024 ** 2:.1f} MiB"
+        for info in active[:QUEUE_LIST_MAX_ITEMS]
+    ]
+    if len(active) > QUEUE_LIST_MAX_ITEMS:
+        lines.append(f"... và {len(active) - QUEUE_LIST_MAX_ITEMS} tiến trình khác")
+    recent = list(ffmpeg_supervisor.finished)[-5:]
+    recent_lines = [
+        f"`{info.pid}` {info.label}: **{info.reason}** sau {int(info.ended_at - info.started_at)}s"
+        for info in reversed(recent)
+    ]
+    embed = discord.Embed(title="🎛️ Tiến trình FFmpeg", color=discord.Color.blurple())
+    embed.add_field(name="Đang chạy", value="\n".join(lines) or "Không có", inline=False)
+    embed.add_field(name="Kết thúc gần đây", value="\n".join(recent_lines) or "Chưa có", inline=False)
+    await ctx.send(embed=embed)
+
 # -----------------------------#
 #        Định Nghĩa Sự Kiện     #
 # -----------------------------#
@@ -934,6 +5492,31 @@ async def on_disconnect():
     """
     logger.info("Bot đã ngắt kết nối khỏi Discord.")
 
+@bot.event
+async def on_shard_ready(shard_id):
+    """
+    Sự kiện khi một shard đã sẵn sàng.
+    """
+    current_shard.set(shard_id)
+    guilds = sum(1 for guild in bot.guilds if guild.shard_id == shard_id)
+    logger.info(f"Shard {shard_id}/{bot.shard_count} đã sẵn sàng với {guilds} server.")
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    """
+    Sự kiện khi một shard mất kết nối gateway.
+    """
+    current_shard.set(shard_id)
+    logger.warning(f"Shard {shard_id} đã ngắt kết nối khỏi gateway.")
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    """
+    Sự kiện khi một shard nối lại phiên gateway.
+    """
+    current_shard.set(shard_id)
+    logger.info(f"Shard {shard_id} đã nối lại phiên.")
+
 @bot.event
 async def on_error(event, *args, **kwargs):
     """
@@ -950,6 +5533,8 @@ async def on_command_error(ctx, error):
         await ctx.send("❗ Lệnh không tồn tại. Vui lòng kiểm tra lại.")
     elif isinstance(error, commands.MissingRequiredArgument):
         await ctx.send("❗ Thiếu đối số cần thiết cho lệnh này.")
+    elif isinstance(error, commands.BadArgument):
+        await ctx.send("❗ Đối số không hợp lệ. Vui lòng kiểm tra lại.")
     else:
         logger.error(f"Lỗi trong lệnh {ctx.command}: {error}")
         await ctx.send("❗ Đã xảy ra lỗi khi xử lý lệnh của bạn.")
@@ -961,4 +5546,14 @@ async def on_command_error(ctx, error):
 # Đảm bảo đóng session aiohttp khi bot tắt bằng cách sử dụng phương thức close của lớp MyBot
 # Không cần tạo task ở đây
 
-bot.run(TOKEN)
+def main():
+    """
+    Điểm khởi chạy bot: kiểm tra ffmpeg, thiết lập logging rồi kết nối Discord.
+    """
+    check_ffmpeg()
+    configure_logging()
+    bot.run(TOKEN)
+
+# Chỉ chạy bot khi file được chạy trực tiếp (các tiến trình worker có thể import lại file này)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import bot
+
+
+def test_stopped_process():
+    assert bot.classify_ffmpeg_exit(None, '', stopped=True) == 'stopped'
+    assert bot.classify_ffmpeg_exit(-15, '', stopped=True) == 'stopped'
+
+
+def test_clean_exit():
+    assert bot.classify_ffmpeg_exit(0, '', stopped=False) == 'eof'
+
+
+def test_http_errors_from_ffmpeg_messages():
+    stderr_403 = '[https @ 0x55] HTTP error 403 Forbidden\nError opening input files: Server returned 403 Forbidden (access denied)'
+    stderr_404 = 'Error opening input: Server returned 404 Not Found'
+    assert bot.classify_ffmpeg_exit(1, stderr_403, stopped=False) == 'http_403'
+    assert bot.classify_ffmpeg_exit(1, stderr_404, stopped=False) == 'http_404'
+
+
+def test_numbers_in_stderr_are_not_http_errors():
+    stderr = 'Option reconnect not found.\n[aac @ 0x1404] frame size 4040 too large'
+    assert bot.classify_ffmpeg_exit(1, stderr, stopped=False) == 'exit_1'
+
+
+def test_network_and_invalid_data():
+    assert bot.classify_ffmpeg_exit(1, 'Connection reset by peer', stopped=False) == 'network'
+    assert bot.classify_ffmpeg_exit(1, 'Invalid data found when processing input', stopped=False) == 'invalid_data'
+
+
+def test_stderr_tail_keeps_last_bytes():
+    tail = bot.StderrTail(8)
+    tail.write(b'0123456789')
+    tail.write(b'ab')
+    assert tail.text() == '456789ab'
@@ -0,0 +1,38 @@
+import bot
+
+
+def test_writer_formats_samples_and_labels():
+    writer = bot.MetricsWriter()
+    writer.gauge('x_gauge', 'Mô tả.', 3)
+    writer.counter('x_events', 'Sự kiện.', [({'reason': 'a"b'}, 2)])
+    text = writer.render()
+    assert '# TYPE x_gauge gauge\nx_gauge 3\n' in text
+    assert '# TYPE x_events counter\n' in text
+    assert 'x_events_total{reason="a\\"b"} 2\n' in text
+
+
+def test_histogram_exported_in_seconds():
+    histogram = bot.Histogram((10, 100))
+    for value in (5, 50, 500):
+        histogram.observe(value)
+    writer = bot.MetricsWriter()
+    writer.histogram('x_seconds', 'Thời gian.', histogram)
+    lines = writer.render().splitlines()
+    assert 'x_seconds_bucket{le="0.01"} 1' in lines
+    assert 'x_seconds_bucket{le="0.1"} 2' in lines
+    assert 'x_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'x_seconds_sum 0.555' in lines
+    assert 'x_seconds_count 3' in lines
+
+
+def test_render_metrics_without_connection():
+    text = bot.render_metrics()
+    assert text.endswith('\n')
+    assert 'musicbot_guilds 0' in text
+    assert 'musicbot_queue_tracks 0' in text
+    assert '# TYPE musicbot_track_start_seconds histogram' in text
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            assert name
+            float(value)
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import time
+
+import bot
+
+
+def setup(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, 'PLAYER_STATE_DIR', str(tmp_path))
+    monkeypatch.setattr(bot.bot, 'music_players', {})
+    offloaded = []
+    to_thread = asyncio.to_thread
+
+    async def recording_to_thread(func, *args):
+        offloaded.append(func)
+        return await to_thread(func, *args)
+
+    monkeypatch.setattr(bot.asyncio, 'to_thread', recording_to_thread)
+    return offloaded
+
+
+def write_state(guild_id, age=0):
+    state = {
+        "text_channel_id": None, "is_looping": True, "volume": 50,
+        "queue": [{"title": "đã lưu", "duration": 180, "id": "abc123def45"}],
+    }
+    bot.write_player_state(guild_id, state)
+    path = bot.player_state_path(guild_id)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_evicted_player_is_restored_off_loop(monkeypatch, tmp_path):
+    offloaded = setup(monkeypatch, tmp_path)
+    path = write_state(7)
+    music_player = asyncio.run(bot.find_music_player(7))
+    assert offloaded == [bot.read_player_state]
+    assert music_player is bot.bot.music_players[7]
+    assert music_player.volume == 50 and music_player.is_looping
+    assert [track.title for track in music_player.music_queue] == ["đã lưu"]
+    assert not os.path.exists(path)
+
+
+def test_stale_state_is_discarded(monkeypatch, tmp_path):
+    setup(monkeypatch, tmp_path)
+    path = write_state(7, age=bot.PLAYER_STATE_RETENTION + 60)
+    assert asyncio.run(bot.find_music_player(7)) is None
+    assert not os.path.exists(path)
+    assert 7 not in bot.bot.music_players
+
+
+def test_corrupt_state_is_ignored(monkeypatch, tmp_path):
+    setup(monkeypatch, tmp_path)
+    with open(bot.player_state_path(7), 'w', encoding='utf-8') as f:
+        f.write("{")
+    assert asyncio.run(bot.find_music_player(7)) is None
+    assert bot.bot.music_players == {}
@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeBot:
+    def __init__(self, titles):
+        self.music_players = {
+            guild_id: SimpleNamespace(
+                guild_id=guild_id, current_song=SimpleNamespace(title=title), voice_client=object()
+            )
+            for guild_id, title in enumerate(titles)
+        }
+        self.presences = []
+
+    async def wait_until_ready(self):
+        pass
+
+    async def change_presence(self, activity):
+        self.presences.append(activity.name)
+
+
+def test_rotation_advances_only_after_interval(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(bot, 'PRESENCE_ROTATE_SECONDS', 30)
+    scheduler = bot.PresenceScheduler(FakeBot(['a', 'b']))
+    now[0] += 10
+    assert scheduler.advance_rotation() == 20
+    assert scheduler._rotation == 0
+    now[0] += 25
+    assert scheduler.advance_rotation() == 30
+    assert scheduler._rotation == 1
+
+
+def test_rotation_continues_during_notify_bursts(monkeypatch):
+    monkeypatch.setattr(bot, 'PRESENCE_ROTATE_SECONDS', 0.05)
+    monkeypatch.setattr(bot, 'PRESENCE_MIN_INTERVAL', 0)
+    fake_bot = FakeBot(['a', 'b'])
+
+    async def scenario():
+        scheduler = bot.PresenceScheduler(fake_bot)
+        scheduler.start()
+        # Sự kiện liên tục tới nhanh hơn chu kỳ xoay vòng
+        for _ in range(30):
+            scheduler.notify()
+            await asyncio.sleep(0.01)
+        await scheduler.close()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler._rotation >= 3
+    assert {"nhạc ở 2 server", ": a", ": b"} <= set(fake_bot.presences)
@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeContext:
+    """
+    Ngữ cảnh lệnh tối giản: ghi lại các tin nhắn bot gửi.
+    """
+    def __init__(self, guild_id=1):
+        self.guild = SimpleNamespace(id=guild_id)
+        self.channel = None
+        self.messages = []
+
+    async def send(self, content):
+        self.messages.append(content)
+
+
+def setup_player(monkeypatch, count):
+    music_player = bot.MusicPlayer(1, None)
+    music_player.music_queue.extend(bot.Track(None, f"t{i}") for i in range(count))
+    monkeypatch.setattr(bot.bot, 'music_players', {1: music_player})
+
+    async def send_control_panel(player):
+        pass
+
+    monkeypatch.setattr(bot, 'send_control_panel', send_control_panel)
+    return music_player
+
+
+def titles(music_player):
+    return [track.title for track in music_player.music_queue]
+
+
+def test_out_of_range_positions_are_rejected(monkeypatch):
+    music_player = setup_player(monkeypatch, 3)
+    ctx = FakeContext()
+    asyncio.run(bot.remove.callback(ctx, 0))
+    asyncio.run(bot.remove.callback(ctx, 4))
+    asyncio.run(bot.move.callback(ctx, 1, 9))
+    asyncio.run(bot.skipto.callback(ctx, -1))
+    assert ctx.messages == ["❗ Vị trí không có trong hàng đợi."] * 4
+    assert titles(music_player) == ["t0", "t1", "t2"]
+
+
+def test_commands_without_player(monkeypatch):
+    monkeypatch.setattr(bot.bot, 'music_players', {})
+    monkeypatch.setattr(bot, 'PLAYER_STATE_DIR', None)
+    ctx = FakeContext()
+    asyncio.run(bot.remove.callback(ctx, 1))
+    asyncio.run(bot.shuffle.callback(ctx))
+    assert ctx.messages == ["❗ Vị trí không có trong hàng đợi.", "❗ Hàng đợi không đủ bài để xáo trộn."]
+
+
+def test_remove_and_move_in_range(monkeypatch):
+    music_player = setup_player(monkeypatch, 3)
+    ctx = FakeContext()
+    asyncio.run(bot.remove.callback(ctx, 2))
+    asyncio.run(bot.move.callback(ctx, 2, 1))
+    assert titles(music_player) == ["t2", "t0"]
+    assert ctx.messages == ["🗑️ Đã xóa **t1** khỏi hàng đợi.", "↕️ Đã chuyển **t2** tới vị trí 1."]
+
+
+def test_unexpected_error_is_reported(monkeypatch):
+    music_player = setup_player(monkeypatch, 2)
+
+    def broken_shuffle():
+        raise RuntimeError("hỏng")
+
+    monkeypatch.setattr(music_player.music_queue, 'shuffle', broken_shuffle)
+    ctx = FakeContext()
+    asyncio.run(bot.shuffle.callback(ctx))
+    assert ctx.messages == ["❗ Đã xảy ra lỗi khi xáo trộn hàng đợi."]
@@ -0,0 +1,39 @@
+import asyncio
+
+import bot
+
+
+def test_single_flight_shares_one_call():
+    calls = []
+
+    async def resolve():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'kết quả'
+
+    async def scenario():
+        flight = bot.SingleFlight()
+        results = await asyncio.gather(*(flight.run('v', resolve) for _ in range(5)))
+        assert results == ['kết quả'] * 5
+        assert flight.leaders == 1 and flight.followers == 4
+        assert len(flight) == 0
+        assert await flight.run('v', resolve) == 'kết quả'
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def test_single_flight_cancelled_caller_does_not_cancel_others():
+    async def resolve():
+        await asyncio.sleep(0.02)
+        return 1
+
+    async def scenario():
+        flight = bot.SingleFlight()
+        first = asyncio.create_task(flight.run('v', resolve))
+        second = asyncio.create_task(flight.run('v', resolve))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 1
+
+    asyncio.run(scenario())
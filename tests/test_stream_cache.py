@@ -0,0 +1,60 @@
+import time
+
+import bot
+
+
+def audio_data(expires_at=None):
+    return {'url': 'https://example.invalid/stream', 'title': 'bài', 'expires_at': expires_at}
+
+
+def test_get_returns_copy_and_counts():
+    cache = bot.StreamCache(10, 10 ** 6, 3600)
+    cache.set('a', audio_data())
+    first = cache.get('a')
+    first['title'] = 'đã sửa'
+    assert cache.get('a')['title'] == 'bài'
+    assert cache.get('missing') is None
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+
+
+def test_ttl_follows_stream_expiry(monkeypatch):
+    now = time.time()
+    cache = bot.StreamCache(10, 10 ** 6, 3600)
+    cache.set('a', audio_data(expires_at=now + bot.STREAM_URL_EXPIRY_MARGIN + 10))
+    assert 'a' in cache
+    monkeypatch.setattr(bot.time, 'time', lambda: now + 11)
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_default_ttl_without_expiry(monkeypatch):
+    now = time.time()
+    cache = bot.StreamCache(10, 10 ** 6, 60)
+    cache.set('a', audio_data())
+    monkeypatch.setattr(bot.time, 'time', lambda: now + 61)
+    assert cache.get('a') is None
+
+
+def test_already_expired_is_not_stored():
+    cache = bot.StreamCache(10, 10 ** 6, 3600)
+    cache.set('a', audio_data(expires_at=time.time() + bot.STREAM_URL_EXPIRY_MARGIN - 1))
+    assert len(cache) == 0
+
+
+def test_lru_eviction_by_entries():
+    cache = bot.StreamCache(2, 10 ** 6, 3600)
+    cache.set('a', audio_data())
+    cache.set('b', audio_data())
+    cache.get('a')
+    cache.set('c', audio_data())
+    assert 'a' in cache and 'c' in cache and 'b' not in cache
+    assert cache.stats()['evictions'] == 1
+
+
+def test_eviction_by_bytes():
+    cache = bot.StreamCache(100, 1, 3600)
+    cache.set('a', audio_data())
+    assert len(cache) == 0
+    assert cache.current_bytes == 0
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+import bot
+
+
+class FakeStore:
+    """
+    Kho phân giải trả về một URL đã lưu còn hạn cho mọi video.
+    """
+    def __init__(self):
+        self.reads = 0
+        self.writes = []
+
+    def get(self, video_id):
+        self.reads += 1
+        return {
+            'url': 'https://example.invalid/stored', 'title': 'đã lưu', 'thumbnail': None,
+            'duration': '3:00', 'duration_seconds': 180, 'video_id': video_id,
+            'webpage_url': f'https://www.youtube.com/watch?v={video_id}', 'expires_at': time.time() + 3600,
+        }
+
+    def put(self, video_id, audio_data, info=None):
+        self.writes.append(audio_data['url'])
+
+
+def fresh_info(video_id):
+    return {
+        'url': 'https://example.invalid/fresh', 'title': 'mới', 'thumbnail': None, 'duration': 180,
+        'id': video_id, 'webpage_url': f'https://www.youtube.com/watch?v={video_id}', 'attempt': 1,
+    }
+
+
+def setup(monkeypatch):
+    submits = []
+
+    async def submit(guild_id, func, url, *args):
+        submits.append(url)
+        return fresh_info(bot.extract_video_id(url))
+
+    store = FakeStore()
+    monkeypatch.setattr(bot, 'resolution_store', store)
+    monkeypatch.setattr(bot, 'stream_cache', bot.StreamCache(100, 10 ** 6, 3600))
+    monkeypatch.setattr(bot.extraction_scheduler, 'submit', submit)
+    return store, submits
+
+
+def test_stored_url_used_without_refresh(monkeypatch):
+    store, submits = setup(monkeypatch)
+    player = bot.MusicPlayer(1, None)
+    audio_data = asyncio.run(bot.get_audio_stream_url(player, 'https://www.youtube.com/watch?v=aaaaaaaaaaa'))
+    assert audio_data['url'] == 'https://example.invalid/stored'
+    assert submits == []
+
+
+def test_forced_refresh_skips_store_and_extracts(monkeypatch):
+    store, submits = setup(monkeypatch)
+    player = bot.MusicPlayer(1, None)
+    url = 'https://www.youtube.com/watch?v=aaaaaaaaaaa'
+    audio_data = asyncio.run(bot.get_audio_stream_url(player, url, force_refresh=True))
+    assert submits == [url]
+    assert store.reads == 0
+    assert audio_data['url'] == 'https://example.invalid/fresh'
+    assert bot.stream_cache.get('aaaaaaaaaaa')['url'] == 'https://example.invalid/fresh'
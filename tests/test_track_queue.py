@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def make_queue(count):
+    queue = bot.TrackQueue()
+    queue.extend(bot.Track(None, f"t{i}") for i in range(count))
+    return queue
+
+
+def titles(queue):
+    return [track.title for track in queue]
+
+
+def test_popleft_and_peek():
+    queue = make_queue(3)
+    assert queue.popleft().title == "t0"
+    assert [track.title for track in queue.peek(2)] == ["t1", "t2"]
+    assert [track.title for track in queue.peek(5, start=1)] == ["t2"]
+    assert len(queue) == 2
+    assert queue[0].title == "t1"
+
+
+def test_popleft_empty_returns_none():
+    queue = bot.TrackQueue()
+    assert queue.empty()
+    assert queue.popleft() is None
+
+
+def test_compacts_after_many_pops():
+    queue = make_queue(10)
+    for _ in range(8):
+        queue.popleft()
+    assert titles(queue) == ["t8", "t9"]
+    assert len(queue._items) < 10
+
+
+def test_insert_remove_move():
+    queue = make_queue(4)
+    queue.popleft()
+    queue.insert(0, bot.Track(None, "next"))
+    queue.insert(99, bot.Track(None, "last"))
+    assert titles(queue) == ["next", "t1", "t2", "t3", "last"]
+    assert queue.remove(1).title == "t1"
+    queue.move(3, 0)
+    assert titles(queue) == ["last", "next", "t2", "t3"]
+
+
+def test_invalid_index_raises():
+    queue = make_queue(2)
+    with pytest.raises(IndexError):
+        queue.remove(2)
+    with pytest.raises(IndexError):
+        queue.move(0, -1)
+
+
+def test_skip_to():
+    queue = make_queue(5)
+    assert queue.skip_to(3) == 3
+    assert titles(queue) == ["t3", "t4"]
+
+
+def test_shuffle_keeps_tracks():
+    queue = make_queue(20)
+    queue.popleft()
+    queue.shuffle()
+    assert sorted(titles(queue)) == sorted(f"t{i}" for i in range(1, 20))
+
+
+def test_wait_not_empty():
+    async def scenario():
+        queue = bot.TrackQueue()
+        waiter = asyncio.create_task(queue.wait_not_empty())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        queue.append(bot.Track(None, "t0"))
+        await asyncio.wait_for(waiter, timeout=1)
+        queue.clear()
+        assert not queue._not_empty.is_set()
+
+    asyncio.run(scenario())
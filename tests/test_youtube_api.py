@@ -0,0 +1,197 @@
+import asyncio
+import datetime
+
+import bot
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.status = 200
+        self._data = data
+
+    async def json(self, **kwargs):
+        return self._data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    """
+    Trả lời search/videos của YouTube Data API bằng dữ liệu cố định và ghi lại các lần gọi.
+    """
+    def __init__(self, video_ids):
+        self.video_ids = video_ids
+        self.calls = []
+
+    def get(self, url, params=None):
+        endpoint = url.rstrip('/').rsplit('/', 1)[-1]
+        self.calls.append((endpoint, params))
+        if endpoint == 'search':
+            return FakeResponse({'items': [
+                {'id': {'videoId': video_id},
+                 'snippet': {'title': f'Bài {video_id}', 'thumbnails': {'default': {'url': 'thumb'}}}}
+                for video_id in self.video_ids
+            ]})
+        ids = params['id'].split(',')
+        return FakeResponse({'items': [
+            {'id': video_id, 'contentDetails': {'duration': 'PT3M5S'}} for video_id in ids
+        ]})
+
+
+def test_normalize_query_folds_case_spacing_and_diacritics():
+    assert bot.normalize_query('  Sơn  Tùng   M-TP ') == 'son tung m-tp'
+    assert bot.normalize_query('ĐEN VÂU') == bot.normalize_query('đen vâu') == 'den vau'
+    assert bot.normalize_query('Lạc Trôi') == bot.normalize_query('lac troi')
+
+
+def test_search_cache_hits_on_equivalent_queries():
+    async def scenario():
+        api = bot.YouTubeAPI('key')
+        api.session = FakeSession(['aaaaaaaaaaa', 'bbbbbbbbbbb'])
+        first = await api.search_youtube('Lạc Trôi', max_results=2)
+        second = await api.search_youtube('  lac   TROI ', max_results=2)
+        return api, first, second
+
+    api, first, second = asyncio.run(scenario())
+    assert first == second
+    assert [result['duration'] for result in first] == ['3:05', '3:05']
+    assert [endpoint for endpoint, _ in api.session.calls] == ['search', 'videos']
+    assert api.stats()['search_hits'] == 1
+    assert api.stats()['search_misses'] == 1
+
+
+def test_cached_results_are_copies():
+    async def scenario():
+        api = bot.YouTubeAPI('key')
+        api.session = FakeSession(['aaaaaaaaaaa'])
+        first = await api.search_youtube('abc', max_results=1)
+        first[0]['title'] = 'đã sửa'
+        return await api.search_youtube('abc', max_results=1)
+
+    assert asyncio.run(scenario())[0]['title'] == 'Bài aaaaaaaaaaa'
+
+
+def test_durations_shared_across_queries():
+    async def scenario():
+        api = bot.YouTubeAPI('key')
+        api.session = FakeSession(['aaaaaaaaaaa'])
+        await api.search_youtube('một', max_results=1)
+        await api.search_youtube('hai', max_results=1)
+        return api
+
+    api = asyncio.run(scenario())
+    assert [endpoint for endpoint, _ in api.session.calls] == ['search', 'videos', 'search']
+
+
+def test_fallback_results_are_not_kept_for_full_ttl(monkeypatch):
+    submits = []
+
+    async def submit(guild_id, func, query, max_results):
+        submits.append(query)
+        return [{'title': 'yt-dlp', 'url': 'https://www.youtube.com/watch?v=ccccccccccc',
+                 'thumbnail': None, 'duration': '2:00'}]
+
+    monkeypatch.setattr(bot.extraction_scheduler, 'submit', submit)
+
+    async def scenario():
+        api = bot.YouTubeAPI('key')
+        api.session = FakeSession(['aaaaaaaaaaa'])
+        api.quota.mark_exhausted()
+        first = await api.search_youtube('abc', max_results=1)
+        second = await api.search_youtube('abc', max_results=1)
+        return api, first, second
+
+    api, first, second = asyncio.run(scenario())
+    assert first == second and submits == ['abc']
+    assert len(api.search_cache) == 0
+    assert len(api.degraded_search_cache) == 1
+    assert api.degraded_search_cache.ttl == bot.SEARCH_DEGRADED_CACHE_TTL
+
+
+def test_unknown_durations_are_not_kept_for_full_ttl():
+    class NoDetailsSession(FakeSession):
+        def get(self, url, params=None):
+            if url.endswith('/videos'):
+                self.calls.append(('videos', params))
+                return FakeResponse({'items': []})
+            return super().get(url, params)
+
+    async def scenario():
+        api = bot.YouTubeAPI('key')
+        api.session = NoDetailsSession(['aaaaaaaaaaa'])
+        degraded = await api.search_youtube('abc', max_results=1)
+        api.degraded_search_cache.clear()  # Hết hạn ngắn: lần sau gọi lại API
+        api.session = FakeSession(['aaaaaaaaaaa'])
+        api.duration_cache.clear()
+        fresh = await api.search_youtube('abc', max_results=1)
+        return api, degraded, fresh
+
+    api, degraded, fresh = asyncio.run(scenario())
+    assert degraded[0]['duration'] == 'Unknown'
+    assert fresh[0]['duration'] == '3:05'
+    assert [endpoint for endpoint, _ in api.session.calls] == ['search', 'videos']
+    assert len(api.search_cache) == 1 and len(api.degraded_search_cache) == 0
+
+
+def test_quota_spend_and_remaining():
+    quota = bot.QuotaTracker(100)
+    quota.spend('search', 100 - 1)
+    assert quota.remaining == 1
+    assert quota.can_spend(1)
+    assert not quota.can_spend(2)
+    assert quota.spent['search'] == 99
+
+
+def test_quota_exhausted_until_rollover():
+    quota = bot.QuotaTracker(10000)
+    quota.spend('videos', 1)
+    quota.mark_exhausted()
+    assert quota.remaining == 0
+    # Sang ngày mới (giờ Thái Bình Dương): quota được đặt lại
+    quota.day -= datetime.timedelta(days=1)
+    assert quota.remaining == 10000
+    assert not quota.exhausted
+    assert quota.total_spent == 0
+
+
+def test_token_bucket_allows_burst_then_waits(monkeypatch):
+    clock = [1000.0]
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(bot.asyncio, 'sleep', fake_sleep)
+
+    async def scenario():
+        bucket = bot.TokenBucket(rate=2, capacity=3)
+        for _ in range(4):
+            await bucket.acquire()
+        return bucket
+
+    bucket = asyncio.run(scenario())
+    assert bucket.waits == 1
+    assert sleeps == [0.5]
+
+
+def test_token_bucket_refills_up_to_capacity(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: clock[0])
+
+    async def scenario():
+        bucket = bot.TokenBucket(rate=1, capacity=2)
+        await bucket.acquire()
+        await bucket.acquire()
+        clock[0] += 100
+        await bucket.acquire()
+        return bucket
+
+    bucket = asyncio.run(scenario())
+    assert bucket.tokens == 1
+    assert bucket.waits == 0